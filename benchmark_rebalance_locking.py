@@ -0,0 +1,113 @@
+# Runs concurrent rebalance and health check workers against the groups and provider configurations in the database,
+# once for each TRANSACTION_ISOLATION_MODE, and reports how many transactions aborted and how long workers stalled
+# in aborted attempts and retry backoff. isolated() already retries deadlocks and serialization failures in place, so
+# aborts only counts the calls that ran out of those retries, and their latency includes them. Provider nodes are faked and no Celery tasks are enqueued, but instance
+# states, groups and events in the database are changed, so only run it against a local database:
+#
+#   cat benchmark_rebalance_locking.py | python manage.py shell_plus
+#
+# BENCHMARK_WORKERS and BENCHMARK_SECONDS set the number of workers of each kind and how long each mode runs.
+import os
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection, OperationalError
+from libcloud.compute.base import Node
+from libcloud.compute.types import NodeState
+
+import stratosphere.submodels.compute_instance
+from stratosphere.util import call_with_retry
+
+worker_count = int(os.environ.get('BENCHMARK_WORKERS', '4'))
+seconds_per_mode = float(os.environ.get('BENCHMARK_SECONDS', '30'))
+
+stratosphere.submodels.compute_instance.schedule_random_default_delay = lambda *args, **kwargs: None
+ProviderConfiguration.schedule_send_failed_email = lambda self: None
+
+def fake_nodes(provider_configuration):
+    instances = provider_configuration.instances.filter(destroyed=False).exclude(external_id=None)
+    return [Node(id=instance.external_id, name=instance.name, state=random.choice([NodeState.RUNNING, NodeState.PENDING]),
+                 public_ips=[], private_ips=[], driver=None) for instance in instances]
+
+def give_instances_external_ids():
+    for instance in ComputeInstance.objects.filter(external_id=None):
+        ComputeInstance.objects.filter(pk=instance.pk).update(external_id=str(uuid.uuid4()))
+
+def rebalance(group_id):
+    ComputeGroup.objects.get(pk=group_id).check_instance_distribution()
+
+def check_health(provider_configuration_id):
+    provider_configuration = ProviderConfiguration.objects.get(pk=provider_configuration_id)
+    provider_configuration._list_nodes = lambda: fake_nodes(provider_configuration)
+    provider_configuration.check_health()
+
+def timed_call(target, arg, stats, stats_lock):
+    attempt_times = []
+    def attempt():
+        attempt_start = time.time()
+        try:
+            target(arg)
+        except OperationalError:
+            with stats_lock:
+                stats['aborts'] += 1
+            raise
+        finally:
+            attempt_times.append(time.time() - attempt_start)
+    start = time.time()
+    try:
+        # retry the way @retry(OperationalError) does in the workers, so backoff shows up as stall time
+        call_with_retry(attempt, OperationalError, delay=1, backoff=3)
+        succeeded = True
+    except OperationalError:
+        succeeded = False
+    elapsed = time.time() - start
+    with stats_lock:
+        stats['calls'] += 1
+        stats['failures'] += 0 if succeeded else 1
+        stats['stall'] += elapsed - attempt_times[-1] if succeeded else elapsed
+        stats['latencies'].append(elapsed)
+
+def run_worker(target, ids, deadline, stats, stats_lock):
+    try:
+        while time.time() < deadline:
+            timed_call(target, random.choice(ids), stats, stats_lock)
+    finally:
+        connection.close()
+
+def print_stats(name, stats):
+    latencies = sorted(stats['latencies']) or [0]
+    print('  %-13s calls: %5d  aborts: %4d  failures: %3d  stall: %7.2fs  median: %6.3fs  max: %6.3fs' %
+          (name, stats['calls'], stats['aborts'], stats['failures'], stats['stall'],
+           latencies[len(latencies) // 2], latencies[-1]))
+
+def run_mode(mode, group_ids, provider_configuration_ids):
+    settings.TRANSACTION_ISOLATION_MODE = mode
+    give_instances_external_ids()
+    stats_lock = threading.Lock()
+    all_stats = {name: {'calls': 0, 'aborts': 0, 'failures': 0, 'stall': 0.0, 'latencies': []}
+                 for name in ('rebalance', 'check_health')}
+    deadline = time.time() + seconds_per_mode
+    threads = [threading.Thread(target=run_worker, args=(rebalance, group_ids, deadline, all_stats['rebalance'], stats_lock))
+               for _ in range(worker_count)]
+    threads += [threading.Thread(target=run_worker, args=(check_health, provider_configuration_ids, deadline,
+                                                          all_stats['check_health'], stats_lock))
+                for _ in range(worker_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('%s:' % mode)
+    for name, stats in sorted(all_stats.items()):
+        print_stats(name, stats)
+
+group_ids = list(ComputeGroup.objects.exclude(state=ComputeGroup.DESTROYED).values_list('pk', flat=True))
+provider_configuration_ids = list(ProviderConfiguration.objects.exclude(user=None).values_list('pk', flat=True))
+print('%d groups, %d provider configurations, %d workers of each kind, %ds per mode' %
+      (len(group_ids), len(provider_configuration_ids), worker_count, seconds_per_mode))
+
+for mode in ('serializable', 'row_lock'):
+    run_mode(mode, group_ids, provider_configuration_ids)
+
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+
 from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider as LibcloudProvider
 
@@ -11,10 +13,11 @@ regions = ['us-east-1', 'us-west-1', 'us-west-2']
 
 driver_cls = get_driver(LibcloudProvider.EC2)
 
-for region in regions:
-    print('Region: %s' % region)
+
+def wreak_havoc(region):
     driver = driver_cls(access_key_id, secret_access_key, region=region)
     nodes = driver.list_nodes()
+    print('Region %s: %d nodes' % (region, len(nodes)))
 
     nodes_to_destroy = list(nodes)
     random.shuffle(nodes_to_destroy)
@@ -24,5 +27,10 @@ for region in regions:
         nodes_to_destroy = nodes_to_destroy[:count]
 
         for node in nodes_to_destroy:
-            print('Destroying %s' % node.id)
+            print('Destroying %s in %s' % (node.id, region))
             driver.destroy_node(node)
+
+
+# regions are independent, so work on all of them at once
+with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+    list(executor.map(wreak_havoc, regions))
@@ -1,2 +1,2 @@
 #!/bin/bash
-echo "[pc._destroy_all_nodes() for pc in ProviderConfiguration.objects.all()]" | python manage.py shell_plus
+echo "ProviderConfiguration.destroy_all_nodes(ProviderConfiguration.objects.all())" | python manage.py shell_plus
@@ -0,0 +1,2 @@
+#!/bin/bash
+echo "ProviderConfiguration.destroy_orphan_nodes(ProviderConfiguration.objects.exclude(user=None))" | python manage.py shell_plus
@@ -301,6 +301,32 @@ COMPRESS_OFFLINE = True
 SITE_ID = int(os.environ.get('DJANGO_SITE_ID', '2'))
 
 
+# how often each provider's shared public image catalog is refreshed
+PUBLIC_IMAGE_CATALOG_MAX_AGE = timedelta(hours=1)
+
+# How read-modify-write paths like rebalancing are isolated: 'row_lock' locks the group or provider configuration
+# row being changed with SELECT ... FOR UPDATE, so concurrent workers queue behind each other, while 'serializable'
+# runs them on the serializable database, where conflicting workers abort and retry.
+TRANSACTION_ISOLATION_MODE = os.environ.get('TRANSACTION_ISOLATION_MODE', 'row_lock')
+
+# Bounds of the thread pools that call many providers' APIs at once, like ProviderConfiguration.list_nodes_concurrently().
+# Configurations of the same provider (region) share a cap, to stay clear of its API rate limits.
+PROVIDER_IO_MAX_WORKERS = int(os.environ.get('PROVIDER_IO_MAX_WORKERS', '16'))
+PROVIDER_IO_MAX_WORKERS_PER_PROVIDER = int(os.environ.get('PROVIDER_IO_MAX_WORKERS_PER_PROVIDER', '4'))
+
+# how long a scheduled task can stay queued or running before the scheduler assumes it was lost and reschedules it
+SCHEDULED_TASK_STALE_AFTER = timedelta(minutes=5)
+
+# How long instance states snapshots are kept at each resolution, after which they're only kept rolled up into the next
+# coarser one; see InstanceStatesRollup. None keeps them forever.
+INSTANCE_STATES_RETENTION = {
+    'raw': timedelta(days=int(os.environ.get('INSTANCE_STATES_RAW_RETENTION_DAYS', '2'))),
+    'minute': timedelta(days=14),
+    'hour': timedelta(days=180),
+    'day': None,
+}
+
+
 PRELOADED_IMAGES = {
     'ubuntu-16.04': {
         'aws_us_east_1': 'ami-736b7219',
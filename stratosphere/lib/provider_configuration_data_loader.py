@@ -1,13 +1,19 @@
-from django.db import transaction
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
 import libcloud.common.types
 
-from ..models import ProviderCredentialSet, ProviderImage, ProviderSize, DiskImage
+from ..models import BestProviderSize, ComputeInstance, Provider, ProviderCredentialSet, ProviderImage, ProviderSize, DiskImage
+from ..util import bulk_update, grouper
 
+from decimal import Decimal
+
+import hashlib
+import itertools
 import json
 import traceback
-import uuid
 
 
 class ProviderConfigurationDataLoader(object):
@@ -15,58 +21,109 @@ class ProviderConfigurationDataLoader(object):
         self._load_available_sizes()
         self._load_available_images(include_public)
 
+    def load_public_catalog(self, max_age=None):
+        """
+        Refreshes the provider's shared public image catalog with this configuration's credentials, unless it was
+        already refreshed within `max_age`. Public images are identical across accounts in a region, so only one
+        public configuration per provider needs to load them each interval.
+        """
+        if max_age is None:
+            max_age = settings.PUBLIC_IMAGE_CATALOG_MAX_AGE
+
+        now = timezone.now()
+        previous_loaded_at = Provider.objects.filter(pk=self.provider_id) \
+                                             .values_list('public_catalog_loaded_at', flat=True).get()
+
+        # claim the refresh, so that concurrent loads for the same provider don't both query the catalog
+        claimed = Provider.objects.filter(pk=self.provider_id, public_catalog_loaded_at=previous_loaded_at) \
+                                  .filter(Q(public_catalog_loaded_at=None) | Q(public_catalog_loaded_at__lte=now - max_age)) \
+                                  .update(public_catalog_loaded_at=now)
+        if not claimed:
+            self.logger.info('Public image catalog for provider %s is fresh, skipping' % self.provider.name)
+            return
+
+        loaded = False
+        try:
+            self.load_data(True)
+            loaded = self.data_state == self.LOADED
+        finally:
+            if not loaded:
+                # let the next refresh retry instead of waiting out max_age
+                Provider.objects.filter(pk=self.provider_id, public_catalog_loaded_at=now) \
+                                .update(public_catalog_loaded_at=previous_loaded_at)
+
     def _load_available_sizes(self):
         driver_sizes = self.driver.list_sizes()
-        provider_size_ids = set(self.provider_sizes.values_list('id', flat=True))
+        provider_sizes_by_external_id = {ps.external_id: ps for ps in self.provider_sizes.all()}
+        size_fields = {f.name: f for f in ProviderSize._meta.get_fields()}
+
+        new_provider_sizes = []
+        modified_provider_sizes = []
 
         for driver_size in self._filter_driver_sizes(driver_sizes):
-            provider_size = ProviderSize.objects.filter(external_id=driver_size.id, provider_configuration=self).first()
-            if provider_size is None:
-                provider_size = ProviderSize(external_id=driver_size.id, provider_configuration=self)
-            else:
-                provider_size_ids.remove(provider_size.pk)
+            provider_size = provider_sizes_by_external_id.pop(driver_size.id, None)
 
             try:
-                provider_size.cpu = self.ecus_by_id[driver_size.id]
+                cpu = self.ecus_by_id[driver_size.id]
             except KeyError:
                 self.logger.warning("Could not find ECU count for driver side %s for provider %s" % (driver_size.id, self.provider.name))
                 continue
 
-            provider_size.name = driver_size.name
-            provider_size.price = driver_size.price
-            provider_size.ram = driver_size.ram
-            provider_size.disk = driver_size.disk
-            provider_size.bandwidth = driver_size.bandwidth
-            provider_size.extra = json.loads(json.dumps(driver_size.extra))
-
-            provider_size.save()
+            values = {
+                'name': driver_size.name,
+                'price': driver_size.price,
+                'ram': driver_size.ram,
+                'disk': driver_size.disk,
+                'bandwidth': driver_size.bandwidth,
+                'cpu': cpu,
+                'extra': json.loads(json.dumps(driver_size.extra)),
+            }
 
-        # remaining elements of provider_size_ids are those elements deleted remotely
-        ProviderSize.objects.filter(pk__in=provider_size_ids).delete()
+            if provider_size is None:
+                new_provider_sizes.append(ProviderSize(external_id=driver_size.id, provider_configuration=self, **values))
+            else:
+                # compare in the fields' Python types, e.g. the driver's float prices against our Decimals
+                values = {name: self._to_field_value(size_fields[name], value) for name, value in values.items()}
+                if any(getattr(provider_size, name) != value for name, value in values.items()):
+                    for name, value in values.items():
+                        setattr(provider_size, name, value)
+                    modified_provider_sizes.append(provider_size)
+
+        # Django has no upsert, and there's no unique constraint on (provider_configuration, external_id) to upsert
+        # against anyway, so new and modified sizes are written separately
+        with transaction.atomic():
+            ProviderSize.objects.bulk_create(new_provider_sizes)
+            bulk_update(modified_provider_sizes, ['name', 'price', 'ram', 'disk', 'bandwidth', 'cpu', 'extra'])
+
+            # remaining elements of provider_sizes_by_external_id are those deleted remotely
+            removed_provider_size_ids = [ps.pk for ps in provider_sizes_by_external_id.values()]
+            if removed_provider_size_ids:
+                ProviderSize.objects.filter(pk__in=removed_provider_size_ids).delete()
+
+            if new_provider_sizes or modified_provider_sizes or removed_provider_size_ids:
+                BestProviderSize.invalidate(provider_configuration=self)
+                self.mark_groups_for_rebalance()
+
+    @staticmethod
+    def _to_field_value(field, value):
+        value = field.to_python(value)
+
+        # to_python() converts floats exactly, e.g. 0.12 to 0.11999999999999999555..., but the database rounds them
+        # to the field's decimal places, so they'd never compare equal to what was stored
+        if isinstance(field, models.DecimalField) and value is not None:
+            value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+
+        return value
 
     def _get_driver_images(self, include_public):
+        """
+        Returns an iterable of driver images. Subclasses whose providers return very large image lists should yield
+        the images as they're parsed rather than building a list, since the loader consumes them in fixed-size
+        batches and never holds more than one batch at a time.
+        """
         return self.driver.list_images()
 
-    # TODO locally delete images deleted remotely
-    def _load_available_images(self, include_public, driver_images_limit=None, row_retrieval_chunk_size=100):
-        def driver_image_name(driver_image):
-            return driver_image.name
-
-        def get_provider_images_by_external_id(driver_images):
-            driver_image_ids = [driver_image.id for driver_image in driver_images]
-            provider_images = ProviderImage.objects.filter(provider=self.provider,
-                                                           external_id__in=driver_image_ids)
-            return {provider_image.external_id: provider_image for provider_image in provider_images}
-
-        import itertools
-        def grouper(n, iterable):
-            it = iter(iterable)
-            while True:
-               chunk = tuple(itertools.islice(it, n))
-               if not chunk:
-                   return
-               yield chunk
-
+    def _load_available_images(self, include_public, driver_images_limit=None, batch_size=1000):
         def handle_load_error(error_type):
             self.logger.error('Caught exception while loading provider images for %s:\n%s' % (self.pk, traceback.format_exc()))
             with transaction.atomic():
@@ -78,10 +135,9 @@ class ProviderConfigurationDataLoader(object):
 
         try:
             self.logger.info('Querying %s images for provider %s for user %s' % ('public' if include_public else 'private', self.provider.name, self.user))
-            start = timezone.now()
 
             try:
-                driver_images = self._get_driver_images(include_public)
+                driver_images = iter(self._get_driver_images(include_public))
 
             except Exception as e:
                 if isinstance(e, libcloud.common.types.InvalidCredsError):
@@ -94,95 +150,171 @@ class ProviderConfigurationDataLoader(object):
                 handle_load_error(error_type)
                 return
 
-            end = timezone.now()
-            self.logger.info('Retrieved %d images in %s' % (len(driver_images), (end - start)))
+            self._sync_provider_images(driver_images, include_public, batch_size, driver_images_limit)
 
-            filtered_driver_images = list(driver_images)
-            if driver_images_limit is not None:
-                filtered_driver_images = filtered_driver_images[:driver_images_limit]
+        except:
+            handle_load_error(None)
+        else:
+            self.data_state = self.LOADED
+            self.save()
 
-            self.logger.info('Scanning driver and updating provider images...')
-            start = timezone.now()
+    @staticmethod
+    def _fingerprint_image_extra(extra_json):
+        return hashlib.sha1(extra_json.encode('utf-8')).hexdigest()
 
-            modified, scanned = 0, 0
-            new_driver_images_by_provider_id = {}
-            for driver_images_chunk in grouper(row_retrieval_chunk_size, filtered_driver_images):
-                provider_images_by_external_id = get_provider_images_by_external_id(driver_images_chunk)
+    def _sync_provider_images(self, driver_images, include_public, batch_size, driver_images_limit=None):
+        """
+        Brings this configuration's ProviderImages in line with `driver_images`, touching only the images that were
+        added, changed or removed remotely. Images are compared by external ID and a fingerprint of their `extra`,
+        and links to this configuration are added and removed in bulk on the M2M through table.
 
-                for driver_image in driver_images_chunk:
-                    provider_image = provider_images_by_external_id.get(driver_image.id)
-                    if provider_image is None:
-                        new_provider_id = uuid.uuid4()
-                        new_driver_images_by_provider_id[new_provider_id] = driver_image
-                    else:
-                        provider_image.extra = json.loads(json.dumps(driver_image.extra))
+        Only the first `driver_images_limit` images are synced, if it's given. Nothing is removed when that cuts the
+        listing short, since the images past the limit would otherwise look like they were deleted remotely.
 
-                        if provider_image.has_changed:
-                            modified += 1
-                            provider_image.save()
+        Public images belong to the provider's catalog and are only created, changed or removed when `include_public`
+        is set. Those changes are stamped with the next catalog version, which is bumped once the sync finishes.
+        """
+        self.logger.info('Syncing driver images with provider images...')
+        start = timezone.now()
 
-                scanned += len(driver_images_chunk)
+        catalog_version = None
+        if include_public:
+            catalog_version = Provider.objects.filter(pk=self.provider_id) \
+                                              .values_list('public_catalog_version', flat=True).get() + 1
 
-            end = timezone.now()
-            self.logger.info('Scanned %d driver images and modified %d ProviderImages in %s' %
-                  (len(filtered_driver_images), modified, end - start))
+        ProviderImageLink = ProviderImage.provider_configurations.through
+        linked_image_ids = set(ProviderImageLink.objects.filter(providerconfiguration_id=self.pk)
+                                                        .values_list('providerimage_id', flat=True))
 
+        seen_image_ids = set()
+        created, modified, linked, unlinked = 0, 0, 0, 0
+
+        driver_images = iter(driver_images)
+        listed_images = driver_images if driver_images_limit is None else itertools.islice(driver_images, driver_images_limit)
+
+        for driver_images_batch in grouper(batch_size, listed_images):
             with transaction.atomic():
-                new_driver_image_names = {driver_image: driver_image.name
-                                          for driver_image in new_driver_images_by_provider_id.values()}
+                batch_created, batch_modified, batch_image_ids_by_public = \
+                    self._sync_provider_images_batch(driver_images_batch, include_public, catalog_version)
 
-                self.logger.info('Creating DiskImages...')
-                start = timezone.now()
+                seen_image_ids.update(batch_image_ids_by_public[True])
+                seen_image_ids.update(batch_image_ids_by_public[False])
 
-                new_disk_images_by_provider_id = {new_provider_id: DiskImage(name=new_driver_image_names[driver_image])
-                                                  for new_provider_id, driver_image in new_driver_images_by_provider_id.items()}
-                DiskImage.objects.bulk_create(new_disk_images_by_provider_id.values())
+                # private images are linked to the configurations that can see them; public images aren't linked at all
+                link_image_ids = [pk for pk in batch_image_ids_by_public[False] if pk not in linked_image_ids]
+                unlink_image_ids = [pk for pk in batch_image_ids_by_public[True] if pk in linked_image_ids]
 
-                end = timezone.now()
-                self.logger.info('Created %d DiskImages in %s' % (len(new_disk_images_by_provider_id), end - start))
+                ProviderImageLink.objects.bulk_create([ProviderImageLink(providerimage_id=pk, providerconfiguration_id=self.pk)
+                                                       for pk in link_image_ids])
+                ProviderImageLink.objects.filter(providerconfiguration_id=self.pk, providerimage_id__in=unlink_image_ids).delete()
 
-                self.logger.info('Creating ProviderImages...')
-                start = timezone.now()
+                linked_image_ids.update(link_image_ids)
+                linked_image_ids.difference_update(unlink_image_ids)
 
-                for chunk in grouper(1000, new_driver_images_by_provider_id.items()):
-                    new_provider_images = [ProviderImage(id=new_provider_id,
-                                                         provider=self.provider,
-                                                         external_id=driver_image.id,
-                                                         name=new_driver_image_names[driver_image],
-                                                         extra=json.loads(json.dumps(driver_image.extra)),
-                                                         disk_image=new_disk_images_by_provider_id[new_provider_id])
-                                           for new_provider_id, driver_image in chunk]
-                    ProviderImage.objects.bulk_create(new_provider_images)
+            created += batch_created
+            modified += batch_modified
+            linked += len(link_image_ids)
+            unlinked += len(unlink_image_ids)
 
-                end = timezone.now()
-                self.logger.info('Created %d ProviderImages in %s' % (len(new_driver_images_by_provider_id), end - start))
+        # islice() has consumed exactly the images it returned, so any image left means the listing was truncated
+        if driver_images_limit is not None and next(driver_images, None) is not None:
+            self.logger.warning('Listing of images for provider %s was truncated to %d images, not removing any' %
+                                (self.provider.name, driver_images_limit))
+            removed = 0
+        else:
+            removed = self._remove_deleted_provider_images(seen_image_ids, linked_image_ids, include_public, batch_size)
 
-                self.logger.info('Linking ProviderImages to DiskImages...')
-                start = timezone.now()
+        if include_public and (created or modified or removed):
+            Provider.objects.filter(pk=self.provider_id).update(public_catalog_version=F('public_catalog_version') + 1)
 
-                scanned, linked, unlinked = 0, 0, 0
-                new_driver_images = new_driver_images_by_provider_id.values()
-                for driver_images_chunk in grouper(row_retrieval_chunk_size, filtered_driver_images):
-                    provider_images_by_external_id = get_provider_images_by_external_id(driver_images_chunk)
+            # public images are available to every configuration of the provider
+            BestProviderSize.invalidate(provider_configuration__provider_id=self.provider_id)
+        elif created or modified or linked or unlinked or removed:
+            BestProviderSize.invalidate(provider_configuration=self)
+            self.mark_groups_for_rebalance()
 
-                    for driver_image in driver_images_chunk:
-                        provider_image = provider_images_by_external_id[driver_image.id]
+        end = timezone.now()
+        self.logger.info('Synced %d driver images in %s: created %d, modified %d, linked %d, unlinked %d, removed %d' %
+                         (len(seen_image_ids), end - start, created, modified, linked, unlinked, removed))
 
-                        if self.image_is_public(provider_image):
-                            unlinked += 1
-                            provider_image.provider_configurations.remove(self)
-                        else:
-                            linked += 1
-                            provider_image.provider_configurations.add(self)
+    def _sync_provider_images_batch(self, driver_images, include_public, catalog_version):
+        extra_jsons = {driver_image.id: json.dumps(driver_image.extra, sort_keys=True) for driver_image in driver_images}
 
-                    scanned += len(driver_images_chunk)
+        existing_provider_images = ProviderImage.objects.filter(provider=self.provider, external_id__in=extra_jsons.keys()) \
+                                                        .only('id', 'external_id', 'extra_hash')
+        provider_images_by_external_id = {pi.external_id: pi for pi in existing_provider_images}
 
-                end = timezone.now()
-                self.logger.info('Scanned %d ProviderImages, linked %d, unlinked %d to DiskImages in %s' %
-                      (scanned, linked, unlinked, end - start))
+        new_disk_images = []
+        new_provider_images = []
+        modified_provider_images = []
+        image_ids_by_public = {True: [], False: []}
 
-        except:
-            handle_load_error(None)
-        else:
-            self.data_state = self.LOADED
-            self.save()
+        for driver_image in driver_images:
+            extra_json = extra_jsons[driver_image.id]
+            extra = json.loads(extra_json)
+            extra_hash = self._fingerprint_image_extra(extra_json)
+
+            # image_is_public() only looks at `extra`
+            is_public = bool(self.image_is_public(ProviderImage(extra=extra)))
+            image_catalog_version = catalog_version if is_public else None
+
+            provider_image = provider_images_by_external_id.get(driver_image.id)
+            if is_public and not include_public:
+                # public images are synced with the provider's catalog, but still need to be unlinked below
+                if provider_image is None:
+                    continue
+
+            elif provider_image is None:
+                disk_image = DiskImage(name=driver_image.name)
+                new_disk_images.append(disk_image)
+
+                provider_image = ProviderImage(provider=self.provider, external_id=driver_image.id,
+                                               name=driver_image.name, extra=extra, extra_hash=extra_hash,
+                                               catalog_version=image_catalog_version, disk_image=disk_image)
+                new_provider_images.append(provider_image)
+
+                # guard against the same image being listed twice
+                provider_images_by_external_id[driver_image.id] = provider_image
+
+            elif provider_image.extra_hash != extra_hash:
+                provider_image.extra = extra
+                provider_image.extra_hash = extra_hash
+                provider_image.catalog_version = image_catalog_version
+                modified_provider_images.append(provider_image)
+
+            image_ids_by_public[is_public].append(provider_image.pk)
+
+        DiskImage.objects.bulk_create(new_disk_images)
+        ProviderImage.objects.bulk_create(new_provider_images)
+        bulk_update(modified_provider_images, ['extra', 'extra_hash', 'catalog_version'])
+
+        return len(new_provider_images), len(modified_provider_images), image_ids_by_public
+
+    def _remove_deleted_provider_images(self, seen_image_ids, linked_image_ids, include_public, batch_size):
+        # Images this configuration can no longer see are unlinked from it. Those that no other configuration links to
+        # are deleted, except when instances still refer to them, in which case they're left alone entirely, since
+        # unlinking a private image would make it look public.
+        missing_image_ids = linked_image_ids - seen_image_ids
+
+        if include_public:
+            public_image_ids = ProviderImage.objects.filter(provider=self.provider, provider_configurations=None) \
+                                                    .values_list('id', flat=True).iterator()
+            missing_image_ids.update(pk for pk in public_image_ids if pk not in seen_image_ids)
+
+        removed = 0
+        ProviderImageLink = ProviderImage.provider_configurations.through
+
+        for missing_image_ids_batch in grouper(batch_size, missing_image_ids):
+            with transaction.atomic():
+                used_image_ids = set(ComputeInstance.objects.filter(provider_image_id__in=missing_image_ids_batch)
+                                                            .values_list('provider_image_id', flat=True))
+                removable_image_ids = [pk for pk in missing_image_ids_batch if pk not in used_image_ids]
+
+                ProviderImageLink.objects.filter(providerconfiguration_id=self.pk,
+                                                 providerimage_id__in=removable_image_ids).delete()
+
+                removable_images = ProviderImage.objects.filter(pk__in=removable_image_ids, provider_configurations=None)
+                removed += removable_images.count()
+                removable_images.delete()
+
+        return removed
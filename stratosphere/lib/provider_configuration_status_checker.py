@@ -7,41 +7,42 @@ from django.utils import timezone
 from libcloud.compute.types import NodeState
 
 from stratosphere.models import ComputeInstance
-from stratosphere.util import thread_local
 
 import traceback
 
-from ..models import Event, InstanceFailedEvent, InstanceStateChangeEvent
-from ..tasks import send_failed_email
-from ..util import call_with_retry
+from ..models import ChangeCounter, Event, InstanceFailedEvent, InstanceStateChangeEvent
+from ..tasks import PROVIDER_CHECK_RETRY_BACKOFF, PROVIDER_CHECK_RETRY_DELAY, send_failed_email
+from ..util import bulk_create_historical_records, bulk_create_inherited, bulk_update, call_with_retry, isolated
 
 
 class ProviderConfigurationFailedEvent(Event):
     class Meta:
         app_label = "stratosphere"
 
-    @property
-    def object_name(self):
-        return self.provider_configuration.provider.pretty_name
+    prefetched_fields = ('provider_configuration',)
+
+    def _get_display_name(self):
+        return self.cached_provider_configuration.provider.pretty_name
 
     @property
     def rich_description(self):
-        return "Provider <b>%s</b> <strong style='color: red;'>FAILED</strong>." % self.provider_configuration.provider.pretty_name
+        return "Provider <b>%s</b> <strong style='color: red;'>FAILED</strong>." % self.object_name
 
 
 class ProviderConfigurationEnabledEvent(Event):
     class Meta:
         app_label = "stratosphere"
 
+    prefetched_fields = ('provider_configuration',)
+
     enabled = models.BooleanField()
 
-    @property
-    def object_name(self):
-        return self.provider_configuration.provider.pretty_name
+    def _get_display_name(self):
+        return self.cached_provider_configuration.provider.pretty_name
 
     @property
     def rich_description(self):
-        return "Provider <b>%s</b> %s." % (self.provider_configuration.provider.pretty_name, 'enabled' if self.enabled else 'disabled')
+        return "Provider <b>%s</b> %s." % (self.object_name, 'enabled' if self.enabled else 'disabled')
 
 
 class ProviderConfigurationStatusChecker(object):
@@ -64,13 +65,19 @@ class ProviderConfigurationStatusChecker(object):
 
             ProviderConfigurationEnabledEvent.objects.create(user=self.user, provider_configuration=self, enabled=enabled_value)
 
-    def max_failure_count(self):
-        instance_count = self.instances.count()
+            self.mark_groups_for_rebalance()
+
+    def max_failure_count(self, instances=None):
+        instance_count = self.instances.count() if instances is None else len(instances)
         return instance_count if instance_count < 3 else 3
 
-    def failure_count(self, now):
+    def failure_count(self, now, instances=None):
         one_hour_ago = now - timedelta(hours=1)
-        return self.instances.filter(ComputeInstance.unignored_failed_instances_query() & Q(failed_at__gte=one_hour_ago)).count()
+        if instances is None:
+            return self.instances.filter(ComputeInstance.unignored_failed_instances_query() & Q(failed_at__gte=one_hour_ago)).count()
+        else:
+            return sum(1 for instance in instances
+                       if instance.is_unignored_failed() and instance.failed_at is not None and instance.failed_at >= one_hour_ago)
 
     def schedule_send_failed_email(self):
         send_failed_email.apply_async(args=[self.pk])
@@ -85,12 +92,16 @@ class ProviderConfigurationStatusChecker(object):
 
         ProviderConfigurationFailedEvent.objects.create(user=self.user, provider_configuration=self)
 
-    @thread_local(DB_OVERRIDE='serializable')
-    def check_enabled(self):
+    @isolated()
+    def check_enabled(self, instances=None):
+        """
+        Disables this configuration if too many of its instances failed in the last hour. `instances` can be passed
+        in when all of the configuration's instances have already been loaded, to count them in memory.
+        """
         now = timezone.now()
-        instance_count = self.instances.count()
-        max_failure_count_value = self.max_failure_count()
-        failure_count_value = self.failure_count(now)
+        instance_count = self.instances.count() if instances is None else len(instances)
+        max_failure_count_value = self.max_failure_count(instances)
+        failure_count_value = self.failure_count(now, instances)
 
         self.logger.info('Instance count: %d, max failure count: %d, failure count: %d' %
                          (instance_count, max_failure_count_value, failure_count_value))
@@ -101,94 +112,208 @@ class ProviderConfigurationStatusChecker(object):
         else:
             self.logger.info('Provider %s (%s) already disabled' % (self.pk, self.provider.name))
 
-    @thread_local(DB_OVERRIDE='serializable')
-    def check_failed_instances(self):
-        bad_instances = []
+    def check_health(self, bulk=True, retry_task=None):
+        """
+        Runs the whole health pipeline for this configuration: reconciles its instances' states with the nodes
+        reported by the provider, marks instances that are stuck or in unexpected states as failed, and disables the
+        configuration if too many have failed. Nodes are listed before the transaction begins, since that's slow;
+        the instances are then loaded, locked, and all of the resulting changes written in one transaction; in bulk
+        mode, with one UPDATE for the instances and one INSERT per kind of record, rather than a save() per instance
+        and event.
+
+        If listing nodes fails, it's retried in place with a blocking backoff, unless `retry_task`, the bound Celery
+        task running the check, is given: then the task is re-enqueued with a backoff countdown instead, freeing the
+        worker for other configurations, and the instances are only marked UNKNOWN once it's out of retries.
+
+        Returns the orphan nodes found at the provider; see _find_orphan_nodes().
+        """
+        try:
+            self.logger.info('Querying statuses for instances of provider %s' % self.pk)
+            if retry_task is None:
+                libcloud_nodes = call_with_retry(lambda: self._list_nodes(), Exception, logger=self.logger)
+            else:
+                libcloud_nodes = self._list_nodes()
+            self.logger.info('Got %d nodes' % len(libcloud_nodes))
+
+        except Exception as e:
+            if retry_task is not None and retry_task.request.retries < retry_task.max_retries:
+                countdown = PROVIDER_CHECK_RETRY_DELAY * PROVIDER_CHECK_RETRY_BACKOFF ** retry_task.request.retries
+                self.logger.warning('Error listing nodes of %s (%s: %s), retrying in %d seconds' %
+                                    (self, e.__class__.__qualname__, e, countdown))
+                raise retry_task.retry(exc=e, countdown=countdown)
+
+            # TODO increment failure count even if there aren't any nodes
+            self.logger.error('Error listing nodes of %s' % self)
+
+            traceback.print_exc()
+            libcloud_nodes = None
+
+        orphan_nodes = self._apply_instance_statuses(libcloud_nodes, bulk)
+
+        if self.user is not None:
+            self.user.take_instance_states_snapshot_if_changed()
+
+        return orphan_nodes
+
+    @isolated()
+    def _apply_instance_statuses(self, libcloud_nodes, bulk):
+        """
+        Reconciles the instances with `libcloud_nodes`, or marks them all UNKNOWN if listing the nodes failed (None),
+        and writes the changes. The instances are loaded here, locked in primary key order, rather than before the
+        nodes were listed, so that the changes are made to their current fields instead of overwriting whatever
+        changed while the provider was being queried.
+        """
+        instances = list(self.instances.select_for_update().order_by('pk'))
+        orphan_nodes = []
+
+        if libcloud_nodes is None:
+            for instance in instances:
+                instance.state = ComputeInstance.UNKNOWN
+            state_change_events = []
+
+        else:
+            state_change_events, orphan_nodes = self._reconcile_instance_states(instances, libcloud_nodes)
+            if len(orphan_nodes) > 0:
+                self.logger.warning('Found %d orphan nodes for provider %s: %s' %
+                                    (len(orphan_nodes), self.pk, [node.id for node in orphan_nodes]))
+
+        failed_events = self._mark_failed_instances(instances)
+
+        # prevent transaction from failing, or causing other transactions to fail, if nothing has changed
+        # TODO is this actually effective?
+        changed_instances = [instance for instance in instances if instance.has_changed]
+
+        self._save_instance_statuses(changed_instances, state_change_events + failed_events, bulk)
+        self.check_enabled(instances)
+
+        return orphan_nodes
 
+    def _reconcile_instance_states(self, instances, libcloud_nodes):
+        now = timezone.now()
+        thirty_seconds_ago = now - timedelta(seconds=30)
+
+        nodes_by_external_id = {node.id: node for node in libcloud_nodes}
+        tracked_external_ids = set()
+        state_change_events = []
+
+        # exclude ComputeInstances whose libcloud node creation jobs have not yet run
+        for instance in instances:
+            if instance.external_id is None:
+                continue
+
+            tracked_external_ids.add(instance.external_id)
+            node = nodes_by_external_id.get(instance.external_id)
+
+            if node is None:
+                # There's a race condition between assigning an instance an external_id when it's created and the
+                # list_nodes() query returning, so wait 30 seconds before a missing instance is considered
+                # terminated (and thus failed).
+                if instance.created_at < thirty_seconds_ago:
+                    instance.state = ComputeInstance.TERMINATED
+            else:
+                instance.state = NodeState.tostring(node.state)
+                instance.private_ips = node.private_ips
+                instance.public_ips = node.public_ips
+
+                self.logger.info('State of node %s is %s' % (instance.pk, instance.state))
+
+            if instance.has_changed and 'state' in instance.changed_fields:
+                old_state = instance.old_values['state']
+                self.logger.info('Updating state of instance %s from %s to %s' % (instance.pk, old_state, instance.state))
+                state_change_events.append(InstanceStateChangeEvent(user=self.user, provider_configuration=self,
+                                                                    compute_group_id=instance.group_id,
+                                                                    compute_instance=instance, old_state=old_state,
+                                                                    new_state=instance.state))
+
+        orphan_nodes = self._find_orphan_nodes(nodes_by_external_id, tracked_external_ids)
+        return state_change_events, orphan_nodes
+
+    def _mark_failed_instances(self, instances):
+        """
+        Marks instances that have been pending for too long, or that are in an unexpected state, as failed, and
+        returns the (unsaved) InstanceFailedEvents for them.
+        """
         now = timezone.now()
         five_minutes_ago = now - timedelta(minutes=5)
-        bad_pending_instances_query = ComputeInstance.pending_instances_query() & Q(created_at__lt=five_minutes_ago)
-        bad_pending_instances = self.instances.filter(bad_pending_instances_query)
-        bad_instances.extend(list(bad_pending_instances))
 
+        bad_pending_instances = [instance for instance in instances
+                                 if instance.is_pending() and instance.created_at < five_minutes_ago]
         if len(bad_pending_instances) > 0:
             self.logger.warn('Found %d expired pending instances for provider %s: %s' %
                              (len(bad_pending_instances), self.pk, bad_pending_instances))
 
-        bad_state_instances_query =  ~ComputeInstance.running_instances_query()
-        bad_state_instances_query &= ~ComputeInstance.pending_instances_query()
-        bad_state_instances_query &= ~ComputeInstance.unavailable_instances_query()
-        bad_state_instances = self.instances.filter(bad_state_instances_query)
-        bad_instances.extend(list(bad_state_instances))
-
+        bad_state_instances = [instance for instance in instances
+                               if not instance.is_running() and not instance.is_pending() and not instance.is_unavailable()]
         if len(bad_state_instances) > 0:
             self.logger.warn('Found %d instances in an unexpected state for provider %s: %s' %
                              (len(bad_state_instances), self.pk, bad_state_instances))
 
         # TODO this is where all the other health checks would go
 
-        for instance in bad_instances:
-            with transaction.atomic():
-                self.logger.warn('Marking instance %s failed for provider %s' % (instance.pk, self.pk))
-                self.logger.warn('state: %s, failed: %s, destroyed: %s' % (instance.state, instance.failed, instance.destroyed))
+        failed_events = []
+        for instance in bad_pending_instances + bad_state_instances:
+            self.logger.warn('Marking instance %s failed for provider %s' % (instance.pk, self.pk))
+            self.logger.warn('state: %s, failed: %s, destroyed: %s' % (instance.state, instance.failed, instance.destroyed))
 
-                instance.failed = True
-                instance.failed_at = now
-                instance.save()
+            instance.failed = True
+            instance.failed_at = now
 
-                InstanceFailedEvent.objects.create(user=self.user, provider_configuration=self, compute_group=instance.group, compute_instance=instance)
+            failed_events.append(InstanceFailedEvent(user=self.user, provider_configuration=self,
+                                                     compute_group_id=instance.group_id, compute_instance=instance))
 
-    def update_instance_statuses(self):
-        try:
-            self.logger.info('Querying statuses for instances of provider %s' % self.pk)
-            libcloud_nodes = call_with_retry(lambda: self._list_nodes(), Exception, logger=self.logger)
-            self.logger.info('Got %d nodes' % len(libcloud_nodes))
+        return failed_events
 
-        except Exception as e:
-            # TODO increment failure count even if there aren't any nodes
-            self.logger.error('Error listing nodes of %s' % self)
+    def _save_instance_statuses(self, changed_instances, events, bulk):
+        if len(changed_instances) == 0:
+            return
 
-            traceback.print_exc()
-            for instance in self.instances.all():
-                instance.state = ComputeInstance.UNKNOWN
-                instance.save()
+        rebalance_group_ids = {instance.group_id for instance in changed_instances
+                               if {'state', 'failed'} & set(instance.changed_fields)}
 
-        else:
-            now = timezone.now()
-            thirty_seconds_ago = now - timedelta(seconds=30)
-
-            # exclude ComputeInstances whose libcloud node creation jobs have not yet run
-            for instance in self.instances.filter(~Q(external_id=None)):
-                nodes = list(filter(lambda node: node.id == instance.external_id, libcloud_nodes))
-
-                if len(nodes) == 0:
-                    # There's a race condition between assigning an instance an external_id when it's created and the
-                    # list_nodes() query returning, so wait 30 seconds before a missing instance is considered
-                    # terminated (and thus failed).
-                    if instance.created_at < thirty_seconds_ago:
-                        instance.state = ComputeInstance.TERMINATED
-                else:
-                    node = nodes[0]
-
-                    instance.state = NodeState.tostring(node.state)
-                    instance.private_ips = node.private_ips
-                    instance.public_ips = node.public_ips
-
-                    self.logger.info('State of node %s is %s' % (instance.pk, instance.state))
-
-                # prevent transaction from failing, or causing other transactions to fail, if nothing has changed
-                # TODO is this actually effective?
-                if instance.has_changed:
-                    if 'state' in instance.changed_fields:
-                        old_state = instance.old_values['state']
-                        self.logger.info('Updating state of instance %s from %s to %s' % (instance.pk, old_state, instance.state))
-                        InstanceStateChangeEvent.objects.create(user=self.user, provider_configuration=self, compute_group=instance.group,
-                                                                compute_instance=instance, old_state=old_state, new_state=instance.state)
+        with transaction.atomic():
+            if bulk:
+                self.logger.info('Saving %d changed instances and %d events in bulk' % (len(changed_instances), len(events)))
+                bulk_update(changed_instances, ['state', 'private_ips', 'public_ips', 'failed', 'failed_at'])
+                bulk_create_historical_records(changed_instances)
+
+                # bulk_create_inherited() takes one model at a time, and skips save(), which captures display fields
+                events_by_class = {}
+                for event in events:
+                    event.capture_display_fields()
+                    events_by_class.setdefault(event.__class__, []).append(event)
+                for class_events in events_by_class.values():
+                    bulk_create_inherited(class_events)
+
+                # bulk_update() and bulk_create_inherited() skip the post_save handlers that bump the change counter
+                ChangeCounter.bump([ChangeCounter.COMPUTE, ChangeCounter.PROVIDERS, ChangeCounter.EVENTS],
+                                   {ChangeCounter.COMPUTE: {instance.group_id for instance in changed_instances},
+                                    ChangeCounter.PROVIDERS: [self.pk]},
+                                   user=self.user_id)
+            else:
+                for event in events:
+                    event.save()
 
+                # in primary key order, like bulk_update(), so that concurrent writers lock instance rows in one order
+                for instance in sorted(changed_instances, key=lambda instance: instance.pk):
                     instance.save()
 
-            self.check_failed_instances()
+            if len(rebalance_group_ids) > 0:
+                self.mark_groups_for_rebalance(rebalance_group_ids)
+
+    def _find_orphan_nodes(self, nodes_by_external_id, tracked_external_ids):
+        """
+        Returns the nodes that exist at the provider but aren't tracked by any of our ComputeInstances. Nodes that
+        are already terminated are ignored, as are nodes whose names match instances that are still waiting for
+        create_libcloud_node() to record their external_id.
+        """
+        untracked_nodes = [node for external_id, node in nodes_by_external_id.items()
+                           if external_id not in tracked_external_ids and node.state != NodeState.TERMINATED]
+
+        if len(untracked_nodes) == 0:
+            return []
+
+        # create_libcloud_node() names nodes "<group name>-<instance name>"
+        uncreated_instances = self.instances.filter(external_id=None).values_list('group__name', 'name')
+        uncreated_node_names = {'%s-%s' % (group_name, name) for group_name, name in uncreated_instances}
 
-            if self.user is not None:
-                with thread_local(DB_OVERRIDE='serializable'):
-                    self.user.take_instance_states_snapshot_if_changed()
+        return [node for node in untracked_nodes if node.name not in uncreated_node_names]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import annoying.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0006_auto_20160809_0029'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_instance_states_counts',
+            field=annoying.fields.JSONField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0007_user_last_instance_states_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='providerimage',
+            name='extra_hash',
+            field=models.CharField(max_length=40, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0008_providerimage_extra_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provider',
+            name='public_catalog_loaded_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='provider',
+            name='public_catalog_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='providerimage',
+            name='catalog_version',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+    ]
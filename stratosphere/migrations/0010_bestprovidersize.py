@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0009_public_image_catalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BestProviderSize',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, default=uuid.uuid4, serialize=False, editable=False)),
+                ('cpu', models.IntegerField()),
+                ('memory', models.IntegerField()),
+                ('compute_image', models.ForeignKey(related_name='best_provider_sizes', to='stratosphere.ComputeImage')),
+                ('provider_configuration', models.ForeignKey(related_name='best_provider_sizes', to='stratosphere.ProviderConfiguration')),
+                ('provider_size', models.ForeignKey(related_name='+', null=True, blank=True, to='stratosphere.ProviderSize')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='bestprovidersize',
+            unique_together=set([('provider_configuration', 'compute_image', 'cpu', 'memory')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0010_bestprovidersize'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='computegroup',
+            name='needs_rebalance',
+            field=models.BooleanField(default=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='historicalcomputegroup',
+            name='needs_rebalance',
+            field=models.BooleanField(default=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0011_computegroup_needs_rebalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTask',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, default=uuid.uuid4, serialize=False, editable=False)),
+                ('task_name', models.CharField(max_length=128)),
+                ('entity_id', models.CharField(max_length=64)),
+                ('scheduled_at', models.DateTimeField()),
+                ('started_at', models.DateTimeField(null=True, blank=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scheduledtask',
+            unique_together=set([('task_name', 'entity_id')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0012_scheduledtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledtask',
+            name='retry_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scheduledtask',
+            name='last_error',
+            field=models.TextField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0013_scheduledtask_retries'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('user', 'created_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import annoying.fields
+
+
+# Names are copied from the event's most specific object: its instance, else its group, else (for provider events)
+# its provider configuration's provider.
+CAPTURE_DISPLAY_NAMES_SQL = [
+    """
+    UPDATE stratosphere_event SET display_name = stratosphere_computeinstance.name
+    FROM stratosphere_computeinstance
+    WHERE stratosphere_event.compute_instance_id = stratosphere_computeinstance.id
+    AND stratosphere_event.display_name IS NULL
+    """,
+    """
+    UPDATE stratosphere_event SET display_name = stratosphere_computegroup.name
+    FROM stratosphere_computegroup
+    WHERE stratosphere_event.compute_group_id = stratosphere_computegroup.id
+    AND stratosphere_event.compute_instance_id IS NULL
+    AND stratosphere_event.display_name IS NULL
+    """,
+    """
+    UPDATE stratosphere_event SET display_name = stratosphere_provider.pretty_name
+    FROM stratosphere_providerconfiguration, stratosphere_provider
+    WHERE stratosphere_event.provider_configuration_id = stratosphere_providerconfiguration.id
+    AND stratosphere_providerconfiguration.provider_id = stratosphere_provider.id
+    AND stratosphere_event.compute_group_id IS NULL
+    AND stratosphere_event.compute_instance_id IS NULL
+    AND stratosphere_event.display_name IS NULL
+    """,
+]
+
+
+def capture_size_labels(apps, schema_editor):
+    RebalanceEvent = apps.get_model('stratosphere', 'RebalanceEvent')
+    ProviderSize = apps.get_model('stratosphere', 'ProviderSize')
+
+    events = list(RebalanceEvent.objects.filter(size_labels=None).only('old_size_distribution', 'new_size_distribution'))
+
+    size_ids = set()
+    for event in events:
+        size_ids |= set(event.old_size_distribution.keys()) | set(event.new_size_distribution.keys())
+
+    sizes = ProviderSize.objects.select_related('provider_configuration__provider').in_bulk(size_ids)
+    size_labels_by_id = {str(size_id): [size.provider_configuration.provider.pretty_name, size.external_id]
+                         for size_id, size in sizes.items()}
+
+    for event in events:
+        event_size_ids = set(event.old_size_distribution.keys()) | set(event.new_size_distribution.keys())
+        size_labels = {size_id: size_labels_by_id[size_id] for size_id in event_size_ids if size_id in size_labels_by_id}
+        RebalanceEvent.objects.filter(pk=event.pk).update(size_labels=size_labels)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0014_event_feed_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='display_name',
+            field=models.CharField(max_length=256, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='rebalanceevent',
+            name='size_labels',
+            field=annoying.fields.JSONField(null=True, blank=True),
+        ),
+        migrations.RunSQL(CAPTURE_DISPLAY_NAMES_SQL, migrations.RunSQL.noop),
+        migrations.RunPython(capture_size_labels, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stratosphere', '0015_event_display_fields'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='instancestatessnapshot',
+            index_together=set([('user', 'time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='groupinstancestatessnapshot',
+            index_together=set([('user_snapshot', 'group')]),
+        ),
+    ]
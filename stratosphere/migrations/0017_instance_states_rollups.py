@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stratosphere', '0016_instance_states_snapshot_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceStatesMinuteRollup',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, default=uuid.uuid4, serialize=False, editable=False)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('last_time', models.DateTimeField()),
+                ('pending', models.IntegerField()),
+                ('running', models.IntegerField()),
+                ('failed', models.IntegerField()),
+                ('pending_min', models.IntegerField()),
+                ('running_min', models.IntegerField()),
+                ('failed_min', models.IntegerField()),
+                ('pending_max', models.IntegerField()),
+                ('running_max', models.IntegerField()),
+                ('failed_max', models.IntegerField()),
+                ('group', models.ForeignKey(null=True, blank=True, related_name='+', to='stratosphere.ComputeGroup')),
+                ('user', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='instancestatesminuterollup',
+            index_together=set([('user', 'group', 'last_time')]),
+        ),
+        migrations.CreateModel(
+            name='InstanceStatesHourRollup',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, default=uuid.uuid4, serialize=False, editable=False)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('last_time', models.DateTimeField()),
+                ('pending', models.IntegerField()),
+                ('running', models.IntegerField()),
+                ('failed', models.IntegerField()),
+                ('pending_min', models.IntegerField()),
+                ('running_min', models.IntegerField()),
+                ('failed_min', models.IntegerField()),
+                ('pending_max', models.IntegerField()),
+                ('running_max', models.IntegerField()),
+                ('failed_max', models.IntegerField()),
+                ('group', models.ForeignKey(null=True, blank=True, related_name='+', to='stratosphere.ComputeGroup')),
+                ('user', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='instancestateshourrollup',
+            index_together=set([('user', 'group', 'last_time')]),
+        ),
+        migrations.CreateModel(
+            name='InstanceStatesDayRollup',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, default=uuid.uuid4, serialize=False, editable=False)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('last_time', models.DateTimeField()),
+                ('pending', models.IntegerField()),
+                ('running', models.IntegerField()),
+                ('failed', models.IntegerField()),
+                ('pending_min', models.IntegerField()),
+                ('running_min', models.IntegerField()),
+                ('failed_min', models.IntegerField()),
+                ('pending_max', models.IntegerField()),
+                ('running_max', models.IntegerField()),
+                ('failed_max', models.IntegerField()),
+                ('group', models.ForeignKey(null=True, blank=True, related_name='+', to='stratosphere.ComputeGroup')),
+                ('user', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='instancestatesdayrollup',
+            index_together=set([('user', 'group', 'last_time')]),
+        ),
+    ]
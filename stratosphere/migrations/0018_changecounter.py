@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# every user needs a counter for their changes to be counted; new users get one when they're created
+CREATE_CHANGE_COUNTERS_SQL = """
+    INSERT INTO stratosphere_changecounter (user_id, version, compute_version, providers_version, events_version,
+                                            state_history_version)
+    SELECT id, 0, 0, 0, 0, 0 FROM stratosphere_user
+    """
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stratosphere', '0017_instance_states_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCounter',
+            fields=[
+                ('user', models.OneToOneField(primary_key=True, related_name='change_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.BigIntegerField(default=0)),
+                ('compute_version', models.BigIntegerField(default=0)),
+                ('providers_version', models.BigIntegerField(default=0)),
+                ('events_version', models.BigIntegerField(default=0)),
+                ('state_history_version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunSQL(CREATE_CHANGE_COUNTERS_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stratosphere', '0018_changecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='changecounter',
+            name='compute_reset_version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='changecounter',
+            name='providers_reset_version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ChangedObject',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('section', models.CharField(max_length=16)),
+                ('object_id', models.UUIDField()),
+                ('version', models.BigIntegerField()),
+                ('user', models.ForeignKey(related_name='changed_objects', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='changedobject',
+            unique_together=set([('user', 'section', 'object_id')]),
+        ),
+    ]
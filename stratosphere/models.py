@@ -1,4 +1,7 @@
+from django.contrib.sites.models import Site
 from django.db import models
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
 
 from simple_history.models import HistoricalRecords
 
@@ -6,6 +9,7 @@ from .tasks import load_provider_data, load_public_provider_data
 
 from .submodels.event import *
 from .submodels.user import *
+from .submodels.change_counter import *
 from .submodels.authentication_method import *
 from .submodels.compute_instance import *
 from .submodels.provider import *
@@ -24,7 +28,9 @@ from .submodels.provider_configuration import *
 from .submodels.aws.aws_provider_configuration import *
 from .submodels.azure.azure_provider_configuration import *
 from .submodels.compute_group import *
+from .submodels.instance_states_rollup import *
 from .submodels.beta_key import *
+from .submodels.scheduled_task import *
 
 
 class ComputeGroup(ComputeGroupBase):
@@ -41,6 +47,11 @@ def compute_group_post_save(sender, created, instance, **kwargs):
     ComputeGroup.handle_post_save(sender, created, instance, **kwargs)
 
 
+@receiver(post_delete, sender=ComputeGroup)
+def compute_group_post_delete(sender, instance, **kwargs):
+    ComputeGroup.handle_post_delete(sender, instance, **kwargs)
+
+
 @receiver(pre_save, sender=ComputeInstance)
 def compute_instance_pre_save(sender, instance, raw, using, update_fields, **kwargs):
     ComputeInstance.handle_pre_save(sender, instance, raw, using, update_fields, **kwargs)
@@ -57,8 +68,32 @@ def schedule_load_provider_info(sender, created, instance, **kwargs):
             schedule_random_default_delay(load_public_provider_data, instance.pk)
         else:
             instance.init()
-            schedule_random_default_delay(load_provider_data, instance.pk)
+            ScheduledTask.schedule(load_provider_data, instance.pk)
+
+
+def bump_provider_change_counter(sender, created, instance, **kwargs):
+    # public configurations don't belong to anyone's dashboard
+    if instance.user_id is not None:
+        # groups only show what doesn't change about their configurations, so only a new one can show up in them
+        sections = [ChangeCounter.COMPUTE, ChangeCounter.PROVIDERS] if created else [ChangeCounter.PROVIDERS]
+        ChangeCounter.bump(sections, {ChangeCounter.PROVIDERS: [instance.pk]}, user=instance.user_id)
 
 
 for subclass in ProviderConfiguration.__subclasses__():
     post_save.connect(schedule_load_provider_info, subclass)
+    post_save.connect(bump_provider_change_counter, subclass)
+
+
+post_save.connect(ChangeCounter.handle_user_post_save, User)
+
+
+for sender in [Provider, Site]:
+    post_save.connect(clear_icon_url_cache, sender)
+    post_delete.connect(clear_icon_url_cache, sender)
+
+for sender in [Provider] + ProviderConfiguration.__subclasses__():
+    post_save.connect(clear_info_url_cache, sender)
+    post_delete.connect(clear_info_url_cache, sender)
+
+for signal in [post_save, post_delete]:
+    signal.connect(invalidate_best_provider_sizes_for_mapping, DiskImageMapping)
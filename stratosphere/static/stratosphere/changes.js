@@ -0,0 +1,87 @@
+// Polls /changes/ for what changed on the dashboard since the last poll, and passes each changed section to the
+// callbacks subscribed to it: the whole list of compute groups and providers, and nothing for the events feed and
+// state history, which fetch their own deltas. /changes/ only sends the groups and providers that changed, with the
+// ids of the removed ones, so they're merged into the lists from the previous polls. Polls send back the version they
+// last saw as an ETag, so that they get an empty 304 while nothing changes.
+var dashboardChanges = (function() {
+    var version = null;
+    var subscribers = {};
+    var polling = false;
+    var lists = {};
+
+    // without a list of removed ids, `objects` is the whole list
+    var merge = function(section, objects, removedIds) {
+        if (typeof removedIds === 'undefined' || !(section in lists))
+            return lists[section] = objects;
+
+        var changed = {};
+        objects.forEach(function(object) {
+            changed[object.id] = object;
+        });
+        var removed = {};
+        removedIds.forEach(function(id) {
+            removed[id] = true;
+        });
+
+        var merged = lists[section].filter(function(object) {
+            return !removed[object.id];
+        }).map(function(object) {
+            var newObject = changed[object.id] || object;
+            delete changed[object.id];
+            return newObject;
+        });
+        objects.forEach(function(object) {
+            if (object.id in changed)
+                merged.push(object);
+        });
+        return lists[section] = merged;
+    };
+
+    var poll = function() {
+        if (polling)
+            return;
+        polling = true;
+
+        var sentVersion = version;
+        $.ajax({
+            url: '/changes/',
+            data: version === null ? {} : {since: version},
+            headers: version === null ? {} : {'If-None-Match': '"' + version + '"'},
+            dataType: 'json',
+        }).done(function(data, textStatus, xhr) {
+            if (xhr.status == 304 || !data)
+                return;
+
+            // a subscription made while this poll was in flight resets the version, to get everything on the next one
+            if (version === sentVersion)
+                version = data.version;
+            data.changed.forEach(function(section) {
+                var sectionData = data[section];
+                if (typeof sectionData !== 'undefined')
+                    sectionData = merge(section, sectionData, data[section + '_removed']);
+
+                (subscribers[section] || []).forEach(function(callback) {
+                    callback(sectionData);
+                });
+            });
+        }).always(function() {
+            polling = false;
+        });
+    };
+
+    var started = false;
+
+    return {
+        // the first poll after subscribing reports every section as changed
+        subscribe: function(section, callback) {
+            (subscribers[section] = subscribers[section] || []).push(callback);
+
+            if (!started) {
+                started = true;
+                setInterval(poll, 3000);
+            }
+            version = null;
+            setTimeout(poll);
+        },
+    };
+})();
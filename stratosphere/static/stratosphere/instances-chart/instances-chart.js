@@ -97,7 +97,9 @@ var drawInstancesChart = function(data) {
 function getStateHistory(compute_group_id, cb) {
     var base_url = '/compute/state_history/';
     var url = compute_group_id != null ? base_url + compute_group_id + '/' : base_url;
-    $.get(url, {limit: instances_chart_range_limit}).done(cb);
+    // about one bucket per pixel; the server downsamples the history to fit
+    var points = $('#instances-chart').width() || 500;
+    $.get(url, {limit: instances_chart_range_limit, points: points}).done(cb);
 }
 
 function setUpSlider() {
@@ -136,6 +138,10 @@ function setUpInstancesChart(compute_group_id) {
 
     setUpSlider();
 
+    // the history is only fetched again when there's a new snapshot or the range changes, but it's redrawn on every
+    // tick so that the chart keeps extending to the current time
+    var last_data = null;
+
     $('#instances-chart-max-range-buttons button').click(function() {
         var oldSelectedButton = selectedInstancesChartRangeButton();
         oldSelectedButton.removeClass('btn-info').addClass('btn-default');
@@ -145,19 +151,22 @@ function setUpInstancesChart(compute_group_id) {
         instances_chart_range_limit = $(this).attr('seconds') || null;
 
         getStateHistory(compute_group_id, function (data) {
+            last_data = data;
             changed_instances_chart_range_limit = true;
             drawInstancesChart(data);
         });
     });
 
-    getStateHistory(compute_group_id, function (data) {
-        drawInstancesChart(data);
-    });
-
-    setInterval(function() {
+    dashboardChanges.subscribe('state_history', function() {
         getStateHistory(compute_group_id, function (data) {
+            last_data = data;
             if (!instances_chart_range_slider_moving)
                 drawInstancesChart(data);
         });
+    });
+
+    setInterval(function() {
+        if (last_data !== null && !instances_chart_range_slider_moving)
+            drawInstancesChart(last_data);
     }, 3000);
 }
\ No newline at end of file
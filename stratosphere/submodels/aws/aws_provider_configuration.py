@@ -3,9 +3,13 @@ from django.dispatch import receiver
 
 from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider as LibcloudProvider
+from libcloud.utils.py3 import httplib
 
 from stratosphere.models import Provider, ProviderConfiguration, ProviderCredentialSet
 
+from xml.etree import ElementTree
+
+import gzip
 import uuid
 
 
@@ -222,7 +226,47 @@ class AWSProviderConfiguration(ProviderConfiguration):
         if not include_public:
             filters['is-public'] = False
 
-        return self.driver.list_images(ex_filters=filters)
+        params = {'Action': 'DescribeImages'}
+        params.update(self.driver._build_filters(filters))
+
+        # DescribeImages isn't paginated, and the public image list is tens of megabytes of XML, so rather than let
+        # libcloud parse the whole response into a tree, we parse the raw response incrementally. The request is
+        # made here, rather than in the generator, so that credential errors are raised to the caller immediately.
+        connection = self.driver.connection
+        response = connection.request(self.driver.path, params=params, raw=True).response
+        if response.status != httplib.OK:
+            # let libcloud's response class raise the usual exception, e.g. InvalidCredsError
+            connection.responseCls(response=response, connection=connection)
+
+        if response.getheader('content-encoding') == 'gzip':
+            response = gzip.GzipFile(fileobj=response)
+
+        return self._iterparse_driver_images(response)
+
+    def _iterparse_driver_images(self, stream):
+        depth = 0
+        images_set, images_set_depth = None, None
+
+        for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+            tag = element.tag.rpartition('}')[2]
+
+            if event == 'start':
+                depth += 1
+                if images_set is None and tag == 'imagesSet':
+                    images_set, images_set_depth = element, depth
+                continue
+
+            # items nested inside an image, like blockDeviceMapping entries, are parsed by _to_image()
+            if images_set is not None and tag == 'item' and depth == images_set_depth + 1:
+                yield self.driver._to_image(element)
+
+                # drop every image parsed so far, including this one, so the tree never grows past one image
+                images_set.clear()
+
+            elif element is images_set:
+                images_set = None
+
+            depth -= 1
 
     def admin_url(self, compute_instance=None):
         base_url = "https://console.aws.amazon.com/ec2/home?region=%s" % self.region
@@ -0,0 +1,124 @@
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import F
+
+
+class ChangeCounter(models.Model):
+    """
+    A monotonic counter of changes to what a user's dashboard shows, so that its polls can ask what changed since the
+    version they last saw instead of reloading everything. Each bump increments `version`, and sets the versions of
+    the sections it changed to the new version, so a section changed since version N iff its version is above N.
+    Within the compute and providers sections, ChangedObject rows record which groups and configurations changed.
+    """
+    class Meta:
+        app_label = "stratosphere"
+
+    COMPUTE = 'compute'
+    PROVIDERS = 'providers'
+    EVENTS = 'events'
+    STATE_HISTORY = 'state_history'
+    SECTIONS = (COMPUTE, PROVIDERS, EVENTS, STATE_HISTORY)
+
+    # the sections whose changed objects are tracked individually
+    OBJECT_SECTIONS = (COMPUTE, PROVIDERS)
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True, related_name='change_counter')
+    version = models.BigIntegerField(default=0)
+
+    compute_version = models.BigIntegerField(default=0)
+    providers_version = models.BigIntegerField(default=0)
+    events_version = models.BigIntegerField(default=0)
+    state_history_version = models.BigIntegerField(default=0)
+
+    # the last versions at which the whole section changed, rather than a known set of its objects
+    compute_reset_version = models.BigIntegerField(default=0)
+    providers_reset_version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def get_for_user(cls, user):
+        return cls.objects.get_or_create(user=user)[0]
+
+    def changed_sections(self, since):
+        return [section for section in self.SECTIONS if getattr(self, '%s_version' % section) > since]
+
+    def changed_object_ids(self, section, since):
+        """
+        Returns the ids of the objects in `section` (one of OBJECT_SECTIONS) that changed since version `since`, or
+        None if the whole section might have.
+        """
+        if getattr(self, '%s_reset_version' % section) > since:
+            return None
+
+        return set(ChangedObject.objects.filter(user=self.user_id, section=section, version__gt=since)
+                                        .values_list('object_id', flat=True))
+
+    @classmethod
+    def bump(cls, sections, object_ids=None, **filters):
+        """
+        Bumps the counters of the users matching `filters`, e.g. user=user_id or user__compute_groups=group_id,
+        marking `sections` changed. `object_ids` maps COMPUTE and PROVIDERS to the ids of the compute groups and
+        provider configurations that changed, so that polls only fetch those; a section in OBJECT_SECTIONS without
+        ids changes as a whole. The counters are bumped once the current transaction commits, so that they're only
+        locked for an instant, rather than serializing every transaction that changes the same user's objects, and so
+        that a poll that sees the new version is sure to see the changes too.
+        """
+        object_ids = {section: set(ids) for section, ids in (object_ids or {}).items() if section in sections}
+
+        updates = {'version': F('version') + 1}
+        for section in sections:
+            updates['%s_version' % section] = F('version') + 1
+            if section in cls.OBJECT_SECTIONS and section not in object_ids:
+                updates['%s_reset_version' % section] = F('version') + 1
+
+        using = router.db_for_write(cls)
+        counters = cls.objects.filter(**filters)
+
+        def bump_counters():
+            if not any(object_ids.values()):
+                counters.update(**updates)
+                return
+
+            # the update holds the counters' row locks until the objects' versions are recorded too, so that one
+            # user's bumps record them in order
+            with transaction.atomic(using=using):
+                counters.update(**updates)
+                for user_id, version in set(counters.values_list('user_id', 'version')):
+                    for section, ids in object_ids.items():
+                        ChangedObject.record(user_id, section, ids, version)
+
+        connections[using].on_commit(bump_counters)
+
+    @classmethod
+    def handle_user_post_save(cls, sender, created, instance, **kwargs):
+        if created:
+            cls.objects.create(user=instance)
+
+
+class ChangedObject(models.Model):
+    """
+    The last version of a user's change counter at which one of their compute groups or provider configurations
+    changed. Rows outlive their objects, so that polls can tell deleted objects from unchanged ones.
+    """
+    class Meta:
+        app_label = "stratosphere"
+        unique_together = ('user', 'section', 'object_id')
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='changed_objects')
+    section = models.CharField(max_length=16)
+    object_id = models.UUIDField()
+    version = models.BigIntegerField()
+
+    @classmethod
+    def record(cls, user_id, section, object_ids, version):
+        """
+        Sets the version of `object_ids` in `section` to `version`. Only called by ChangeCounter.bump() while it holds
+        the lock on the user's counter, so that no other transaction inserts the same rows concurrently.
+        """
+        if len(object_ids) == 0:
+            return
+
+        rows = cls.objects.filter(user=user_id, section=section, object_id__in=object_ids)
+        if rows.update(version=version) < len(object_ids):
+            missing_ids = object_ids - set(rows.values_list('object_id', flat=True))
+            cls.objects.bulk_create(cls(user_id=user_id, section=section, object_id=object_id, version=version)
+                                    for object_id in missing_ids)
@@ -1,30 +1,26 @@
 from annoying.fields import JSONField
 
-from datetime import datetime, timedelta
+from fractions import Fraction
 
-from django.apps import apps
 from django.conf import settings
-from django.db import connection, models, transaction, OperationalError
+from django.db import connection, models, transaction
 from django.db.models import Q
-from django.db.models.signals import pre_save
-from django.dispatch import receiver
-from django.utils import timezone
-
-from save_the_change.mixins import SaveTheChange, TrackChanges
 
 from .mixins import TrackSavedChanges
 
-from ..models import ComputeInstance, Event, ProviderConfiguration, ProviderSize
-from ..util import generate_name, HasLogger, retry, call_with_retry, thread_local
+from ..models import BestProviderSize, ChangeCounter, ComputeInstance, Event, ProviderSize
+from ..util import generate_names, HasLogger, isolated
 
-import json
-import traceback
 import uuid
 
 
+STATE_COUNT_FIELDS = ('running', 'pending', 'failed')
+
+
 class InstanceStatesSnapshot(models.Model):
     class Meta:
         app_label = "stratosphere"
+        index_together = [('user', 'time')]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='instance_states_snapshots')
@@ -34,10 +30,83 @@ class InstanceStatesSnapshot(models.Model):
     running = models.IntegerField()
     failed  = models.IntegerField()
 
+    @classmethod
+    def _query_history(cls, user_id, group_id, select_clause, where_clause='', params=(), rest=''):
+        """
+        Runs a query over the user's snapshots, as `u`, or over one of their group's snapshots joined to them, which
+        is where group snapshots' times live. {counts} in `select_clause` is replaced with the alias of the table to
+        read counts from. Either way, time ranges are scanned through the (user, time) index.
+        """
+        if group_id is None:
+            from_clause = 'FROM %s AS u' % cls._meta.db_table
+            from_params = []
+            counts_alias = 'u'
+        else:
+            from_clause = 'FROM %s AS u JOIN %s AS c ON c.user_snapshot_id = u.id AND c.group_id = %%s' % \
+                          (cls._meta.db_table, GroupInstanceStatesSnapshot._meta.db_table)
+            from_params = [group_id]
+            counts_alias = 'c'
+
+        sql = 'SELECT %s %s WHERE u.user_id = %%s%s %s' % (select_clause.format(counts=counts_alias), from_clause,
+                                                           where_clause, rest)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, from_params + [user_id] + list(params))
+            return cursor.fetchall()
+
+    @classmethod
+    def downsampled_history(cls, user_id, start, bucket_seconds, group_id=None, end=None):
+        """
+        Returns the snapshots of the user, or of one of their groups, taken since `start` (and before `end`, if it's
+        given), aggregated into buckets of `bucket_seconds` aligned to the epoch. Each bucket is a dict with the time
+        and counts of its last snapshot, and the 'min' and 'max' of each count across it, so that short spikes survive
+        downsampling.
+        """
+        select_clause = ', '.join(['max(u.time)'] +
+                                  ['(array_agg({counts}.%s ORDER BY u.time DESC))[1]' % field for field in STATE_COUNT_FIELDS] +
+                                  ['min({counts}.%s)' % field for field in STATE_COUNT_FIELDS] +
+                                  ['max({counts}.%s)' % field for field in STATE_COUNT_FIELDS])
+        where_clause, params = (' AND u.time >= %s', [start]) if end is None else \
+                               (' AND u.time >= %s AND u.time < %s', [start, end])
+        rows = cls._query_history(user_id, group_id, select_clause, where_clause, params,
+                                  'GROUP BY floor(extract(epoch FROM u.time) / %d) ORDER BY 1' % bucket_seconds)
+
+        field_count = len(STATE_COUNT_FIELDS)
+        history = []
+        for row in rows:
+            bucket = {'time': row[0]}
+            bucket.update(zip(STATE_COUNT_FIELDS, row[1:1 + field_count]))
+            bucket['min'] = dict(zip(STATE_COUNT_FIELDS, row[1 + field_count:1 + 2 * field_count]))
+            bucket['max'] = dict(zip(STATE_COUNT_FIELDS, row[1 + 2 * field_count:]))
+            history.append(bucket)
+
+        return history
+
+    @classmethod
+    def last_before(cls, user_id, before=None, group_id=None):
+        """
+        Returns the time and counts of the user's or group's last snapshot before `before`, or of their last snapshot
+        at all if it's None, as a dict like the buckets downsampled_history() returns; or None if there isn't one.
+        """
+        select_clause = ', '.join(['u.time'] + ['{counts}.%s' % field for field in STATE_COUNT_FIELDS])
+        where_clause, params = ('', []) if before is None else (' AND u.time < %s', [before])
+        rows = cls._query_history(user_id, group_id, select_clause, where_clause, params, 'ORDER BY u.time DESC LIMIT 1')
+
+        if len(rows) == 0:
+            return None
+
+        counts = dict(zip(STATE_COUNT_FIELDS, rows[0][1:]))
+        return dict(counts, time=rows[0][0], min=counts, max=counts)
+
+    @classmethod
+    def first_time(cls, user_id, group_id=None):
+        rows = cls._query_history(user_id, group_id, 'u.time', rest='ORDER BY u.time LIMIT 1')
+        return rows[0][0] if len(rows) > 0 else None
+
 
 class GroupInstanceStatesSnapshot(models.Model):
     class Meta:
         app_label = "stratosphere"
+        index_together = [('user_snapshot', 'group')]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user_snapshot = models.ForeignKey('InstanceStatesSnapshot', related_name='group_snapshots')
@@ -49,13 +118,14 @@ class GroupInstanceStatesSnapshot(models.Model):
 
 
 class GroupEvent(object):
-    @property
-    def object_name(self):
+    prefetched_fields = ('compute_group',)
+
+    def _get_display_name(self):
         return self.compute_group.name
 
     @property
     def object_url(self):
-        return '/compute_groups/' + str(self.compute_group.pk)
+        return '/compute_groups/' + str(self.compute_group_id)
 
 
 class GroupCreatedEvent(Event, GroupEvent):
@@ -64,7 +134,7 @@ class GroupCreatedEvent(Event, GroupEvent):
 
     @property
     def rich_description(self):
-        return "Compute group <b>%s</b> was created." % self.compute_group.name
+        return "Compute group <b>%s</b> was created." % self.object_name
 
 
 class GroupTerminatedEvent(Event, GroupEvent):
@@ -73,7 +143,7 @@ class GroupTerminatedEvent(Event, GroupEvent):
 
     @property
     def rich_description(self):
-        return "Compute group <b>%s</b> was terminated." % self.compute_group.name
+        return "Compute group <b>%s</b> was terminated." % self.object_name
 
 
 class RebalanceEvent(Event, GroupEvent):
@@ -83,20 +153,52 @@ class RebalanceEvent(Event, GroupEvent):
     old_size_distribution = JSONField()
     new_size_distribution = JSONField()
 
+    # the provider pretty name and external ID of each size in the distributions, keyed by size ID like them, as of
+    # when the event was created
+    size_labels = JSONField(null=True, blank=True)
+
+    def capture_display_fields(self):
+        super().capture_display_fields()
+        if self.size_labels is None:
+            self.size_labels = self._get_size_labels()
+
+    @classmethod
+    def prefetch_extra(cls, events):
+        events = [event for event in events if event.size_labels is None]
+        if len(events) == 0:
+            return
+
+        size_ids = set()
+        for event in events:
+            size_ids |= event._size_ids()
+
+        sizes = ProviderSize.objects.select_related('provider_configuration__provider').in_bulk(size_ids)
+        sizes_by_id = {str(size_id): size for size_id, size in sizes.items()}
+        for event in events:
+            event._sizes_by_id = sizes_by_id
+
+    def _size_ids(self):
+        return set(self.old_size_distribution.keys()) | set(self.new_size_distribution.keys())
+
+    def _get_size_labels(self):
+        if not hasattr(self, '_sizes_by_id'):
+            self.prefetch_extra([self])
+
+        size_ids = self._size_ids()
+        return {size_id: [size.provider_configuration.provider.pretty_name, size.external_id]
+                for size_id, size in self._sizes_by_id.items() if size_id in size_ids}
+
     def _size_distribution_table(self):
-        size_ids = set(self.old_size_distribution.keys()) | set(self.new_size_distribution.keys())
+        size_labels = self.size_labels if self.size_labels is not None else self._get_size_labels()
 
         counts = []
-        for size_id in size_ids:
-            size = ProviderSize.objects.filter(pk=size_id).first()
-            if size is None:
-                name = '<missing>'
-            else:
-                name = size.provider_configuration.provider.pretty_name
+        for size_id in self._size_ids():
+            # sizes can be deleted after the event, when a provider stops offering them
+            name, external_id = size_labels.get(size_id, ('&lt;missing&gt;', '&lt;missing&gt;'))
 
             old_count = self.old_size_distribution.get(size_id, 0)
             new_count = self.new_size_distribution.get(size_id, 0)
-            counts.append('<tr><td>%s</td><td>%s</td><td>%d</td><td>%d</td></tr>' % (name, size.external_id, old_count, new_count))
+            counts.append('<tr><td>%s</td><td>%s</td><td>%d</td><td>%d</td></tr>' % (name, external_id, old_count, new_count))
 
         table = '<table class="table rebalance-event-distribution-table">'
         table += '<thead><tr><th>Provider</th><th>Size</th><th>Old instance count</th><th>New instance count</th>'
@@ -107,7 +209,7 @@ class RebalanceEvent(Event, GroupEvent):
 
     @property
     def rich_description(self):
-        return "<b>%s</b>'s instances were rebalanced.%s" % (self.compute_group.name, self._size_distribution_table())
+        return "<b>%s</b>'s instances were rebalanced.%s" % (self.object_name, self._size_distribution_table())
 
 
 class HailMaryEvent(RebalanceEvent):
@@ -116,7 +218,7 @@ class HailMaryEvent(RebalanceEvent):
 
     @property
     def rich_description(self):
-        return "<b>%s</b> entered <strong style='color: red;'>Hail Mary</strong> mode. Its instances were rebalanced:%s" % (self.compute_group.name, self._size_distribution_table())
+        return "<b>%s</b> entered <strong style='color: red;'>Hail Mary</strong> mode. Its instances were rebalanced:%s" % (self.object_name, self._size_distribution_table())
 
 
 class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
@@ -152,151 +254,168 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
     size_distribution = JSONField()
     state = models.CharField(max_length=16, choices=STATE_CHOICES, default=PENDING)
 
+    # Set whenever something the rebalancer depends on changes: the group's own settings, the states of its
+    # instances, or its providers' availability and sizes. check_instance_distribution_all only rebalances groups
+    # with this set, and clears it as it schedules them.
+    needs_rebalance = models.BooleanField(default=True, db_index=True)
+
+    REBALANCE_INPUT_FIELDS = {'instance_count', 'cpu', 'memory', 'image', 'image_id', 'provider_policy', 'state'}
+
+    def save(self, *args, **kwargs):
+        if self.REBALANCE_INPUT_FIELDS & set(self.changed_fields):
+            self.needs_rebalance = True
+        super(ComputeGroupBase, self).save(*args, **kwargs)
+
     # workaround for https://github.com/chrisglass/django_polymorphic/issues/160
     def delete(self):
         self.events.non_polymorphic().filter(compute_group=self).all().delete()
         super(ComputeGroupBase, self).delete()
 
-    def provider_states(self):
-        provider_states_map = {}
-        now = timezone.now()
-        two_minutes_ago = now - timedelta(minutes=2)
+    def provider_states(self, provider_configurations=None, state_counts=None):
+        """
+        `provider_configurations` (keyed by provider name) and `state_counts` (keyed by provider configuration ID, as
+        returned by ComputeInstance.state_count_aggregates()) can be passed in when they've already been loaded for
+        many groups at once; otherwise, they're queried for this group.
+        """
+        if provider_configurations is None:
+            provider_configurations = {pc.provider_name: pc for pc in
+                                       self.user.provider_configurations.filter(provider_name__in=self.provider_policy.keys())}
 
+        if state_counts is None:
+            state_counts = {counts['provider_configuration']: counts for counts in
+                            self.instances.values('provider_configuration').annotate(**ComputeInstance.state_count_aggregates())}
+
+        provider_states_map = {}
         for provider_name in self.provider_policy:
-            provider_configuration = ProviderConfiguration.objects.get(provider_name=provider_name, user=self.user)
-            provider_instances = self.instances.filter(provider_image__provider__name=provider_name)
-            icon_url = provider_configuration.provider.icon_url()
+            provider_configuration = provider_configurations.get(provider_name)
+            if provider_configuration is None:
+                self.logger.warning('No provider configuration for provider %s in group %s' % (provider_name, self.pk))
+                continue
 
             # TODO split GroupInstanceStatesSnapshot into provider snapshots and use those
-            running_count = len(list(filter(lambda i: i.is_running(), provider_instances)))
-            pending_count = len(list(filter(lambda i: i.is_pending(), provider_instances)))
-            failed_count = len(list(filter(lambda i: i.is_failed() and i.state != ComputeInstance.TERMINATED, provider_instances)))
+            counts = state_counts.get(provider_configuration.pk, {})
 
             provider_states_map[provider_name] = {
                 'id': provider_configuration.pk,
-                'running': running_count,
-                'pending': pending_count,
-                'failed': failed_count,
+                'running': counts.get('running', 0),
+                'pending': counts.get('pending', 0),
+                'failed': counts.get('failed', 0),
                 'pretty_name': provider_configuration.provider.pretty_name,
-                'icon_url': icon_url,
+                'icon_url': provider_configuration.provider.icon_url(),
             }
 
         return provider_states_map
 
-    @thread_local(DB_OVERRIDE='serializable')
+    @isolated()
     def check_instance_distribution(self):
-        with transaction.atomic():
-            running_count = self.instances.filter(ComputeInstance.running_instances_query()).count()
+        running_count = self.instances.filter(ComputeInstance.running_instances_query()).count()
 
-            provider_configurations = self.user.provider_configurations
-            good_provider_ids = [provider.pk for provider in provider_configurations.filter(enabled=True)]
+        provider_configurations = self.user.provider_configurations
+        good_provider_ids = [provider.pk for provider in provider_configurations.filter(enabled=True)]
 
-            self.logger.warn('good providers: %s' % good_provider_ids)
+        self.logger.warn('good providers: %s' % good_provider_ids)
 
-            if self.state == self.DESTROYED:
-                available_count = self.instances.filter(~ComputeInstance.unavailable_instances_query()).count()
-                self.logger.info('Compute group state is DESTROYED. Remaining available instances: %d' % available_count)
+        if self.state == self.DESTROYED:
+            available_count = self.instances.filter(~ComputeInstance.unavailable_instances_query()).count()
+            self.logger.info('Compute group state is DESTROYED. Remaining available instances: %d' % available_count)
 
-            else:
-                self.logger.info('Group state is %s' % self.state)
-                if running_count >= self.instance_count and self.state == self.PENDING:
-                    self.state = self.RUNNING
-                    self.save()
+        else:
+            self.logger.info('Group state is %s' % self.state)
+            if running_count >= self.instance_count and self.state == self.PENDING:
+                self.state = self.RUNNING
+                self.save()
 
-            # rebalance even if running count matches, in order to correct imbalance if provider is added or re-enabled
-            self.logger.warn('Rebalancing instances')
-            self.rebalance_instances(good_provider_ids)
+        # rebalance even if running count matches, in order to correct imbalance if provider is added or re-enabled
+        self.logger.warn('Rebalancing instances')
+        self.rebalance_instances(good_provider_ids)
 
-    @thread_local(DB_OVERRIDE='serializable')
+    @isolated()
     def rebalance_instances(self, provider_ids=None):
-        with transaction.atomic():
-            best_sizes = self._get_best_sizes(provider_ids)
-
-            # if there aren't any providers left, deploy the required number of
-            # instances to every provider in hopes that one of them will work
-            if len(best_sizes) == 0 and self.instance_count > 0:
-                self.logger.warn('No sizes available for any provider; rebalancing across all providers as a Hail Mary')
-                best_sizes = self._get_best_sizes()
-                instance_counts_by_size_id = self._get_emergency_size_distribution(best_sizes)
-                hail_mary = True
+        best_sizes = self._get_best_sizes(provider_ids)
+
+        # if there aren't any providers left, deploy the required number of
+        # instances to every provider in hopes that one of them will work
+        if len(best_sizes) == 0 and self.instance_count > 0:
+            self.logger.warn('No sizes available for any provider; rebalancing across all providers as a Hail Mary')
+            best_sizes = self._get_best_sizes()
+            instance_counts_by_size_id = self._get_emergency_size_distribution(best_sizes)
+            hail_mary = True
+        else:
+            instance_counts_by_size_id = self._get_size_distribution(best_sizes)
+            hail_mary = False
+
+        if self.size_distribution != instance_counts_by_size_id:
+            self.logger.info('New size distribution: %s' % instance_counts_by_size_id)
+            if hail_mary:
+                HailMaryEvent.objects.create(user=self.user, compute_group=self, old_size_distribution=self.size_distribution,
+                                             new_size_distribution=instance_counts_by_size_id)
             else:
-                instance_counts_by_size_id = self._get_size_distribution(best_sizes)
-                hail_mary = False
-
-            if self.size_distribution != instance_counts_by_size_id:
-                self.logger.info('New size distribution: %s' % instance_counts_by_size_id)
-                if hail_mary:
-                    HailMaryEvent.objects.create(user=self.user, compute_group=self, old_size_distribution=self.size_distribution,
-                                                 new_size_distribution=instance_counts_by_size_id)
-                else:
-                    RebalanceEvent.objects.create(user=self.user, compute_group=self, old_size_distribution=self.size_distribution,
-                                                  new_size_distribution=instance_counts_by_size_id)
+                RebalanceEvent.objects.create(user=self.user, compute_group=self, old_size_distribution=self.size_distribution,
+                                              new_size_distribution=instance_counts_by_size_id)
 
-            self.size_distribution = instance_counts_by_size_id
-            self.save()
+        self.size_distribution = instance_counts_by_size_id
+        self.save()
 
-            self._create_compute_instances()
+        self._create_compute_instances()
 
-            self.user.take_instance_states_snapshot_if_changed()
+        self.user.take_instance_states_snapshot_if_changed()
 
-    @thread_local(DB_OVERRIDE='serializable')
+    @isolated()
     def destroy_instance(self, instance):
-        with transaction.atomic():
-            self.instance_count -= 1
-            self.save()
+        self.instance_count -= 1
+        self.save()
 
-            instance.destroy()
+        instance.destroy()
 
-    @retry(OperationalError)
-    @thread_local(DB_OVERRIDE='serializable')
+    @isolated()
     def destroy(self):
-        with transaction.atomic():
-            self.state = self.DESTROYED
-            self.instance_count = 0
-            self.save()
-
-    def create_phantom_instance_states_snapshot(self, now):
-        # TODO figure out how to make this more consistent without causing a bunch of transaction conflicts
-        instances = list(self.instances.all())
-        two_minutes_ago = now - timedelta(minutes=2)
-
-        args = {
-            'group': self,
-            'pending': len(list(filter(lambda i: i.is_pending(), instances))),
-            'running': len(list(filter(lambda i: i.is_running(), instances))),
-            'failed': len(list(filter(lambda i: i.is_failed() and i.state != ComputeInstance.TERMINATED, instances))),
-        }
-
-        return GroupInstanceStatesSnapshot(**args)
+        self.state = self.DESTROYED
+        self.instance_count = 0
+        self.save()
+
+    def estimated_cost(self, provider_sizes=None):
+        """
+        `provider_sizes` (keyed by stringified primary key, like size_distribution) can be passed in when the sizes
+        have already been loaded for many groups at once.
+        """
+        if provider_sizes is None:
+            provider_sizes = {self._get_provider_size_key(provider_size): provider_size for provider_size in
+                              ProviderSize.objects.filter(pk__in=self.size_distribution.keys())}
 
-    def estimated_cost(self):
         cost = 0
         for provider_size_id, count in self.size_distribution.items():
-            provider_size = ProviderSize.objects.get(pk=provider_size_id)
-            cost += provider_size.price * count
+            cost += provider_sizes[provider_size_id].price * count
 
         return cost
 
     def _get_best_sizes(self, allowed_provider_ids=None):
+        provider_configurations = {pc.provider_name: pc for pc in
+                                   self.user.provider_configurations.filter(provider_name__in=self.provider_policy.keys())}
+
+        # most ticks are answered entirely from the index, without touching images or sizes
+        best_provider_sizes = BestProviderSize.objects.filter(provider_configuration__in=provider_configurations.values(),
+                                                              compute_image_id=self.image_id,
+                                                              cpu=self.cpu, memory=self.memory) \
+                                                      .select_related('provider_size')
+        best_provider_sizes_by_pc_id = {bps.provider_configuration_id: bps for bps in best_provider_sizes}
+
         best_sizes = {}
         for provider_name in self.provider_policy:
-            self.logger.debug('Getting sizes for provider %s and image %s' % (provider_name, self.image))
-            provider_configuration = self.user.provider_configurations.get(provider_name=provider_name)
+            provider_configuration = provider_configurations.get(provider_name)
+            if provider_configuration is None:
+                self.logger.warning('No provider configuration for provider %s in group %s' % (provider_name, self.pk))
+                continue
 
             if allowed_provider_ids is None or provider_configuration.pk in allowed_provider_ids:
-                available_sizes = []
-
-                provider_image = provider_configuration.available_provider_images.filter(disk_image__disk_image_mappings__compute_image=self.image).first()
-                if provider_image is None:
-                    self.logger.debug('No provider image available')
+                best_provider_size = best_provider_sizes_by_pc_id.get(provider_configuration.pk)
+                if best_provider_size is None:
+                    best_size = self._find_best_size(provider_configuration)
+                    BestProviderSize.store(provider_configuration, self.image_id, self.cpu, self.memory, best_size)
                 else:
-                    provider_sizes = provider_configuration.get_available_sizes(provider_image=provider_image, cpu=self.cpu, memory=self.memory)
-                    self.logger.debug('Provider sizes for image %s, cpu %d, memory %d: %s' % (provider_image, self.cpu, self.memory, provider_sizes))
-                    available_sizes.extend(provider_sizes)
+                    best_size = best_provider_size.provider_size
 
-                available_sizes.sort(key=lambda s: s.price)
-                if len(available_sizes) > 0:
-                    best_size = available_sizes[0]
+                if best_size is not None:
+                    best_size.provider_configuration = provider_configuration
                     self.logger.debug('Best size: %s' % best_size)
                     best_sizes[provider_name] = best_size
                 else:
@@ -306,6 +425,21 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
 
         return best_sizes
 
+    def _find_best_size(self, provider_configuration):
+        self.logger.debug('Getting sizes for provider %s and image %s' % (provider_configuration.provider_name, self.image))
+        available_sizes = []
+
+        provider_image = provider_configuration.available_provider_images.filter(disk_image__disk_image_mappings__compute_image=self.image).first()
+        if provider_image is None:
+            self.logger.debug('No provider image available')
+        else:
+            provider_sizes = provider_configuration.get_available_sizes(provider_image=provider_image, cpu=self.cpu, memory=self.memory)
+            self.logger.debug('Provider sizes for image %s, cpu %d, memory %d: %s' % (provider_image, self.cpu, self.memory, provider_sizes))
+            available_sizes.extend(provider_sizes)
+
+        available_sizes.sort(key=lambda s: s.price)
+        return available_sizes[0] if len(available_sizes) > 0 else None
+
     @staticmethod
     def _sorted_sizes(sizes):
         # sort to ensure consistency across multiple runs, e.g. when a size has the
@@ -329,28 +463,52 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
         if created:
             GroupCreatedEvent.objects.create(user=instance.user, compute_group=instance)
 
+        ChangeCounter.bump([ChangeCounter.COMPUTE], {ChangeCounter.COMPUTE: [instance.pk]}, user=instance.user_id)
+
+    @classmethod
+    def handle_post_delete(cls, sender, instance, **kwargs):
+        ChangeCounter.bump([ChangeCounter.COMPUTE], {ChangeCounter.COMPUTE: [instance.pk]}, user=instance.user_id)
+
+    def _get_provider_policy_weight(self, provider_name):
+        # 'auto' providers get an equal share; a number gives the provider a share proportional to it
+        policy = self.provider_policy.get(provider_name, 'auto')
+        if policy == 'auto':
+            return Fraction(1)
+
+        try:
+            return max(Fraction(policy), Fraction(0))
+        except (TypeError, ValueError):
+            self.logger.warning('Invalid policy %r for provider %s in group %s; treating as auto' %
+                                (policy, provider_name, self.pk))
+            return Fraction(1)
+
     def _get_size_distribution(self, sizes):
-        instance_counts = {self._get_provider_size_key(provider_size): 0 for provider_size in sizes.values()}
+        """
+        Splits instance_count across `sizes` (keyed by provider name) in proportion to their provider policy weights,
+        using the largest remainder method: each size gets the floor of its exact share, and the instances left over
+        go to the sizes with the largest fractional shares, ties broken by _sorted_sizes() order.
+        """
+        sizes_list = self._sorted_sizes(sizes)
+        if len(sizes_list) == 0:
+            return {}
 
-        # if len(sizes) == 0, the following gets into an infinite loop
-        if len(sizes) > 0:
-            sizes_list = self._sorted_sizes(sizes)
+        provider_names = {provider_size.pk: provider_name for provider_name, provider_size in sizes.items()}
+        weights = [self._get_provider_policy_weight(provider_names[provider_size.pk]) for provider_size in sizes_list]
 
-            while sum(instance_counts.values()) < self.instance_count:
-                remaining_instance_count = self.instance_count - sum(instance_counts.values())
-                provider_instance_count = int(remaining_instance_count/len(sizes))
+        total_weight = sum(weights)
+        if total_weight == 0:
+            weights = [Fraction(1)] * len(sizes_list)
+            total_weight = len(sizes_list)
 
-                for provider_size in sizes_list:
-                    # correct for rounding down when dividing remaining instances by number of sizes
-                    if provider_instance_count == 0 and sum(instance_counts.values()) < self.instance_count:
-                        corrected_provider_instance_count = 1
-                    else:
-                        corrected_provider_instance_count = provider_instance_count
+        shares = [self.instance_count * weight / total_weight for weight in weights]
+        counts = [int(share) for share in shares]
 
-                    key = self._get_provider_size_key(provider_size)
-                    instance_counts[key] += corrected_provider_instance_count
+        remaining_instance_count = self.instance_count - sum(counts)
+        by_remainder = sorted(range(len(sizes_list)), key=lambda i: -(shares[i] - counts[i]))  # stable, so ties keep order
+        for i in by_remainder[:remaining_instance_count]:
+            counts[i] += 1
 
-        return instance_counts
+        return {self._get_provider_size_key(provider_size): count for provider_size, count in zip(sizes_list, counts)}
 
     def _get_emergency_size_distribution(self, sizes):
         sizes_list = self._sorted_sizes(sizes)
@@ -379,20 +537,32 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
         with transaction.atomic():
             self.logger.info('Size distribution: %s' % self.size_distribution)
 
+            # plan against one snapshot of the group's live instances, rather than querying per size
+            live_instances = list(self.instances.filter(ComputeInstance.pending_instances_query()
+                                                        | ComputeInstance.running_instances_query()))
+            pending_instances_by_size_id = {}
+            running_instances_by_size_id = {}
+            for instance in live_instances:
+                instances_by_size_id = pending_instances_by_size_id if instance.is_pending() else running_instances_by_size_id
+                instances_by_size_id.setdefault(str(instance.provider_size_id), []).append(instance)
+
+            provider_sizes = {str(ps.pk): ps for ps in
+                              ProviderSize.objects.filter(pk__in=self.size_distribution.keys()).select_related('provider_configuration')}
+
+            new_instances = []
             pending_destroy_instances = []
             running_destroy_instances = []
-            other_destroy_instances = []
 
             for provider_size_id, size_instance_count in self.size_distribution.items():
-                provider_size = ProviderSize.objects.get(pk=provider_size_id)
+                provider_size = provider_sizes[provider_size_id]
                 provider_configuration = provider_size.provider_configuration
 
                 self.logger.info('Balancing compute instances for size %s; expected count %d' %
                                  (provider_size, size_instance_count))
 
-                pending_instances = self.instances.filter(Q(provider_size=provider_size) & ComputeInstance.pending_instances_query())
-                running_instances = self.instances.filter(Q(provider_size=provider_size) & ComputeInstance.running_instances_query())
-                pending_or_running_count = pending_instances.count() + running_instances.count()
+                pending_instances = pending_instances_by_size_id.pop(provider_size_id, [])
+                running_instances = running_instances_by_size_id.pop(provider_size_id, [])
+                pending_or_running_count = len(pending_instances) + len(running_instances)
                 self.logger.info('pending_or_running_count: %d' % pending_or_running_count)
 
                 if pending_or_running_count < size_instance_count:
@@ -404,43 +574,38 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
                     # TODO could this also produce multiple images if we don't specify the provider size?
                     provider_image = provider_configuration.available_provider_images.get(
                                             disk_image__disk_image_mappings__compute_image=self.image,
-                                            disk_image__disk_image_mappings__provider=provider_configuration.provider)
+                                            disk_image__disk_image_mappings__provider=provider_configuration.provider_id)
 
                     for i in range(instances_to_create):
-                        instance_name = generate_name(self.instances)
-
-                        compute_instance_args = {
-                            'name': instance_name,
-                            'provider_image': provider_image,
-                            'group': self,
-                            'provider_size': provider_size,
-                            'extra': {},
-                            'provider_configuration': provider_configuration,
-                            'state': None,
-                            'public_ips': [],
-                            'private_ips': [],
-                        }
-
-                        compute_instance = ComputeInstance.objects.create(**compute_instance_args)
-                        self.logger.info('Created instance %s for provider_size %s' % (compute_instance.pk, provider_size))
+                        new_instances.append(ComputeInstance(provider_image=provider_image, group=self,
+                                                             provider_size=provider_size, extra={},
+                                                             provider_configuration=provider_configuration, state=None,
+                                                             public_ips=[], private_ips=[]))
 
                 else:
-                    extra_pending_instance_count = min(pending_instances.count(), pending_or_running_count - size_instance_count)
+                    extra_pending_instance_count = min(len(pending_instances), pending_or_running_count - size_instance_count)
                     if extra_pending_instance_count > 0:
-                        extra_pending_instances = list(pending_instances)[:extra_pending_instance_count]
+                        extra_pending_instances = pending_instances[:extra_pending_instance_count]
                         self.logger.info('Found %d extra pending instances for size %s' % (len(extra_pending_instances), provider_size))
                         pending_destroy_instances.extend(extra_pending_instances)
 
-                    extra_running_instance_count = running_instances.count() - size_instance_count
+                    extra_running_instance_count = len(running_instances) - size_instance_count
                     if extra_running_instance_count > 0:
-                        extra_running_instances = list(running_instances)[:extra_running_instance_count]
+                        extra_running_instances = running_instances[:extra_running_instance_count]
                         self.logger.info('Found %d extra running instances for size %s' % (len(extra_running_instances), provider_size))
                         running_destroy_instances.extend(extra_running_instances)
 
+            if len(new_instances) > 0:
+                for instance, name in zip(new_instances, generate_names(self.instances, len(new_instances))):
+                    instance.name = name
+
+                ComputeInstance.create_many(new_instances)
+                self.logger.info('Created %d instances' % len(new_instances))
+
+            # whatever's left over belongs to sizes that aren't in the size distribution
             # TODO make sure this squares with multi-row transaction isolation
-            missing_size_query = ~Q(provider_size__pk__in=self.size_distribution.keys())
-            missing_size_pending_instances = self.instances.filter(missing_size_query & ComputeInstance.pending_instances_query())
-            missing_size_running_instances = self.instances.filter(missing_size_query & ComputeInstance.running_instances_query())
+            missing_size_pending_instances = [i for instances in pending_instances_by_size_id.values() for i in instances]
+            missing_size_running_instances = [i for instances in running_instances_by_size_id.values() for i in instances]
             pending_destroy_instances.extend(missing_size_pending_instances)
             running_destroy_instances.extend(missing_size_running_instances)
 
@@ -448,7 +613,7 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
             self.logger.info('Found %d running instances for sizes not in size distribution' % len(missing_size_running_instances))
 
             if len(pending_destroy_instances) > 0 or len(running_destroy_instances) > 0:
-                total_running_count = self.instances.filter(ComputeInstance.running_instances_query()).count()
+                total_running_count = sum(1 for instance in live_instances if instance.is_running())
                 if total_running_count < self.instance_count:
                     # Two motivations here: we stop ourselves from getting unlucky by accidentally destroying an
                     # instance that's just having a bad minute, and we also stop ourselves from destroying instances
@@ -457,14 +622,13 @@ class ComputeGroupBase(TrackSavedChanges, models.Model, HasLogger):
                     # TODO is this still true?
                     self.logger.warn('Not destroying extraneous instances while running count is less than or equal to expected count')
                 else:
-                    for instance in pending_destroy_instances:
-                        self.logger.warn('Destroying pending instance %s for size %s' % (instance.pk, instance.provider_size))
-                        instance.destroy()
-
                     # stop ourselves from destroying running instances too early when rebalancing to a new provider
                     allowed_running_destroy_count = total_running_count - self.instance_count
                     self.logger.warn('Destroying a maximum of %d running instances' % allowed_running_destroy_count)
 
-                    for instance in running_destroy_instances[:allowed_running_destroy_count]:
-                        self.logger.warn('Destroying running instance %s for size %s' % (instance.pk, instance.provider_size))
-                        instance.destroy()
+                    destroy_instances = pending_destroy_instances + running_destroy_instances[:allowed_running_destroy_count]
+                    for instance in destroy_instances:
+                        self.logger.warn('Destroying %s instance %s for size %s' %
+                                         ('pending' if instance.is_pending() else 'running', instance.pk, instance.provider_size_id))
+
+                    ComputeInstance.destroy_many(destroy_instances)
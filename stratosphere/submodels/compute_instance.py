@@ -2,8 +2,8 @@ from annoying.fields import JSONField
 
 from datetime import timedelta
 
-from django.db import connection, models, transaction
-from django.db.models import Q
+from django.db import connection, models
+from django.db.models import Case, IntegerField, Q, Sum, Value, When
 from django.utils import timezone
 
 from libcloud.compute.base import Node
@@ -14,19 +14,22 @@ import uuid
 
 from .mixins import TrackSavedChanges
 
-from ..models import Event
+from ..models import ChangeCounter, Event
 from ..tasks import create_libcloud_node, destroy_libcloud_node
-from ..util import decode_node_extra, schedule_random_default_delay, thread_local
+from ..util import bulk_create_historical_records, bulk_update, decode_node_extra, isolated, \
+                    schedule_random_default_delay
 
 
 class InstanceEvent(object):
-    @property
-    def object_name(self):
+    prefetched_fields = ('compute_instance',)
+
+    def _get_display_name(self):
         return self.compute_instance.name
 
     @property
     def object_url(self):
-        return '/compute_groups/' + str(self.compute_instance.group.pk)
+        group_id = self.compute_group_id if self.compute_group_id is not None else self.compute_instance.group_id
+        return '/compute_groups/' + str(group_id)
 
 
 class InstanceStateChangeEvent(Event, InstanceEvent):
@@ -46,7 +49,7 @@ class InstanceStateChangeEvent(Event, InstanceEvent):
 
     @property
     def rich_description(self):
-        return "<b>%s</b>'s state changed from <strong>%s</strong> to <strong>%s</strong>." % (self.compute_instance.name, self.old_state, self.new_state)
+        return "<b>%s</b>'s state changed from <strong>%s</strong> to <strong>%s</strong>." % (self.object_name, self.old_state, self.new_state)
 
 
 class InstanceFailedEvent(Event, InstanceEvent):
@@ -55,7 +58,7 @@ class InstanceFailedEvent(Event, InstanceEvent):
 
     @property
     def rich_description(self):
-        return "Instance <b>%s</b> <strong style='color: red;'>FAILED</strong>." % self.compute_instance.name
+        return "Instance <b>%s</b> <strong style='color: red;'>FAILED</strong>." % self.object_name
 
 
 class ComputeInstanceBase(TrackSavedChanges, models.Model):
@@ -135,6 +138,21 @@ class ComputeInstanceBase(TrackSavedChanges, models.Model):
         not_unavailable = ~cls.unavailable_instances_query()
         return state_pending & not_unavailable
 
+    @classmethod
+    def state_count_aggregates(cls):
+        """
+        Aggregates that count pending, running and failed (but not terminated) instances in a single pass. Use with
+        values(...).annotate(**ComputeInstance.state_count_aggregates()) to get the counts per group of rows.
+        """
+        def count_matching(query):
+            return Sum(Case(When(query, then=Value(1)), default=Value(0), output_field=IntegerField()))
+
+        return {
+            'pending': count_matching(cls.pending_instances_query()),
+            'running': count_matching(cls.running_instances_query()),
+            'failed': count_matching(cls.failed_instances_query() & ~Q(state=ComputeInstanceBase.TERMINATED)),
+        }
+
     @classmethod
     def handle_pre_save(cls, sender, instance, raw, using, update_fields, **kwargs):
         old_instance = cls.objects.filter(pk=instance.id).first() if instance.id is not None else None
@@ -146,35 +164,82 @@ class ComputeInstanceBase(TrackSavedChanges, models.Model):
         if created:
             schedule_random_default_delay(create_libcloud_node, instance.pk)
 
-    # TODO fix this so it doesn't hit the database again
-    def _is_in_state(self, state_query):
-        instances = self.__class__.objects.filter(state_query & Q(pk=self.pk))
-        return instances.exists()
+        # instances show up in their groups, and in their providers' running counts and costs
+        ChangeCounter.bump([ChangeCounter.COMPUTE, ChangeCounter.PROVIDERS],
+                           {ChangeCounter.COMPUTE: [instance.group_id],
+                            ChangeCounter.PROVIDERS: [instance.provider_configuration_id]},
+                           user__compute_groups=instance.group_id)
+
+    # The following predicates evaluate the same rules as the *_instances_query() builders above, but against the
+    # fields that are already loaded, so that they don't hit the database again. Keep the two forms in sync; the
+    # tests in ComputeInstanceStatePredicateTest check that they agree.
+    def is_destroyed(self):
+        return self.destroyed
+
+    def is_failed(self):
+        return self.failed
+
+    def is_unavailable(self):
+        return self.is_destroyed() or self.is_failed()
+
+    def is_unignored_failed(self):
+        return self.is_failed() and not self.failure_ignored
 
     def is_running(self):
-        state_query = self.__class__.running_instances_query()
-        return self._is_in_state(state_query)
+        return self.state == ComputeInstanceBase.RUNNING and not self.is_unavailable()
 
     def is_pending(self):
-        state_query = self.__class__.pending_instances_query()
-        return self._is_in_state(state_query)
+        return self.state in (None, ComputeInstanceBase.PENDING) and not self.is_unavailable()
 
-    def is_destroyed(self):
-        state_query = self.__class__.destroyed_instances_query()
-        return self._is_in_state(state_query)
+    @isolated()
+    def destroy(self):
+        self.destroyed = True
+        self.destroyed_at = timezone.now() # TODO make this consistent if a group of instances are destroyed?
+        self.save()
 
-    def is_failed(self):
-        state_query = self.__class__.failed_instances_query()
-        return self._is_in_state(state_query)
+        connection.on_commit(lambda: schedule_random_default_delay(destroy_libcloud_node, self.pk))
 
-    @thread_local(DB_OVERRIDE='serializable')
-    def destroy(self):
-        with transaction.atomic():
-            self.destroyed = True
-            self.destroyed_at = timezone.now() # TODO make this consistent if a group of instances are destroyed?
-            self.save()
+    @classmethod
+    def create_many(cls, instances):
+        """
+        Inserts `instances` and their history records in bulk, and schedules their nodes' creation once the
+        transaction commits, which handle_post_save() would otherwise do for each instance.
+        """
+        cls.objects.bulk_create(instances)
+        bulk_create_historical_records(instances, history_type='+')
+        cls._bump_change_counters(instances)
+
+        instance_ids = [instance.pk for instance in instances]
+        connection.on_commit(lambda: [schedule_random_default_delay(create_libcloud_node, instance_id)
+                                      for instance_id in instance_ids])
 
-            connection.on_commit(lambda: schedule_random_default_delay(destroy_libcloud_node, self.pk))
+    @classmethod
+    @isolated(lock_self=False)
+    def destroy_many(cls, instances):
+        """
+        Like calling destroy() on each of `instances`, but with one UPDATE and one history INSERT.
+        """
+        now = timezone.now()
+        for instance in instances:
+            instance.destroyed = True
+            instance.destroyed_at = now
+
+        bulk_update(instances, ['destroyed', 'destroyed_at'])
+        bulk_create_historical_records(instances)
+        cls._bump_change_counters(instances)
+
+        instance_ids = [instance.pk for instance in instances]
+        connection.on_commit(lambda: [schedule_random_default_delay(destroy_libcloud_node, instance_id)
+                                      for instance_id in instance_ids])
+
+    @staticmethod
+    def _bump_change_counters(instances):
+        group_ids = {instance.group_id for instance in instances}
+        if len(group_ids) > 0:
+            provider_configuration_ids = {instance.provider_configuration_id for instance in instances}
+            ChangeCounter.bump([ChangeCounter.COMPUTE, ChangeCounter.PROVIDERS],
+                               {ChangeCounter.COMPUTE: group_ids, ChangeCounter.PROVIDERS: provider_configuration_ids},
+                               user__compute_groups__in=list(group_ids))
 
     def admin_url(self):
         return self.provider_configuration.admin_url(self)
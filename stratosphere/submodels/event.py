@@ -5,12 +5,16 @@ from polymorphic import PolymorphicModel
 
 from save_the_change.mixins import SaveTheChange, TrackChanges
 
+from ..util import get_request_cached
+
 import uuid
 
 
 class Event(PolymorphicModel):
     class Meta:
         app_label = "stratosphere"
+        # backs the events feed, which pages through a user's events by (created_at, id)
+        index_together = [('user', 'created_at', 'id')]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -19,3 +23,93 @@ class Event(PolymorphicModel):
     provider_configuration = models.ForeignKey('ProviderConfiguration', related_name='events', null=True, blank=True)
     compute_group = models.ForeignKey('ComputeGroup', related_name='events', null=True, blank=True)
     compute_instance = models.ForeignKey('ComputeInstance', related_name='events', null=True, blank=True)
+
+    # the name of the event's object as of when the event was created; see capture_display_fields()
+    display_name = models.CharField(max_length=256, null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        from ..models import ChangeCounter
+
+        if self._state.adding:
+            self.capture_display_fields()
+        super().save(*args, **kwargs)
+
+        ChangeCounter.bump([ChangeCounter.EVENTS], user=self.user_id)
+
+    def capture_display_fields(self):
+        """
+        Copies what the event displays from its related objects onto the event, so that rendering it later needs no
+        lookups, and still shows what it showed when it happened after the objects are renamed or deleted. save()
+        calls this for new events; events inserted in bulk need to have it called first. Event classes provide
+        _get_display_name(), which reads the name from the related objects.
+        """
+        if self.display_name is None:
+            self.display_name = self._get_display_name()
+
+    @property
+    def object_name(self):
+        return self.display_name if self.display_name is not None else self._get_display_name()
+
+    @property
+    def cached_provider_configuration(self):
+        """
+        The event's provider configuration, with its provider, memoized for the current request so that listing many
+        events for the same provider configuration doesn't fetch it once per event.
+        """
+        from ..models import ProviderConfiguration
+        return ProviderConfiguration.get_cached(self.provider_configuration_id)
+
+    @classmethod
+    def prefetch_related_objects(cls, events):
+        """
+        Loads the related objects that the events' object_name, object_url and rich_description use, with one query
+        per kind of object rather than one or more per event. Event classes list the relations they use in a
+        `prefetched_fields` attribute, and can load anything else they need in prefetch_extra(). Provider
+        configurations are put in the request cache that cached_provider_configuration reads, so they're only
+        prefetched within a request_cached function.
+        """
+        from ..models import ComputeGroup, ComputeInstance, Provider, ProviderConfiguration
+
+        events_by_class = {}
+        for event in events:
+            events_by_class.setdefault(event.__class__, []).append(event)
+
+        # events that captured their display names don't need their related objects
+        unnamed_events_by_class = {event_class: [event for event in class_events if event.display_name is None]
+                                   for event_class, class_events in events_by_class.items()}
+
+        ids_by_field = {}
+        for event_class, class_events in unnamed_events_by_class.items():
+            for field_name in getattr(event_class, 'prefetched_fields', ()):
+                ids_by_field.setdefault(field_name, set()).update(getattr(event, field_name + '_id') for event in class_events)
+
+        provider_configuration_ids = ids_by_field.pop('provider_configuration', set()) - {None}
+        if len(provider_configuration_ids) > 0:
+            provider_configurations = list(ProviderConfiguration.objects.filter(pk__in=provider_configuration_ids))
+            providers_by_id = Provider.objects.in_bulk({pc.provider_id for pc in provider_configurations})
+
+            for provider_configuration in provider_configurations:
+                provider = providers_by_id[provider_configuration.provider_id]
+                provider_configuration.provider = get_request_cached((Provider, provider.pk), lambda: provider)
+                get_request_cached((ProviderConfiguration, provider_configuration.pk), lambda: provider_configuration)
+
+        querysets = {
+            'compute_group': ComputeGroup.objects.all(),
+            'compute_instance': ComputeInstance.objects.select_related('group'),
+        }
+        objects_by_field = {field_name: querysets[field_name].in_bulk(ids - {None})
+                            for field_name, ids in ids_by_field.items()}
+
+        for event_class, class_events in events_by_class.items():
+            for field_name in getattr(event_class, 'prefetched_fields', ()):
+                if field_name in objects_by_field:
+                    for event in unnamed_events_by_class[event_class]:
+                        related_object = objects_by_field[field_name].get(getattr(event, field_name + '_id'))
+                        if related_object is not None:
+                            setattr(event, field_name, related_object)
+
+            event_class.prefetch_extra(class_events)
+
+    @classmethod
+    def prefetch_extra(cls, events):
+        pass
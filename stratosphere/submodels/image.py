@@ -56,6 +56,10 @@ class ProviderImage(models.Model, SaveTheChange, TrackChanges):
     external_id = models.CharField(max_length=256, db_index=True)
     name = models.CharField(max_length=256, null=True, blank=True, db_index=True)
     extra = JSONField()
+    # fingerprint of `extra`, so that image syncs can tell which images changed without comparing their contents
+    extra_hash = models.CharField(max_length=40, null=True, blank=True)
+    # public catalog version in which this image was last created or changed; null for private images
+    catalog_version = models.PositiveIntegerField(null=True, blank=True)
 
     provider = models.ForeignKey('Provider', related_name='provider_images')
     provider_configurations = models.ManyToManyField('ProviderConfiguration', related_name='provider_images')
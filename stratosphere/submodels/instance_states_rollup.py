@@ -0,0 +1,343 @@
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from datetime import datetime, timedelta
+
+import math
+import uuid
+
+from ..models import GroupInstanceStatesSnapshot, InstanceStatesSnapshot, STATE_COUNT_FIELDS
+
+
+_epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# how long after a bucket ends its raw snapshots are rolled up, so that snapshots still being written make it in
+ROLLUP_LAG = timedelta(minutes=1)
+
+
+def _floor_time(time, resolution):
+    resolution_seconds = int(resolution.total_seconds())
+    return _epoch + timedelta(seconds=int((time - _epoch).total_seconds()) // resolution_seconds * resolution_seconds)
+
+
+class InstanceStatesRollup(models.Model):
+    """
+    Instance state counts of a user (when group is None) or one of their groups, rolled up from the snapshots taken
+    in one bucket of `resolution`, which starts at `time`. Like state_history()'s buckets, a rollup has the counts of
+    the bucket's last snapshot, taken at `last_time`, and the minimum and maximum of each count across the bucket.
+
+    Each resolution is rolled up from the next finer one, starting with the raw snapshots, and older rows are
+    deleted from each table once they're past their retention in INSTANCE_STATES_RETENTION and have been rolled up
+    into the next coarser one.
+    """
+    class Meta:
+        abstract = True
+        index_together = [('user', 'group', 'last_time')]
+
+    # the bucket size, the INSTANCE_STATES_RETENTION key, and the next finer table, which is rolled up into this one
+    resolution = None
+    retention_key = None
+    source = None
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    group = models.ForeignKey('ComputeGroup', null=True, blank=True, related_name='+')
+    time = models.DateTimeField(db_index=True)
+    last_time = models.DateTimeField()
+
+    pending = models.IntegerField()
+    running = models.IntegerField()
+    failed = models.IntegerField()
+
+    pending_min = models.IntegerField()
+    running_min = models.IntegerField()
+    failed_min = models.IntegerField()
+
+    pending_max = models.IntegerField()
+    running_max = models.IntegerField()
+    failed_max = models.IntegerField()
+
+    @classmethod
+    def retention(cls):
+        return settings.INSTANCE_STATES_RETENTION[cls.retention_key]
+
+    @classmethod
+    def rolled_up_until(cls):
+        """
+        Returns the end of the last bucket rolled up into this table, or None if nothing has been.
+        """
+        last_time = cls.objects.aggregate(models.Max('time'))['time__max']
+        return None if last_time is None else last_time + cls.resolution
+
+    @classmethod
+    def _source_rows(cls, start, end):
+        """
+        Returns (user ID, group ID, bucket number, last time, last counts..., minimum counts..., maximum counts...)
+        rows aggregating the next finer table's rows in [start, end) into this table's buckets.
+        """
+        resolution_seconds = int(cls.resolution.total_seconds())
+
+        if cls.source is InstanceStatesSnapshot:
+            user_table = InstanceStatesSnapshot._meta.db_table
+            group_table = GroupInstanceStatesSnapshot._meta.db_table
+            aggregates = ', '.join(['max(u.time)'] +
+                                   ['(array_agg({counts}.%s ORDER BY u.time DESC))[1]' % field for field in STATE_COUNT_FIELDS] +
+                                   ['min({counts}.%s)' % field for field in STATE_COUNT_FIELDS] +
+                                   ['max({counts}.%s)' % field for field in STATE_COUNT_FIELDS])
+            bucket = 'floor(extract(epoch FROM u.time) / %d)' % resolution_seconds
+
+            queries = [
+                ('SELECT u.user_id, NULL, %s, %s FROM %s AS u WHERE u.time >= %%s AND u.time < %%s '
+                 'GROUP BY u.user_id, 3' % (bucket, aggregates.format(counts='u'), user_table)),
+                ('SELECT u.user_id, c.group_id, %s, %s FROM %s AS u JOIN %s AS c ON c.user_snapshot_id = u.id '
+                 'WHERE u.time >= %%s AND u.time < %%s GROUP BY u.user_id, c.group_id, 3' %
+                 (bucket, aggregates.format(counts='c'), user_table, group_table)),
+            ]
+        else:
+            aggregates = ', '.join(['max(r.last_time)'] +
+                                   ['(array_agg(r.%s ORDER BY r.last_time DESC))[1]' % field for field in STATE_COUNT_FIELDS] +
+                                   ['min(r.%s_min)' % field for field in STATE_COUNT_FIELDS] +
+                                   ['max(r.%s_max)' % field for field in STATE_COUNT_FIELDS])
+            queries = [
+                ('SELECT r.user_id, r.group_id, floor(extract(epoch FROM r.time) / %d), %s FROM %s AS r '
+                 'WHERE r.time >= %%s AND r.time < %%s GROUP BY r.user_id, r.group_id, 3' %
+                 (resolution_seconds, aggregates, cls.source._meta.db_table)),
+            ]
+
+        rows = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                cursor.execute(query, [start, end])
+                rows += cursor.fetchall()
+        return rows
+
+    @classmethod
+    def roll_up(cls, now=None):
+        """
+        Rolls the next finer table's rows up into every complete bucket of this table that hasn't been yet, and
+        returns how many rollups were created.
+        """
+        if now is None:
+            now = timezone.now()
+
+        if cls.source is InstanceStatesSnapshot:
+            source_until = now - ROLLUP_LAG
+            source_first_time = InstanceStatesSnapshot.objects.aggregate(models.Min('time'))['time__min']
+        else:
+            source_until = cls.source.rolled_up_until()
+            source_first_time = cls.source.objects.aggregate(models.Min('time'))['time__min']
+
+        start = cls.rolled_up_until()
+        if start is None:
+            if source_first_time is None:
+                return 0
+            start = _floor_time(source_first_time, cls.resolution)
+
+        if source_until is None:
+            return 0
+        end = _floor_time(source_until, cls.resolution)
+        if end <= start:
+            return 0
+
+        field_count = len(STATE_COUNT_FIELDS)
+        rollups = []
+        for row in cls._source_rows(start, end):
+            user_id, group_id, bucket, last_time = row[:4]
+            counts = row[4:]
+            fields = dict(zip(STATE_COUNT_FIELDS, counts[:field_count]))
+            fields.update(('%s_min' % field, count) for field, count in zip(STATE_COUNT_FIELDS, counts[field_count:2 * field_count]))
+            fields.update(('%s_max' % field, count) for field, count in zip(STATE_COUNT_FIELDS, counts[2 * field_count:]))
+
+            time = _epoch + timedelta(seconds=int(bucket) * int(cls.resolution.total_seconds()))
+            rollups.append(cls(user_id=user_id, group_id=group_id, time=time, last_time=last_time, **fields))
+
+        cls.objects.bulk_create(rollups, batch_size=1000)
+        return len(rollups)
+
+    @classmethod
+    def downsampled_history(cls, user_id, start, bucket_seconds, group_id=None, end=None):
+        """
+        Like InstanceStatesSnapshot.downsampled_history(), for the rollups whose last snapshots were taken in
+        [start, end).
+        """
+        select_clause = ', '.join(['max(r.last_time)'] +
+                                  ['(array_agg(r.%s ORDER BY r.last_time DESC))[1]' % field for field in STATE_COUNT_FIELDS] +
+                                  ['min(r.%s_min)' % field for field in STATE_COUNT_FIELDS] +
+                                  ['max(r.%s_max)' % field for field in STATE_COUNT_FIELDS])
+        rows = cls._query_history(user_id, group_id, select_clause, ' AND r.last_time >= %s AND r.last_time < %s',
+                                  [start, end], 'GROUP BY floor(extract(epoch FROM r.last_time) / %d) ORDER BY 1' %
+                                  bucket_seconds)
+
+        field_count = len(STATE_COUNT_FIELDS)
+        history = []
+        for row in rows:
+            bucket = {'time': row[0]}
+            bucket.update(zip(STATE_COUNT_FIELDS, row[1:1 + field_count]))
+            bucket['min'] = dict(zip(STATE_COUNT_FIELDS, row[1 + field_count:1 + 2 * field_count]))
+            bucket['max'] = dict(zip(STATE_COUNT_FIELDS, row[1 + 2 * field_count:]))
+            history.append(bucket)
+
+        return history
+
+    @classmethod
+    def last_before(cls, user_id, before=None, group_id=None):
+        select_clause = ', '.join(['r.last_time'] + ['r.%s' % field for field in STATE_COUNT_FIELDS])
+        where_clause, params = ('', []) if before is None else (' AND r.last_time < %s', [before])
+        rows = cls._query_history(user_id, group_id, select_clause, where_clause, params,
+                                  'ORDER BY r.last_time DESC LIMIT 1')
+
+        if len(rows) == 0:
+            return None
+
+        counts = dict(zip(STATE_COUNT_FIELDS, rows[0][1:]))
+        return dict(counts, time=rows[0][0], min=counts, max=counts)
+
+    @classmethod
+    def first_time(cls, user_id, group_id=None):
+        rows = cls._query_history(user_id, group_id, 'r.last_time', rest='ORDER BY r.last_time LIMIT 1')
+        return rows[0][0] if len(rows) > 0 else None
+
+    @classmethod
+    def _query_history(cls, user_id, group_id, select_clause, where_clause='', params=(), rest=''):
+        group_clause, group_params = ('r.group_id IS NULL', []) if group_id is None else ('r.group_id = %s', [group_id])
+        sql = 'SELECT %s FROM %s AS r WHERE r.user_id = %%s AND %s%s %s' % (select_clause, cls._meta.db_table,
+                                                                           group_clause, where_clause, rest)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [user_id] + group_params + list(params))
+            return cursor.fetchall()
+
+
+class InstanceStatesMinuteRollup(InstanceStatesRollup):
+    class Meta(InstanceStatesRollup.Meta):
+        app_label = "stratosphere"
+
+    resolution = timedelta(minutes=1)
+    retention_key = 'minute'
+    source = InstanceStatesSnapshot
+
+
+class InstanceStatesHourRollup(InstanceStatesRollup):
+    class Meta(InstanceStatesRollup.Meta):
+        app_label = "stratosphere"
+
+    resolution = timedelta(hours=1)
+    retention_key = 'hour'
+    source = InstanceStatesMinuteRollup
+
+
+class InstanceStatesDayRollup(InstanceStatesRollup):
+    class Meta(InstanceStatesRollup.Meta):
+        app_label = "stratosphere"
+
+    resolution = timedelta(days=1)
+    retention_key = 'day'
+    source = InstanceStatesHourRollup
+
+
+INSTANCE_STATES_ROLLUPS = [InstanceStatesMinuteRollup, InstanceStatesHourRollup, InstanceStatesDayRollup]
+
+
+def roll_up_instance_states(now=None):
+    """
+    Rolls snapshots up into every resolution, finest first, then deletes the rows of each table, raw snapshots
+    included, that are past their retention and have been rolled up into the next coarser table.
+    """
+    if now is None:
+        now = timezone.now()
+
+    for rollup_model in INSTANCE_STATES_ROLLUPS:
+        with transaction.atomic():
+            rollup_model.roll_up(now)
+
+    tables = [(InstanceStatesSnapshot, settings.INSTANCE_STATES_RETENTION['raw'])] + \
+             [(rollup_model, rollup_model.retention()) for rollup_model in INSTANCE_STATES_ROLLUPS]
+
+    for (model, retention), coarser_model in zip(tables, INSTANCE_STATES_ROLLUPS + [None]):
+        if retention is None or coarser_model is None:
+            continue
+
+        rolled_up_until = coarser_model.rolled_up_until()
+        if rolled_up_until is None:
+            continue
+
+        delete_before = min(now - retention, rolled_up_until)
+        with transaction.atomic():
+            if model is InstanceStatesSnapshot:
+                # deleting through the ORM would load every row to cascade to the group snapshots
+                with connection.cursor() as cursor:
+                    cursor.execute('DELETE FROM %s WHERE user_snapshot_id IN (SELECT id FROM %s WHERE time < %%s)' %
+                                   (GroupInstanceStatesSnapshot._meta.db_table, InstanceStatesSnapshot._meta.db_table),
+                                   [delete_before])
+                    cursor.execute('DELETE FROM %s WHERE time < %%s' % InstanceStatesSnapshot._meta.db_table,
+                                   [delete_before])
+            else:
+                model.objects.filter(time__lt=delete_before).delete()
+
+
+def instance_states_history(user_id, start, bucket_seconds, group_id=None):
+    """
+    Returns the user's or group's instance state counts since `start`, downsampled into buckets of `bucket_seconds`
+    like InstanceStatesSnapshot.downsampled_history(), read from the coarsest table whose resolution fits in a
+    bucket and that still reaches back to `start`. Rollups lag behind the raw snapshots, so the history is read from
+    that table up to where it's rolled up to, then from each finer table in turn, ending with the raw snapshots.
+    """
+    now = timezone.now()
+    sources = [InstanceStatesSnapshot] + INSTANCE_STATES_ROLLUPS
+
+    def resolution_seconds(source):
+        return 0 if source is InstanceStatesSnapshot else source.resolution.total_seconds()
+
+    def retention(source):
+        return settings.INSTANCE_STATES_RETENTION['raw'] if source is InstanceStatesSnapshot else source.retention()
+
+    source_index = max(index for index, source in enumerate(sources) if resolution_seconds(source) <= bucket_seconds)
+    while source_index < len(sources) - 1 and retention(sources[source_index]) is not None \
+            and start < now - retention(sources[source_index]):
+        source_index += 1
+
+    parts = []
+    part_start = start
+    for source in reversed(sources[1:source_index + 1]):
+        part_end = source.rolled_up_until()
+        if part_end is None or part_end <= part_start:
+            continue
+        parts.append(source.downsampled_history(user_id, part_start, bucket_seconds, group_id, part_end))
+        part_start = part_end
+    parts.append(InstanceStatesSnapshot.downsampled_history(user_id, part_start, bucket_seconds, group_id))
+
+    # a bucket can straddle the boundary between two parts, in which case its halves are merged
+    history = []
+    for bucket in (bucket for part in parts for bucket in part):
+        if len(history) > 0 and _bucket_number(history[-1], bucket_seconds) == _bucket_number(bucket, bucket_seconds):
+            previous_bucket = history[-1]
+            bucket = dict(bucket,
+                          min={field: min(previous_bucket['min'][field], bucket['min'][field]) for field in STATE_COUNT_FIELDS},
+                          max={field: max(previous_bucket['max'][field], bucket['max'][field]) for field in STATE_COUNT_FIELDS})
+            history[-1] = bucket
+        else:
+            history.append(bucket)
+
+    return history
+
+
+def _bucket_number(bucket, bucket_seconds):
+    return math.floor((bucket['time'] - _epoch).total_seconds() / bucket_seconds)
+
+
+def instance_states_last_before(user_id, before=None, group_id=None):
+    """
+    Like InstanceStatesSnapshot.last_before(), falling back to the rollups, finest first, once the raw snapshots
+    before `before` have been deleted.
+    """
+    for source in [InstanceStatesSnapshot] + INSTANCE_STATES_ROLLUPS:
+        last_snapshot = source.last_before(user_id, before, group_id)
+        if last_snapshot is not None:
+            return last_snapshot
+    return None
+
+
+def instance_states_first_time(user_id, group_id=None):
+    first_times = [source.first_time(user_id, group_id) for source in [InstanceStatesSnapshot] + INSTANCE_STATES_ROLLUPS]
+    first_times = [first_time for first_time in first_times if first_time is not None]
+    return min(first_times) if len(first_times) > 0 else None
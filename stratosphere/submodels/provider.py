@@ -6,6 +6,17 @@ from save_the_change.mixins import SaveTheChange
 
 import uuid
 
+from ..util import bump_shared_cache, get_request_cached, get_shared_cached
+
+
+# Icon URLs depend only on the provider's icon path and the current site, so they're cached in the Django cache
+# for a few minutes. clear_icon_url_cache() is connected to Provider and Site changes in models.py.
+ICON_URL_CACHE = 'provider_icon_url'
+
+
+def clear_icon_url_cache(**kwargs):
+    bump_shared_cache(ICON_URL_CACHE)
+
 
 class Provider(models.Model, SaveTheChange):
     class Meta:
@@ -17,11 +28,21 @@ class Provider(models.Model, SaveTheChange):
     icon_path = models.TextField()
     supports_ssh_instance_auth = models.BooleanField()
     supports_password_instance_auth = models.BooleanField()
+    # bumped whenever a refresh of the shared public image catalog creates, changes or removes images
+    public_catalog_version = models.PositiveIntegerField(default=0)
+    public_catalog_loaded_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def get_cached(cls, pk):
+        return get_request_cached((Provider, pk), lambda: cls.objects.get(pk=pk))
 
     def icon_url(self):
-        icon_path = staticfiles_storage.url(self.icon_path)
-        current_site = Site.objects.get_current()
-        return '//' + current_site.domain + icon_path
+        def load_icon_url():
+            icon_path = staticfiles_storage.url(self.icon_path)
+            current_site = Site.objects.get_current()
+            return '//' + current_site.domain + icon_path
+
+        return get_shared_cached(ICON_URL_CACHE, (self.pk, self.icon_path), load_icon_url)
 
     def __repr__(self):
         return '<Provider %s: %s>' % (self.name, self.pk)
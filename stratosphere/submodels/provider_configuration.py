@@ -1,5 +1,5 @@
 from django.conf import settings
-from django.db import models
+from django.db import connections, models, router
 from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -15,7 +15,7 @@ from save_the_change.mixins import SaveTheChange, TrackChanges
 from stratosphere.lib.provider_configuration_data_loader import ProviderConfigurationDataLoader
 from stratosphere.lib.provider_configuration_status_checker import ProviderConfigurationStatusChecker
 
-from ..models import ComputeInstance, DiskImage, ProviderImage
+from ..models import ComputeInstance, DiskImage, Provider, ProviderImage
 from ..util import *
 
 import threading
@@ -79,6 +79,15 @@ class ProviderConfiguration(PolymorphicModel, ProviderConfigurationStatusChecker
 
         return getattr(_cloud_provider_drivers, driver_attr).driver
 
+    @classmethod
+    def get_cached(cls, pk):
+        def load():
+            provider_configuration = ProviderConfiguration.objects.get(pk=pk)
+            provider_configuration.provider = Provider.get_cached(provider_configuration.provider_id)
+            return provider_configuration
+
+        return get_request_cached((ProviderConfiguration, pk), load)
+
     @property
     def available_disk_images(self):
         return DiskImage.objects.filter(
@@ -93,6 +102,19 @@ class ProviderConfiguration(PolymorphicModel, ProviderConfigurationStatusChecker
                     | (Q(provider_configurations=None)
                        & Q(provider=self.provider)))
 
+    def mark_groups_for_rebalance(self, group_ids=None):
+        # groups of public configurations' users don't exist, and they have no instances anyway
+        if self.user is not None:
+            compute_groups = self.user.compute_groups.all()
+            if group_ids is not None:
+                compute_groups = compute_groups.filter(pk__in=group_ids)
+
+            # The flags are set once the current transaction commits, so that it never waits on group rows while
+            # holding locks on instance rows; a rebalance locks its group first and its instances second, so doing
+            # both in one transaction could deadlock with it.
+            using = router.db_for_write(compute_groups.model)
+            connections[using].on_commit(lambda: compute_groups.update(needs_rebalance=True))
+
     def estimated_cost(self):
         cost = 0
         if self.enabled:
@@ -100,16 +122,76 @@ class ProviderConfiguration(PolymorphicModel, ProviderConfigurationStatusChecker
                 cost += instance.provider_size.price
         return cost
 
+    # The *_concurrently() classmethods below call many configurations' provider APIs at once, on a thread pool of
+    # up to PROVIDER_IO_MAX_WORKERS threads, with at most PROVIDER_IO_MAX_WORKERS_PER_PROVIDER calls to each provider
+    # at a time, so that working across regions takes about as long as the slowest region. They return a list of
+    # (provider configuration or item, result, exception) tuples; see map_concurrently().
+
+    @staticmethod
+    def _map_concurrently(f, items, get_provider_configuration=lambda item: item):
+        return map_concurrently(f, items, key=lambda item: get_provider_configuration(item).provider_id,
+                                max_workers=settings.PROVIDER_IO_MAX_WORKERS,
+                                max_per_key=settings.PROVIDER_IO_MAX_WORKERS_PER_PROVIDER)
+
+    @classmethod
+    def list_nodes_concurrently(cls, provider_configurations):
+        return cls._map_concurrently(lambda provider_configuration: provider_configuration._list_nodes(),
+                                     provider_configurations)
+
+    @classmethod
+    def destroy_nodes_concurrently(cls, provider_configuration_nodes):
+        """
+        Destroys the nodes in `provider_configuration_nodes`, a list of (provider configuration, node) tuples.
+        """
+        def destroy_node(provider_configuration_node):
+            provider_configuration, node = provider_configuration_node
+            provider_configuration.logger.info('Destroying node %s' % node.id)
+            return provider_configuration.driver.destroy_node(node)
+
+        results = cls._map_concurrently(destroy_node, provider_configuration_nodes,
+                                        lambda provider_configuration_node: provider_configuration_node[0])
+        for (provider_configuration, node), _, e in results:
+            if e is not None:
+                provider_configuration.logger.error('Error destroying node %s: %s' % (node.id, e))
+
+        return results
+
+    @classmethod
+    def destroy_all_nodes(cls, provider_configurations):
+        provider_configuration_nodes = []
+        for provider_configuration, nodes, e in cls.list_nodes_concurrently(provider_configurations):
+            if e is not None:
+                provider_configuration.logger.error('Error listing nodes in %s: %s' % (provider_configuration.provider_name, e))
+            else:
+                provider_configuration.logger.info('Found %d nodes in %s' % (len(nodes), provider_configuration.provider_name))
+                provider_configuration_nodes += [(provider_configuration, node) for node in nodes]
+
+        cls.destroy_nodes_concurrently(provider_configuration_nodes)
+
+    @classmethod
+    def destroy_orphan_nodes(cls, provider_configurations):
+        provider_configuration_nodes = []
+        for provider_configuration, nodes, e in cls.list_nodes_concurrently(provider_configurations):
+            if e is not None:
+                provider_configuration.logger.error('Error listing nodes in %s: %s' % (provider_configuration.provider_name, e))
+                continue
+
+            nodes_by_external_id = {node.id: node for node in nodes}
+            tracked_external_ids = set(provider_configuration.instances.filter(~Q(external_id=None))
+                                                                       .values_list('external_id', flat=True))
+
+            orphan_nodes = provider_configuration._find_orphan_nodes(nodes_by_external_id, tracked_external_ids)
+            provider_configuration.logger.info('Found %d orphan nodes in %s' %
+                                               (len(orphan_nodes), provider_configuration.provider_name))
+            provider_configuration_nodes += [(provider_configuration, node) for node in orphan_nodes]
+
+        cls.destroy_nodes_concurrently(provider_configuration_nodes)
+
     def _destroy_all_nodes(self):
-        self.logger.info('Listing nodes in %s' % self.provider_name)
-        nodes = self._list_nodes()
-        self.logger.info('Found %d nodes in %s' % (len(nodes), self.provider_name))
-        for node in nodes:
-            self.logger.info('Destroying node %s' % node.id)
-            try:
-                self.driver.destroy_node(node)
-            except Exception as e:
-                self.logger.error(e)
+        self.destroy_all_nodes([self])
+
+    def _destroy_orphan_nodes(self):
+        self.destroy_orphan_nodes([self])
 
     def destroy_libcloud_node(self, libcloud_node):
         try:
@@ -1,6 +1,6 @@
 from annoying.fields import JSONField
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 from libcloud.compute.base import NodeSize
 
@@ -11,6 +11,16 @@ import uuid
 from ..util import *
 
 
+# Info URLs depend only on the size's external ID and its provider configuration's provider and region, so they're
+# cached in the Django cache for a few minutes. clear_info_url_cache() is connected to Provider and
+# ProviderConfiguration changes in models.py.
+INFO_URL_CACHE = 'provider_size_info_url'
+
+
+def clear_info_url_cache(**kwargs):
+    bump_shared_cache(INFO_URL_CACHE)
+
+
 class ProviderSize(models.Model, SaveTheChange, TrackChanges):
     class Meta:
         app_label = "stratosphere"
@@ -30,13 +40,52 @@ class ProviderSize(models.Model, SaveTheChange, TrackChanges):
         return '%s: %s (%s)' % (self.provider_configuration.provider_name, self.name, self.external_id)
 
     def info_url(self):
-        # TODO this is Amazon-specific
-        if self.provider_configuration.provider.name.startswith('aws'):
-            return "http://www.ec2instances.info/?region=%s&selected=%s" % (self.provider_configuration.region, self.external_id)
-        else:
-            return ''
+        def load_info_url():
+            # TODO this is Amazon-specific
+            if self.provider_configuration.provider.name.startswith('aws'):
+                return "http://www.ec2instances.info/?region=%s&selected=%s" % (self.provider_configuration.region, self.external_id)
+            else:
+                return ''
+
+        return get_shared_cached(INFO_URL_CACHE, (self.provider_configuration_id, self.external_id), load_info_url)
 
     def to_libcloud_size(self):
         return NodeSize(id=self.external_id, name=self.name, ram=self.ram, disk=self.disk,
                         bandwidth=self.bandwidth, price=self.price,
                         driver=self.provider_configuration.driver, extra=self.extra)
+
+
+class BestProviderSize(models.Model):
+    """
+    The cheapest size a provider configuration offers for a compute image's provider image at a given cpu and memory,
+    as chosen by ComputeGroup._get_best_sizes(). A null provider_size records that there isn't one. Rows are deleted
+    whenever sizes, images or disk image mappings change, and recomputed on the next lookup.
+    """
+    class Meta:
+        app_label = "stratosphere"
+        unique_together = ('provider_configuration', 'compute_image', 'cpu', 'memory')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    provider_configuration = models.ForeignKey('ProviderConfiguration', related_name='best_provider_sizes')
+    compute_image = models.ForeignKey('ComputeImage', related_name='best_provider_sizes')
+    cpu = models.IntegerField()
+    memory = models.IntegerField()
+    provider_size = models.ForeignKey('ProviderSize', related_name='+', null=True, blank=True)
+
+    @classmethod
+    def store(cls, provider_configuration, compute_image_id, cpu, memory, provider_size):
+        try:
+            with transaction.atomic():
+                cls.objects.create(provider_configuration=provider_configuration, compute_image_id=compute_image_id,
+                                   cpu=cpu, memory=memory, provider_size=provider_size)
+        except IntegrityError:
+            # another rebalance computed the same entry concurrently
+            pass
+
+    @classmethod
+    def invalidate(cls, **filters):
+        cls.objects.filter(**filters).delete()
+
+
+def invalidate_best_provider_sizes_for_mapping(sender, instance, **kwargs):
+    BestProviderSize.invalidate(compute_image_id=instance.compute_image_id)
@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from datetime import timedelta
+
+import uuid
+import zlib
+
+
+class ScheduledTask(models.Model):
+    """
+    A Celery task that's been enqueued for an entity, like a provider configuration or compute group, and hasn't
+    finished yet. Periodic fan-out tasks schedule through here, so that a tick never enqueues a second message for
+    an entity whose previous run is still queued or executing. Rows are deleted when the run finishes; rows older
+    than SCHEDULED_TASK_STALE_AFTER are assumed to belong to lost messages or killed workers, and are reclaimed.
+
+    A run that's re-enqueued to retry keeps its row, with its attempt count and last error, until it finishes.
+    """
+    class Meta:
+        app_label = "stratosphere"
+        unique_together = ('task_name', 'entity_id')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    task_name = models.CharField(max_length=128)
+    entity_id = models.CharField(max_length=64)
+    scheduled_at = models.DateTimeField()
+    started_at = models.DateTimeField(null=True, blank=True)
+    retry_count = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+
+    @classmethod
+    def claim(cls, task_name, entity_id):
+        entity_id = str(entity_id)
+        now = timezone.now()
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(task_name=task_name, entity_id=entity_id, scheduled_at=now)
+            return True
+        except IntegrityError:
+            stale_before = now - settings.SCHEDULED_TASK_STALE_AFTER
+            return cls.objects.filter(task_name=task_name, entity_id=entity_id, scheduled_at__lt=stale_before) \
+                              .update(scheduled_at=now, started_at=None) > 0
+
+    @classmethod
+    def mark_started(cls, task_name, entity_id):
+        cls.objects.filter(task_name=task_name, entity_id=str(entity_id)).update(started_at=timezone.now())
+
+    @classmethod
+    def record_retry(cls, task_name, entity_id, error, countdown):
+        """
+        Keeps the entity's run claimed while it waits `countdown` seconds to be retried, so that periodic ticks don't
+        schedule it again in the meantime.
+        """
+        retry_at = timezone.now() + timedelta(seconds=countdown)
+        cls.objects.filter(task_name=task_name, entity_id=str(entity_id)) \
+                   .update(scheduled_at=retry_at, started_at=None, retry_count=F('retry_count') + 1, last_error=error)
+
+    @classmethod
+    def release(cls, task_name, entity_id):
+        cls.objects.filter(task_name=task_name, entity_id=str(entity_id)).delete()
+
+    @staticmethod
+    def wheel_countdown(task_name, entity_id, period):
+        """
+        Returns the delay until the entity's slot in a wheel that turns once per `period`. Slots are fixed by a hash
+        of the task and entity, so an entity runs at the same phase every period, and entities are spread evenly
+        across it rather than bunched at the start of each tick.
+        """
+        period_ms = int(period.total_seconds() * 1000)
+        slot_ms = zlib.crc32(('%s:%s' % (task_name, entity_id)).encode('utf-8')) % period_ms
+        now_ms = int(timezone.now().timestamp() * 1000) % period_ms
+        return ((slot_ms - now_ms) % period_ms) / 1000.0
+
+    @classmethod
+    def enqueue(cls, task, entity_id, period=None):
+        countdown = 0 if period is None else cls.wheel_countdown(task.name, entity_id, period)
+        task.apply_async(args=[entity_id], countdown=countdown)
+
+    @classmethod
+    def schedule(cls, task, entity_id, period=None):
+        """
+        Enqueues `task` for `entity_id` at its slot in the next `period`, or right away if `period` is None, unless a
+        run is already pending or executing. Returns whether it was enqueued.
+
+        Tasks wrapped in @coalesced must always be enqueued through here, even for one-off runs, since they release
+        the claim when they finish: a run enqueued directly would release the claim of a scheduled run still in the
+        queue, letting the next tick enqueue a second one.
+        """
+        if cls.claim(task.name, entity_id):
+            cls.enqueue(task, entity_id, period)
+            return True
+        else:
+            return False
@@ -1,3 +1,5 @@
+from annoying.fields import JSONField
+
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin, User
 from django.db import models, transaction
@@ -67,6 +69,10 @@ class User(AbstractBaseUser, PermissionsMixin, HasLogger):
                     'active. Unselect this instead of deleting accounts.'))
     date_joined = models.DateTimeField(_('date joined'), default=timezone.now)
 
+    # counts of the last instance states snapshot, so we can tell whether a new one is needed without reading the
+    # snapshot and its group snapshots back from the database
+    last_instance_states_counts = JSONField(null=True, blank=True)
+
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
@@ -101,7 +107,7 @@ class User(AbstractBaseUser, PermissionsMixin, HasLogger):
         return 'https://www.gravatar.com/avatar/%s?s=48' % hashlib.md5(self.email.strip().lower().encode('utf-8')).hexdigest()
 
     def create_phantom_instance_states_snapshot(self):
-        from ..models import InstanceStatesSnapshot
+        from ..models import ComputeInstance, GroupInstanceStatesSnapshot, InstanceStatesSnapshot
 
         now = timezone.now()
         args = {
@@ -112,55 +118,71 @@ class User(AbstractBaseUser, PermissionsMixin, HasLogger):
             'failed': 0,
         }
 
-        group_snapshots = [g.create_phantom_instance_states_snapshot(now) for g in self.compute_groups.all()]
-        for group_snapshot in group_snapshots:
+        group_counts = ComputeInstance.objects.filter(group__user=self).values('group') \
+                                              .annotate(**ComputeInstance.state_count_aggregates())
+        group_counts_by_id = {counts['group']: counts for counts in group_counts}
+
+        group_snapshots = []
+        for group_id in self.compute_groups.values_list('pk', flat=True):
+            counts = group_counts_by_id.get(group_id, {})
+            group_snapshot = GroupInstanceStatesSnapshot(group_id=group_id, pending=counts.get('pending', 0),
+                                                         running=counts.get('running', 0),
+                                                         failed=counts.get('failed', 0))
+            group_snapshots.append(group_snapshot)
+
             args['pending'] += group_snapshot.pending
             args['running'] += group_snapshot.running
             args['failed'] += group_snapshot.failed
 
         return InstanceStatesSnapshot(**args), group_snapshots
 
-    def take_instance_states_snapshot(self):
-        with transaction.atomic():
-            user_snapshot, group_snapshots = self.create_phantom_instance_states_snapshot()
+    @staticmethod
+    def _instance_states_counts(user_snapshot, group_snapshots):
+        def snapshot_values(snapshot):
+            return {state: getattr(snapshot, state) for state in ('pending', 'running', 'failed')}
+
+        # group IDs are stringified so that the counts survive a round trip through JSON
+        return {
+            'user': snapshot_values(user_snapshot),
+            'groups': {str(gs.group_id): snapshot_values(gs) for gs in group_snapshots},
+        }
+
+    def _get_last_instance_states_counts(self):
+        # re-read the cached counts, since another worker may have taken a snapshot since this user was loaded
+        last_counts = User.objects.only('last_instance_states_counts').get(pk=self.pk).last_instance_states_counts
+
+        # fall back to the last snapshot itself if it was taken before counts were cached
+        if last_counts is None:
+            last_user_snapshot = self.instance_states_snapshots.order_by('-time').first()
+            if last_user_snapshot is not None:
+                last_counts = self._instance_states_counts(last_user_snapshot, last_user_snapshot.group_snapshots.all())
 
+        return last_counts
+
+    def _save_instance_states_snapshot(self, user_snapshot, group_snapshots):
+        from ..models import ChangeCounter, GroupInstanceStatesSnapshot
+
+        with transaction.atomic():
             user_snapshot.save()
 
             for group_snapshot in group_snapshots:
                 group_snapshot.user_snapshot = user_snapshot
-                group_snapshot.save()
+            GroupInstanceStatesSnapshot.objects.bulk_create(group_snapshots)
 
-    def take_instance_states_snapshot_if_changed(self):
-        def snapshots_values(snapshot):
-            return {state: getattr(snapshot, state) for state in ('pending', 'running', 'failed')}
+            self.last_instance_states_counts = self._instance_states_counts(user_snapshot, group_snapshots)
+            User.objects.filter(pk=self.pk).update(last_instance_states_counts=self.last_instance_states_counts)
 
-        def snapshot_values_equal(first, second):
-            if first is None or second is None:
-                return first is None and second is None
-            else:
-                return snapshots_values(first) == snapshots_values(second)
+            ChangeCounter.bump([ChangeCounter.STATE_HISTORY], user=self.pk)
 
+    def take_instance_states_snapshot(self):
         user_snapshot, group_snapshots = self.create_phantom_instance_states_snapshot()
-        last_user_snapshot = self.instance_states_snapshots.order_by('-time').first()
+        self._save_instance_states_snapshot(user_snapshot, group_snapshots)
 
-        not_equal = not snapshot_values_equal(user_snapshot, last_user_snapshot)
-
-        if not not_equal and last_user_snapshot is not None:
-            group_snapshots_map = {gs.group.pk: gs for gs in group_snapshots}
-            last_group_snapshots_map = {gs.group.pk: gs for gs in last_user_snapshot.group_snapshots.all()}
-
-            all_group_ids = set(list(group_snapshots_map.keys()) + list(last_group_snapshots_map.keys()))
-            for group_id in all_group_ids:
-                if not snapshot_values_equal(group_snapshots_map.get(group_id),
-                                             last_group_snapshots_map.get(group_id)):
-                    not_equal = True
-                    break
+    @isolated()
+    def take_instance_states_snapshot_if_changed(self):
+        user_snapshot, group_snapshots = self.create_phantom_instance_states_snapshot()
+        counts = self._instance_states_counts(user_snapshot, group_snapshots)
 
-        if not_equal:
+        if counts != self._get_last_instance_states_counts():
             self.logger.info('Creating snapshot')
-            with transaction.atomic():
-                user_snapshot.save()
-
-                for group_snapshot in group_snapshots:
-                    group_snapshot.user_snapshot = user_snapshot
-                    group_snapshot.save()
\ No newline at end of file
+            self._save_instance_states_snapshot(user_snapshot, group_snapshots)
@@ -1,9 +1,14 @@
+from celery import Task
 from celery.decorators import periodic_task
+from celery.exceptions import Retry
 from celery.task.schedules import crontab
 from celery.utils.log import get_task_logger
 
 from datetime import datetime, timedelta
 
+from functools import wraps
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 from django.core.mail import send_mail
@@ -21,7 +26,7 @@ from multicloud.celery import app
 
 import random
 
-from .util import NodeJSONEncoder, schedule_random_default_delay, thread_local
+from .util import NodeJSONEncoder, thread_local
 
 # we don't import import models here, since doing so seems to screw up bootstrapping
 
@@ -29,7 +34,52 @@ from .util import NodeJSONEncoder, schedule_random_default_delay, thread_local
 logger = get_task_logger(__name__)
 
 
+# periods of the fan-out tasks below, which also size the wheels their per-entity tasks are spread across
+PROVIDER_CHECK_PERIOD = timedelta(seconds=10)
+INSTANCE_DISTRIBUTION_CHECK_PERIOD = timedelta(seconds=10)
+INSTANCE_STATES_SNAPSHOT_PERIOD = timedelta(seconds=15)
+PROVIDER_DATA_LOAD_PERIOD = timedelta(minutes=10)
+INSTANCE_STATES_ROLLUP_PERIOD = timedelta(minutes=1)
+
+# backoff of health checks that are re-enqueued because listing a provider's nodes failed: 10, 30, then 90 seconds
+PROVIDER_CHECK_RETRIES = 3
+PROVIDER_CHECK_RETRY_DELAY = 10
+PROVIDER_CHECK_RETRY_BACKOFF = 3
+
+
+def coalesced(f):
+    """
+    For tasks scheduled through ScheduledTask.schedule(): marks the entity's run as started when the task begins,
+    and releases it when the task ends, successfully or not, so that the next tick can schedule it again. The task's
+    first argument (after the task itself, for bound tasks) must be the entity ID. If the task re-enqueues itself
+    with Task.retry(), the run stays claimed, with the retry recorded, until the retry finishes.
+    """
+    task_name = '%s.%s' % (f.__module__, f.__name__)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        from .models import ScheduledTask
+
+        entity_id = args[1] if isinstance(args[0], Task) else args[0]
+
+        ScheduledTask.mark_started(task_name, entity_id)
+        try:
+            result = f(*args, **kwargs)
+        except Retry as e:
+            ScheduledTask.record_retry(task_name, entity_id, str(e), e.when)
+            raise
+        except:
+            ScheduledTask.release(task_name, entity_id)
+            raise
+
+        ScheduledTask.release(task_name, entity_id)
+        return result
+
+    return wrapper
+
+
 @app.task()
+@coalesced
 def load_provider_data(provider_configuration_id):
     from .models import ProviderConfiguration
 
@@ -44,114 +94,129 @@ def load_public_provider_data(provider_configuration_id):
 
     provider_configuration = ProviderConfiguration.objects.get(pk=provider_configuration_id)
     if provider_configuration.provider_credential_set.error_type is None:
-        provider_configuration.load_data(True)
+        provider_configuration.load_public_catalog()
 
 
-@periodic_task(run_every=timedelta(minutes=10))
+@periodic_task(run_every=PROVIDER_DATA_LOAD_PERIOD)
 def load_provider_data_all():
-    from .models import ProviderConfiguration
+    from .models import ProviderConfiguration, ScheduledTask
 
     provider_configuration_ids = ProviderConfiguration.objects.exclude(user=None).values_list('pk', flat=True)
     for provider_configuration_id in provider_configuration_ids:
-        schedule_random_default_delay(load_provider_data, provider_configuration_id)
+        ScheduledTask.schedule(load_provider_data, provider_configuration_id, PROVIDER_DATA_LOAD_PERIOD)
 
 
-# There's no pagination for EC2 DescribeImages requests, which are what libcloud uses to query driver
-# images. When querying public images, this loads about 40-70k driver images into memory. This is fine for
-# one provider, but when a single worker queries multiple providers simultaneously, it can blow out memory on
-# Heroku. So we send the tasks to a different queue that's processed by a worker with its concurrency set to
-# 1.
+# Public image catalogs are large (about 40-70k images for EC2), but the loader streams them in fixed-size batches,
+# so memory use is bounded by the batch size rather than the catalog size and these tasks can share the default
+# queue's workers. The catalog is shared by every configuration of a provider, so it's loaded with one public
+# configuration per provider, and only once it's older than PUBLIC_IMAGE_CATALOG_MAX_AGE.
 @periodic_task(run_every=timedelta(minutes=10))
 def load_public_provider_data_all():
     from .models import ProviderConfiguration
 
-    provider_configuration_ids = ProviderConfiguration.objects.filter(user=None).values_list('pk', flat=True)
-    for provider_configuration_id in provider_configuration_ids:
-        load_public_provider_data.apply_async(args=[provider_configuration_id], queue='load_public_provider_data')
+    stale_before = timezone.now() - settings.PUBLIC_IMAGE_CATALOG_MAX_AGE
+    provider_configurations = ProviderConfiguration.objects.filter(user=None, provider_credential_set__error_type=None) \
+                                                   .filter(Q(provider__public_catalog_loaded_at=None)
+                                                           | Q(provider__public_catalog_loaded_at__lte=stale_before)) \
+                                                   .values_list('pk', 'provider_id')
 
+    provider_configuration_ids_by_provider_id = {}
+    for provider_configuration_id, provider_id in provider_configurations:
+        provider_configuration_ids_by_provider_id.setdefault(provider_id, provider_configuration_id)
 
-@app.task()
-def check_failed_instances(provider_configuration_id):
-    from .models import ProviderConfiguration
+    for provider_configuration_id in provider_configuration_ids_by_provider_id.values():
+        load_public_provider_data.delay(provider_configuration_id)
 
-    provider_configuration = ProviderConfiguration.objects.get(pk=provider_configuration_id)
-    if provider_configuration.user is not None:
-        provider_configuration.check_failed_instances()
 
-
-@periodic_task(run_every=timedelta(seconds=10))
-def check_failed_instances_all():
-    from .models import ProviderConfiguration
-
-    provider_configuration_ids = ProviderConfiguration.objects.all().values_list('pk', flat=True)
-    for provider_configuration_id in provider_configuration_ids:
-        schedule_random_default_delay(check_failed_instances, provider_configuration_id)
-
-
-@app.task()
-def check_provider_enabled(provider_configuration_id):
+@app.task(bind=True, max_retries=PROVIDER_CHECK_RETRIES)
+@coalesced
+def check_provider_health(self, provider_configuration_id):
     from .models import ProviderConfiguration
 
     provider_configuration = ProviderConfiguration.objects.get(pk=provider_configuration_id)
-    if provider_configuration.user is not None:
-        provider_configuration.check_enabled()
+    if provider_configuration.user is not None and provider_configuration.instances.exists():
+        provider_configuration.check_health(retry_task=self)
 
 
-@periodic_task(run_every=timedelta(seconds=10))
-def check_provider_enabled_all():
-    from .models import ProviderConfiguration
+# One pipeline per configuration lists its nodes, reconciles instance states, marks failed instances and disables
+# the configuration if too many have failed, all against one loaded set of instances.
+@periodic_task(run_every=PROVIDER_CHECK_PERIOD)
+def check_provider_health_all():
+    from .models import ProviderConfiguration, ScheduledTask
 
-    provider_configuration_ids = ProviderConfiguration.objects.all().values_list('pk', flat=True)
+    provider_configuration_ids = ProviderConfiguration.objects.exclude(user=None).values_list('pk', flat=True)
     for provider_configuration_id in provider_configuration_ids:
-        schedule_random_default_delay(check_provider_enabled, provider_configuration_id)
+        ScheduledTask.schedule(check_provider_health, provider_configuration_id, PROVIDER_CHECK_PERIOD)
 
 
 @app.task()
+@coalesced
 def check_instance_states_snapshots(user_id):
     user = get_user_model().objects.get(pk=user_id)
     user.take_instance_states_snapshot_if_changed()
 
 
-@periodic_task(run_every=timedelta(seconds=15))
+@periodic_task(run_every=INSTANCE_STATES_SNAPSHOT_PERIOD)
 def check_instance_states_snapshots_all():
+    from .models import ScheduledTask
+
     user_ids = get_user_model().objects.all().values_list('pk', flat=True)
     for user_id in user_ids:
-        check_instance_states_snapshots.delay(user_id)
+        ScheduledTask.schedule(check_instance_states_snapshots, user_id, INSTANCE_STATES_SNAPSHOT_PERIOD)
 
 
+# Rollups are created for every user at once, so there's a single entity to coalesce on, which keeps two rollup runs
+# from creating the same buckets.
 @app.task()
-def check_instance_distribution(compute_group_id):
-    from .models import ComputeGroup
+@coalesced
+def roll_up_instance_states_snapshots(entity_id):
+    from .models import roll_up_instance_states
 
-    compute_group = ComputeGroup.objects.get(pk=compute_group_id)
-    compute_group.check_instance_distribution()
+    roll_up_instance_states()
 
 
-@periodic_task(run_every=timedelta(seconds=10))
-def check_instance_distribution_all():
-    from .models import ComputeGroup
+@periodic_task(run_every=INSTANCE_STATES_ROLLUP_PERIOD)
+def roll_up_instance_states_snapshots_all():
+    from .models import ScheduledTask
 
-    compute_group_ids = ComputeGroup.objects.all().values_list('pk', flat=True)
-    for compute_group_id in compute_group_ids:
-        schedule_random_default_delay(check_instance_distribution, compute_group_id)
+    ScheduledTask.schedule(roll_up_instance_states_snapshots, 'all', INSTANCE_STATES_ROLLUP_PERIOD)
 
 
 @app.task()
-def update_instance_statuses(provider_configuration_id):
-    from .models import ProviderConfiguration
-
-    provider_configuration = ProviderConfiguration.objects.get(pk=provider_configuration_id)
-    if provider_configuration.user is not None and provider_configuration.instances.count() > 0:
-        provider_configuration.update_instance_statuses()
+@coalesced
+def check_instance_distribution(compute_group_id):
+    from .models import ComputeGroup
 
+    compute_group = ComputeGroup.objects.get(pk=compute_group_id)
+    compute_group.check_instance_distribution()
 
-@periodic_task(run_every=timedelta(seconds=10))
-def update_instance_statuses_all():
-    from .models import ProviderConfiguration
 
-    provider_configuration_ids = ProviderConfiguration.objects.all().values_list('pk', flat=True)
-    for provider_configuration_id in provider_configuration_ids:
-        schedule_random_default_delay(update_instance_statuses, provider_configuration_id)
+@periodic_task(run_every=INSTANCE_DISTRIBUTION_CHECK_PERIOD)
+def check_instance_distribution_all():
+    from .models import ComputeGroup, ScheduledTask
+
+    # Groups whose previous rebalance is still pending or running keep their flag, so that a change made during that
+    # run is picked up by the next one. Groups marked after their flags are cleared here stay marked for the next
+    # tick, and the others are rebalanced from their state at the time the task runs, so no change is lost.
+    compute_group_ids = ComputeGroup.objects.filter(needs_rebalance=True).values_list('pk', flat=True)
+    claimed_compute_group_ids = [compute_group_id for compute_group_id in compute_group_ids
+                                 if ScheduledTask.claim(check_instance_distribution.name, compute_group_id)]
+    ComputeGroup.objects.filter(pk__in=claimed_compute_group_ids).update(needs_rebalance=False)
+
+    for compute_group_id in claimed_compute_group_ids:
+        ScheduledTask.enqueue(check_instance_distribution, compute_group_id, INSTANCE_DISTRIBUTION_CHECK_PERIOD)
+
+
+# Safety net for changes that don't mark their groups, e.g. public image catalog updates. Destroyed groups without
+# any available instances have nothing left to rebalance, so they're skipped.
+@periodic_task(run_every=timedelta(minutes=5))
+def mark_compute_groups_for_rebalance():
+    from .models import ComputeGroup, ComputeInstance
+
+    available_instance_group_ids = ComputeInstance.objects.filter(~ComputeInstance.unavailable_instances_query()) \
+                                                          .values('group_id')
+    ComputeGroup.objects.filter(~Q(state=ComputeGroup.DESTROYED) | Q(pk__in=available_instance_group_ids)) \
+                        .update(needs_rebalance=True)
 
 
 @periodic_task(run_every=timedelta(seconds=30))
@@ -1,3 +1,1271 @@
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import connection, connections, OperationalError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from libcloud.compute.base import Node, NodeImage, NodeSize
+from libcloud.compute.types import NodeState
 
-# Create your tests here.
+from datetime import timedelta
+from decimal import Decimal
+from fractions import Fraction
+from itertools import product
+from unittest import mock
+from xml.etree import ElementTree
+
+import gzip
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+from .models import *
+from .tasks import check_instance_distribution, check_instance_distribution_all, create_libcloud_node, \
+                   load_provider_data, mark_compute_groups_for_rebalance
+from .util import bulk_create_historical_records, bulk_create_inherited, bulk_update, generate_names, isolated, \
+                   map_concurrently
+from .views import _compute_groups_to_json, COMPUTE_GROUPS_JSON_QUERY_BUDGET
+
+
+def create_instances(group, provider_configuration, provider_image, provider_size, count, **kwargs):
+    # bulk_create() skips the post_save handler that would schedule node creation
+    instances = [ComputeInstance(name='%s-%d' % (group.name, i), group=group, provider_configuration=provider_configuration,
+                                 provider_image=provider_image, provider_size=provider_size,
+                                 public_ips=[], private_ips=[], extra={}, **kwargs)
+                 for i in range(count)]
+    return ComputeInstance.objects.bulk_create(instances)
+
+
+def create_compute_group(user, instance_count=0, provider_name='aws_us_east_1', region='us-east-1'):
+    # creating a provider configuration normally schedules a task to load its sizes and images
+    with mock.patch('stratosphere.models.schedule_random_default_delay'), mock.patch.object(ScheduledTask, 'enqueue'):
+        provider = Provider.objects.create(name=provider_name, pretty_name=provider_name,
+                                           icon_path='stratosphere/aws_icon.png',
+                                           supports_ssh_instance_auth=True, supports_password_instance_auth=False)
+        provider_credential_set = AWSProviderCredentialSet.objects.create(access_key_id='access_key_id',
+                                                                          secret_access_key='secret_access_key')
+        provider_configuration = AWSProviderConfiguration.objects.create(provider=provider, provider_name=provider_name,
+                                                                         region=region, user=user,
+                                                                         provider_credential_set=provider_credential_set)
+
+    provider_image = ProviderImage.objects.create(provider=provider, external_id='ami-12345678', name='image',
+                                                  extra={'is_public': True})
+    provider_size = ProviderSize.objects.create(provider_configuration=provider_configuration, external_id='m4.large',
+                                                name='Large', price=0.12, ram=8192, disk=0, cpu=6, extra={})
+    compute_image = ComputeImage.objects.create(user=user, name='image')
+
+    compute_group = ComputeGroup.objects.create(user=user, image=compute_image, instance_count=instance_count,
+                                                cpu=1, memory=512, name='group',
+                                                provider_policy={provider_name: 'auto'}, size_distribution={})
+
+    return compute_group, provider_configuration, provider_image, provider_size
+
+
+class ComputeInstanceStatePredicateTest(TestCase):
+    STATES = [None] + [state for state, _ in ComputeInstance.STATE_CHOICES]
+
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        self.group, provider_configuration, provider_image, provider_size = create_compute_group(user)
+
+        # bulk_create() skips the post_save handler that would schedule node creation
+        instances = []
+        for state, destroyed, failed, failure_ignored in product(self.STATES, [False, True], [False, True], [False, True]):
+            instances.append(ComputeInstance(name='%s-%s-%s-%s' % (state, destroyed, failed, failure_ignored),
+                                             group=self.group, provider_configuration=provider_configuration,
+                                             provider_image=provider_image, provider_size=provider_size,
+                                             state=state, destroyed=destroyed, failed=failed,
+                                             failure_ignored=failure_ignored,
+                                             public_ips=[], private_ips=[], extra={}))
+        ComputeInstance.objects.bulk_create(instances)
+
+    def assertPredicateMatchesQuery(self, predicate_name, query):
+        instances = ComputeInstance.objects.filter(group=self.group)
+        matching_ids = set(instances.filter(query).values_list('pk', flat=True))
+
+        for instance in instances:
+            self.assertEqual(getattr(instance, predicate_name)(), instance.pk in matching_ids,
+                             '%s() disagrees with its query for instance %s' % (predicate_name, instance.name))
+
+    def test_destroyed(self):
+        self.assertPredicateMatchesQuery('is_destroyed', ComputeInstance.destroyed_instances_query())
+
+    def test_failed(self):
+        self.assertPredicateMatchesQuery('is_failed', ComputeInstance.failed_instances_query())
+
+    def test_unavailable(self):
+        self.assertPredicateMatchesQuery('is_unavailable', ComputeInstance.unavailable_instances_query())
+
+    def test_unignored_failed(self):
+        self.assertPredicateMatchesQuery('is_unignored_failed', ComputeInstance.unignored_failed_instances_query())
+
+    def test_running(self):
+        self.assertPredicateMatchesQuery('is_running', ComputeInstance.running_instances_query())
+
+    def test_pending(self):
+        self.assertPredicateMatchesQuery('is_pending', ComputeInstance.pending_instances_query())
+
+    def test_predicates_do_not_query(self):
+        instances = list(ComputeInstance.objects.filter(group=self.group))
+
+        with self.assertNumQueries(0):
+            for instance in instances:
+                instance.is_running()
+                instance.is_pending()
+                instance.is_destroyed()
+                instance.is_failed()
+                instance.is_unavailable()
+                instance.is_unignored_failed()
+
+    def test_state_count_aggregates_match_predicates(self):
+        instances = list(ComputeInstance.objects.filter(group=self.group))
+        counts = ComputeInstance.objects.filter(group=self.group).aggregate(**ComputeInstance.state_count_aggregates())
+
+        self.assertEqual(counts, {
+            'pending': sum(1 for instance in instances if instance.is_pending()),
+            'running': sum(1 for instance in instances if instance.is_running()),
+            'failed': sum(1 for instance in instances
+                          if instance.is_failed() and instance.state != ComputeInstance.TERMINATED),
+        })
+        # every combination of states and flags is covered, so each count is nonzero
+        self.assertTrue(all(count > 0 for count in counts.values()))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ComputeGroupsJSONTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password')
+
+        # the current site is cached for the life of the process after the first lookup
+        Site.objects.get_or_create(pk=settings.SITE_ID, defaults={'domain': 'testserver', 'name': 'testserver'})
+        Site.objects.get_current()
+
+    def add_group(self, instance_count, region):
+        group, provider_configuration, provider_image, provider_size = \
+            create_compute_group(self.user, instance_count, provider_name='aws_%s' % region.replace('-', '_'),
+                                 region=region)
+
+        group.size_distribution = {str(provider_size.pk): instance_count}
+        group.save()
+
+        create_instances(group, provider_configuration, provider_image, provider_size, instance_count,
+                         state=ComputeInstance.RUNNING)
+        create_instances(group, provider_configuration, provider_image, provider_size, 1, state=None)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            groups_json = _compute_groups_to_json(self.user, self.user.compute_groups.all())
+        return len(context.captured_queries), groups_json
+
+    def test_query_budget(self):
+        self.add_group(1, 'us-east-1')
+        small_query_count, groups_json = self.count_queries()
+        self.assertEqual(len(groups_json), 1)
+
+        self.add_group(20, 'us-west-1')
+        self.add_group(50, 'us-west-2')
+        large_query_count, groups_json = self.count_queries()
+        self.assertEqual(len(groups_json), 3)
+
+        self.assertEqual(small_query_count, large_query_count)
+        self.assertLessEqual(large_query_count, COMPUTE_GROUPS_JSON_QUERY_BUDGET)
+
+    def test_counts(self):
+        self.add_group(3, 'us-east-1')
+        _, groups_json = self.count_queries()
+
+        group_json = groups_json[0]
+        self.assertEqual(group_json['running_instance_count'], 3)
+        self.assertEqual(len(group_json['instances']), 4)
+        self.assertEqual(group_json['providers']['aws_us_east_1']['running'], 3)
+        self.assertEqual(group_json['providers']['aws_us_east_1']['pending'], 1)
+        self.assertEqual(group_json['cost'], ProviderSize.objects.get().price * 3)
+
+
+class EventsFeedTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password')
+        self.client.login(username='test@example.com', password='password')
+
+        self.group, self.provider_configuration, provider_image, self.provider_size = create_compute_group(self.user)
+        self.instances = create_instances(self.group, self.provider_configuration, provider_image, self.provider_size, 3)
+
+    def add_events(self):
+        GroupCreatedEvent.objects.create(user=self.user, compute_group=self.group)
+        RebalanceEvent.objects.create(user=self.user, compute_group=self.group, old_size_distribution={},
+                                      new_size_distribution={str(self.provider_size.pk): 3})
+        ProviderConfigurationEnabledEvent.objects.create(user=self.user, provider_configuration=self.provider_configuration,
+                                                         enabled=True)
+        for instance in ComputeInstance.objects.filter(group=self.group):
+            InstanceFailedEvent.objects.create(user=self.user, provider_configuration=self.provider_configuration,
+                                               compute_group=self.group, compute_instance=instance)
+
+    def get_events(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/events/', params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8')), len(context.captured_queries)
+
+    def unseen_events(self, page, seen_ids):
+        # pages after a cursor repeat the events just behind it, which clients skip by ID
+        events = [event for event in page['events'] if event['id'] not in seen_ids]
+        seen_ids.update(event['id'] for event in events)
+        return events
+
+    def test_since_returns_only_newer_events(self):
+        self.add_events()
+        page, _ = self.get_events()
+        # creating the group added one more
+        self.assertEqual(len(page['events']), 7)
+        seen_ids = {event['id'] for event in page['events']}
+
+        newer_page, _ = self.get_events(since=page['cursor'])
+        self.assertEqual(self.unseen_events(newer_page, seen_ids), [])
+        self.assertEqual(newer_page['cursor'], page['cursor'])
+
+        GroupTerminatedEvent.objects.create(user=self.user, compute_group=self.group)
+        newer_page, _ = self.get_events(since=page['cursor'])
+        self.assertEqual([event['type'] for event in self.unseen_events(newer_page, seen_ids)], ['GroupTerminatedEvent'])
+
+    def test_events_committed_late_are_returned(self):
+        self.add_events()
+        page, _ = self.get_events()
+        seen_ids = {event['id'] for event in page['events']}
+
+        # as if the event was created before the newest one returned, but committed after it was read
+        late_event = GroupTerminatedEvent.objects.create(user=self.user, compute_group=self.group)
+        newest_created_at = self.user.events.exclude(pk=late_event.pk).order_by('-created_at').first().created_at
+        Event.objects.filter(pk=late_event.pk).update(created_at=newest_created_at - timedelta(seconds=10))
+
+        newer_page, _ = self.get_events(since=page['cursor'])
+        self.assertEqual([event['id'] for event in self.unseen_events(newer_page, seen_ids)], [str(late_event.pk)])
+        self.assertEqual(newer_page['cursor'], page['cursor'])
+
+    def test_limit_pages_through_events(self):
+        self.add_events()
+        first_event = self.user.events.order_by('created_at', 'id').first()
+        seen_ids = set()
+
+        page, _ = self.get_events(since='0_%s' % uuid.UUID(int=0), limit=4)
+        events = self.unseen_events(page, seen_ids)
+        self.assertEqual(events[0]['id'], str(first_event.pk))
+        self.assertEqual(len(events), 4)
+        self.assertTrue(page['has_more'])
+
+        page, _ = self.get_events(since=page['cursor'], limit=4)
+        self.assertEqual(len(self.unseen_events(page, seen_ids)), 3)
+        self.assertFalse(page['has_more'])
+
+    def test_descriptions_are_rendered_from_captured_fields(self):
+        size = ProviderSize.objects.create(provider_configuration=self.provider_configuration, external_id='m4.xlarge',
+                                           name='Extra large', price=0.24, ram=16384, disk=0, cpu=8, extra={})
+        missing_size_id = str(uuid.uuid4())
+        RebalanceEvent.objects.create(user=self.user, compute_group=self.group,
+                                      old_size_distribution={missing_size_id: 1}, new_size_distribution={str(size.pk): 1})
+        size.delete()
+        self.group.name = 'renamed'
+        self.group.save()
+
+        event = RebalanceEvent.objects.get()
+        with self.assertNumQueries(0):
+            description = event.rich_description
+
+        self.assertIn('<b>group</b>', description)
+        self.assertIn('m4.xlarge', description)
+        self.assertIn('&lt;missing&gt;', description)
+
+    def test_queries_do_not_grow_with_events(self):
+        self.add_events()
+        _, small_query_count = self.get_events()
+
+        self.add_events()
+        self.add_events()
+        page, large_query_count = self.get_events()
+
+        self.assertEqual(len(page['events']), 19)
+        self.assertEqual(small_query_count, large_query_count)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ChangesTest(TestCase):
+    def setUp(self):
+        Site.objects.get_or_create(pk=settings.SITE_ID, defaults={'domain': 'testserver', 'name': 'testserver'})
+        Site.objects.get_current()
+
+        # change counters are bumped on commit, which never comes inside a test case's transaction
+        on_commit_patcher = mock.patch.object(connections['default'], 'on_commit', lambda f: f())
+        on_commit_patcher.start()
+        self.addCleanup(on_commit_patcher.stop)
+
+        self.user = User.objects.create_user(email='test@example.com', password='password')
+        self.client.login(username='test@example.com', password='password')
+        self.group = create_compute_group(self.user)[0]
+
+    def get_changes(self, version=None):
+        if version is None:
+            return self.client.get('/changes/', secure=True)
+        else:
+            return self.client.get('/changes/', {'since': version}, secure=True, HTTP_IF_NONE_MATCH='"%d"' % version)
+
+    def test_unchanged_dashboard_is_not_modified(self):
+        response = self.get_changes()
+        self.assertEqual(response.status_code, 200)
+
+        changes = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(changes['changed'], list(ChangeCounter.SECTIONS))
+        self.assertEqual([group['id'] for group in changes['compute']], [str(self.group.pk)])
+        self.assertEqual(len(changes['providers']), 1)
+        self.assertEqual(response['ETag'], '"%d"' % changes['version'])
+
+        response = self.get_changes(changes['version'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_only_changed_sections_are_returned(self):
+        version = json.loads(self.get_changes().content.decode('utf-8'))['version']
+
+        self.group.name = 'renamed'
+        self.group.save()
+        GroupTerminatedEvent.objects.create(user=self.user, compute_group=self.group)
+
+        response = self.get_changes(version)
+        self.assertEqual(response.status_code, 200)
+
+        changes = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(changes['version'], version + 2)
+        self.assertEqual(changes['changed'], [ChangeCounter.COMPUTE, ChangeCounter.EVENTS])
+        self.assertEqual(changes['compute'][0]['name'], 'renamed')
+        self.assertNotIn('providers', changes)
+
+    def test_only_changed_groups_are_returned(self):
+        other_group = create_compute_group(self.user, provider_name='aws_us_west_1', region='us-west-1')[0]
+        removed_group = create_compute_group(self.user, provider_name='aws_eu_west_1', region='eu-west-1')[0]
+        version = json.loads(self.get_changes().content.decode('utf-8'))['version']
+
+        self.group.name = 'renamed'
+        self.group.save()
+        removed_group.delete()
+
+        changes = json.loads(self.get_changes(version).content.decode('utf-8'))
+        self.assertEqual([group['id'] for group in changes['compute']], [str(self.group.pk)])
+        self.assertEqual(changes['compute_removed'], [str(removed_group.pk)])
+        self.assertNotIn(str(other_group.pk), changes['compute_removed'])
+
+        # polls without a version get every group, with nothing to remove
+        changes = json.loads(self.get_changes().content.decode('utf-8'))
+        self.assertEqual({group['id'] for group in changes['compute']}, {str(self.group.pk), str(other_group.pk)})
+        self.assertNotIn('compute_removed', changes)
+
+    def test_instance_changes_return_only_their_group_and_provider(self):
+        other_group, provider_configuration, provider_image, provider_size = \
+            create_compute_group(self.user, provider_name='aws_us_west_1', region='us-west-1')
+        version = json.loads(self.get_changes().content.decode('utf-8'))['version']
+
+        instance = create_instances(other_group, provider_configuration, provider_image, provider_size, 1)[0]
+        instance.state = ComputeInstance.RUNNING
+        instance.save()
+
+        changes = json.loads(self.get_changes(version).content.decode('utf-8'))
+        self.assertEqual([group['id'] for group in changes['compute']], [str(other_group.pk)])
+        self.assertEqual([provider['id'] for provider in changes['providers']], [str(provider_configuration.pk)])
+        self.assertEqual(changes['compute_removed'], [])
+        self.assertEqual(changes['providers_removed'], [])
+
+
+class StateHistoryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password')
+        self.client.login(username='test@example.com', password='password')
+        self.group = create_compute_group(self.user)[0]
+
+        # a snapshot a minute for the last 10 hours, with running counts cycling 0-9 and a spike in the middle
+        self.now = timezone.now()
+        for i in range(600):
+            running = 100 if i == 300 else i % 10
+            user_snapshot = InstanceStatesSnapshot.objects.create(user=self.user, time=self.now - timedelta(minutes=600 - i),
+                                                                  running=running, pending=1, failed=0)
+            GroupInstanceStatesSnapshot.objects.create(user_snapshot=user_snapshot, group=self.group,
+                                                       running=running // 2, pending=1, failed=0)
+
+    def get_history(self, url, **params):
+        response = self.client.get(url, params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_history_is_downsampled_to_points(self):
+        history = self.get_history('/compute/state_history/', points=50)
+
+        self.assertLessEqual(len(history), 51)
+        self.assertEqual(max(bucket['max']['running'] for bucket in history), 100)
+        self.assertEqual(min(bucket['min']['running'] for bucket in history), 0)
+        self.assertEqual(history[-1]['running'], 599 % 10)
+
+    def test_window_starts_with_previous_counts(self):
+        history = self.get_history('/compute/state_history/', limit=3600, points=1000)
+
+        # the snapshot exactly an hour before setUp()'s now is just outside the window, so it's the previous one
+        self.assertEqual(len(history), 60)
+        self.assertEqual(history[0]['running'], 540 % 10)
+
+    def test_group_history(self):
+        history = self.get_history('/compute/state_history/%s/' % self.group.pk, points=50)
+
+        self.assertEqual(max(bucket['max']['running'] for bucket in history), 50)
+        self.assertEqual(history[-1]['running'], (599 % 10) // 2)
+
+    @override_settings(INSTANCE_STATES_RETENTION={'raw': timedelta(hours=1), 'minute': timedelta(days=14),
+                                                  'hour': timedelta(days=180), 'day': None})
+    def test_history_is_read_from_rollups_after_raw_snapshots_expire(self):
+        roll_up_instance_states(self.now)
+
+        self.assertGreater(InstanceStatesMinuteRollup.objects.filter(group=None).count(), 500)
+        self.assertGreater(InstanceStatesHourRollup.objects.filter(group=self.group).count(), 0)
+        self.assertLess(InstanceStatesSnapshot.objects.count(), 61)
+
+        history = self.get_history('/compute/state_history/', points=50)
+        self.assertLessEqual(len(history), 51)
+        self.assertEqual(max(bucket['max']['running'] for bucket in history), 100)
+        self.assertEqual(min(bucket['min']['running'] for bucket in history), 0)
+        self.assertEqual(history[-1]['running'], 599 % 10)
+
+        group_history = self.get_history('/compute/state_history/%s/' % self.group.pk, points=50)
+        self.assertEqual(max(bucket['max']['running'] for bucket in group_history), 50)
+
+
+def legacy_size_distribution(group, sizes):
+    # the iterative distribution _get_size_distribution() replaced, kept to check the closed form against
+    instance_counts = {group._get_provider_size_key(provider_size): 0 for provider_size in sizes.values()}
+
+    if len(sizes) > 0:
+        sizes_list = group._sorted_sizes(sizes)
+
+        while sum(instance_counts.values()) < group.instance_count:
+            remaining_instance_count = group.instance_count - sum(instance_counts.values())
+            provider_instance_count = int(remaining_instance_count/len(sizes))
+
+            for provider_size in sizes_list:
+                if provider_instance_count == 0 and sum(instance_counts.values()) < group.instance_count:
+                    corrected_provider_instance_count = 1
+                else:
+                    corrected_provider_instance_count = provider_instance_count
+
+                key = group._get_provider_size_key(provider_size)
+                instance_counts[key] += corrected_provider_instance_count
+
+    return instance_counts
+
+
+class SizeDistributionTest(TestCase):
+    ITERATIONS = 500
+
+    def setUp(self):
+        self.random = random.Random(0)
+
+    def random_group(self, provider_names, weights=None):
+        if weights is None:
+            weights = ['auto'] * len(provider_names)
+        return ComputeGroup(instance_count=self.random.randint(0, 1000),
+                            provider_policy=dict(zip(provider_names, weights)))
+
+    def random_sizes(self, provider_count):
+        return {'provider_%d' % i: ProviderSize(id=uuid.UUID(int=self.random.getrandbits(128)))
+                for i in range(provider_count)}
+
+    def test_matches_legacy_for_equal_weights(self):
+        for _ in range(self.ITERATIONS):
+            sizes = self.random_sizes(self.random.randint(1, 8))
+            group = self.random_group(list(sizes.keys()))
+
+            self.assertEqual(group._get_size_distribution(sizes), legacy_size_distribution(group, sizes))
+
+    def test_no_sizes(self):
+        group = ComputeGroup(instance_count=10, provider_policy={})
+        self.assertEqual(group._get_size_distribution({}), {})
+
+    def test_weighted_shares(self):
+        for _ in range(self.ITERATIONS):
+            sizes = self.random_sizes(self.random.randint(1, 8))
+            weights = [self.random.choice(['auto', 0, 1, 2, 3, 0.5]) for _ in sizes]
+            group = self.random_group(list(sizes.keys()), weights)
+
+            distribution = group._get_size_distribution(sizes)
+            self.assertEqual(sum(distribution.values()), group.instance_count)
+
+            parsed_weights = {name: Fraction(1) if weight == 'auto' else Fraction(weight)
+                              for name, weight in group.provider_policy.items()}
+            total_weight = sum(parsed_weights.values())
+
+            for provider_name, provider_size in sizes.items():
+                count = distribution[str(provider_size.pk)]
+                if total_weight == 0:
+                    share = Fraction(group.instance_count, len(sizes))
+                else:
+                    share = group.instance_count * parsed_weights[provider_name] / total_weight
+
+                # every size gets its exact share, rounded either down or up
+                self.assertLess(abs(count - share), 1)
+
+    def test_counts_sum_to_instance_count(self):
+        for _ in range(self.ITERATIONS):
+            sizes = self.random_sizes(self.random.randint(1, 8))
+            group = self.random_group(list(sizes.keys()))
+
+            self.assertEqual(sum(group._get_size_distribution(sizes).values()), group.instance_count)
+
+    def test_ties_go_to_sizes_in_primary_key_order(self):
+        sizes = {'provider_%d' % i: ProviderSize(id=uuid.UUID(int=i)) for i in range(3)}
+        group = ComputeGroup(instance_count=5, provider_policy={name: 'auto' for name in sizes})
+
+        # every size has a remainder of 2/3, so the 2 left over go to the sizes with the lowest primary keys
+        expected = {str(uuid.UUID(int=0)): 2, str(uuid.UUID(int=1)): 2, str(uuid.UUID(int=2)): 1}
+        for _ in range(10):
+            shuffled_names = list(sizes.keys())
+            self.random.shuffle(shuffled_names)
+            shuffled_sizes = {name: sizes[name] for name in shuffled_names}
+
+            self.assertEqual(group._get_size_distribution(shuffled_sizes), expected)
+
+    def test_large_group_is_not_iterative(self):
+        sizes = self.random_sizes(3)
+        group = self.random_group(list(sizes.keys()))
+        group.instance_count = 10000000
+
+        distribution = group._get_size_distribution(sizes)
+        self.assertEqual(sorted(distribution.values()), [3333333, 3333333, 3333334])
+
+
+class GenerateNamesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        self.group, self.provider_configuration, self.provider_image, self.provider_size = create_compute_group(user)
+
+    def test_names_are_unique(self):
+        create_instances(self.group, self.provider_configuration, self.provider_image, self.provider_size, 5)
+
+        with self.assertNumQueries(1):
+            names = generate_names(self.group.instances, 200)
+
+        existing_names = set(self.group.instances.values_list('name', flat=True))
+        self.assertEqual(len(set(names)), 200)
+        self.assertFalse(existing_names & set(names))
+
+    def test_collisions_fall_back_to_suffix(self):
+        create_instances(self.group, self.provider_configuration, self.provider_image, self.provider_size, 1)
+        self.group.instances.update(name='boldwave')
+
+        with mock.patch('stratosphere.util.haikunate', return_value='boldwave'):
+            names = generate_names(self.group.instances, 3)
+
+        self.assertEqual(names, ['boldwave2', 'boldwave3', 'boldwave4'])
+
+
+class MapConcurrentlyTest(TestCase):
+    def test_results_keep_order_and_failures_are_returned(self):
+        def f(item):
+            if item == 3:
+                raise ValueError(item)
+            return item * 10
+
+        results = map_concurrently(f, range(6), key=lambda item: item % 2, max_workers=4, max_per_key=2)
+
+        self.assertEqual([item for item, _, _ in results], list(range(6)))
+        self.assertEqual([result for _, result, _ in results], [0, 10, 20, None, 40, 50])
+        self.assertIsInstance(results[3][2], ValueError)
+
+    def test_calls_per_key_are_capped(self):
+        lock = threading.Lock()
+        active_counts = {}
+        max_active_counts = {}
+
+        def f(item):
+            key = item % 2
+            with lock:
+                active_counts[key] = active_counts.get(key, 0) + 1
+                max_active_counts[key] = max(max_active_counts.get(key, 0), active_counts[key])
+            time.sleep(0.02)
+            with lock:
+                active_counts[key] -= 1
+
+        map_concurrently(f, range(12), key=lambda item: item % 2, max_workers=8, max_per_key=2)
+
+        self.assertEqual(max_active_counts, {0: 2, 1: 2})
+
+
+class ScheduledTaskTest(TestCase):
+    PERIOD = timedelta(seconds=10)
+
+    def setUp(self):
+        self.task = mock.Mock()
+        self.task.name = 'stratosphere.tasks.check_provider_health'
+        self.entity_id = uuid.uuid4()
+
+    def test_pending_run_is_not_scheduled_again(self):
+        self.assertTrue(ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD))
+        self.assertFalse(ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD))
+        self.assertEqual(self.task.apply_async.call_count, 1)
+
+        ScheduledTask.release(self.task.name, self.entity_id)
+        self.assertTrue(ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD))
+
+    def test_stale_run_is_rescheduled(self):
+        ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD)
+        ScheduledTask.objects.update(scheduled_at=timezone.now() - settings.SCHEDULED_TASK_STALE_AFTER * 2)
+
+        self.assertTrue(ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD))
+
+    def test_retrying_run_stays_claimed(self):
+        ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD)
+        ScheduledTask.record_retry(self.task.name, self.entity_id, 'Retry in 10s: timed out', 10)
+
+        self.assertFalse(ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD))
+
+        scheduled_task = ScheduledTask.objects.get()
+        self.assertEqual(scheduled_task.retry_count, 1)
+        self.assertEqual(scheduled_task.last_error, 'Retry in 10s: timed out')
+        self.assertGreater(scheduled_task.scheduled_at, timezone.now())
+
+    def test_one_off_run_is_enqueued_right_away_and_coalesced(self):
+        self.assertTrue(ScheduledTask.schedule(self.task, self.entity_id))
+        self.assertFalse(ScheduledTask.schedule(self.task, self.entity_id, self.PERIOD))
+
+        self.task.apply_async.assert_called_once_with(args=[self.entity_id], countdown=0)
+
+    def test_wheel_slot_is_stable(self):
+        now = timezone.now()
+        with mock.patch('stratosphere.submodels.scheduled_task.timezone.now', return_value=now):
+            countdown = ScheduledTask.wheel_countdown(self.task.name, self.entity_id, self.PERIOD)
+        with mock.patch('stratosphere.submodels.scheduled_task.timezone.now', return_value=now + timedelta(seconds=1)):
+            later_countdown = ScheduledTask.wheel_countdown(self.task.name, self.entity_id, self.PERIOD)
+
+        self.assertTrue(0 <= countdown < 10)
+        self.assertAlmostEqual((countdown - 1) % 10, later_countdown, places=2)
+
+
+class IsolatedTransactionTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        self.group, provider_configuration, provider_image, provider_size = create_compute_group(user, instance_count=3)
+        self.instances = create_instances(self.group, provider_configuration, provider_image, provider_size, 2)
+
+    def test_locked_object_is_reloaded(self):
+        first_group = ComputeGroup.objects.get(pk=self.group.pk)
+        second_group = ComputeGroup.objects.get(pk=self.group.pk)
+
+        # the second call would write back a count decremented from the 3 it loaded, if it didn't reload the group
+        first_group.destroy_instance(self.instances[0])
+        second_group.destroy_instance(self.instances[1])
+
+        self.assertEqual(ComputeGroup.objects.get(pk=self.group.pk).instance_count, 1)
+
+    def test_outermost_call_is_retried(self):
+        attempts = []
+
+        @isolated(lock_self=False)
+        def deadlock_once():
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise OperationalError('deadlock detected')
+
+        deadlock_once()
+        self.assertEqual(attempts, [0, 1])
+
+
+class CheckHealthTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        group, self.provider_configuration, provider_image, provider_size = create_compute_group(user, instance_count=1)
+        self.instance, = create_instances(group, self.provider_configuration, provider_image, provider_size, 1,
+                                          state=ComputeInstance.PENDING, external_id='i-12345678')
+
+    def test_changes_made_while_listing_nodes_are_kept(self):
+        def list_nodes():
+            # e.g. a failure being ignored by the user while the provider is queried
+            ComputeInstance.objects.filter(pk=self.instance.pk).update(failed=True, failed_at=timezone.now(),
+                                                                       failure_ignored=True)
+            return [Node(id='i-12345678', name='group-group-0', state=NodeState.RUNNING, public_ips=['10.0.0.1'],
+                         private_ips=[], driver=None)]
+
+        self.provider_configuration._list_nodes = list_nodes
+        self.provider_configuration.check_health()
+
+        instance = ComputeInstance.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.state, ComputeInstance.RUNNING)
+        self.assertEqual(instance.public_ips, ['10.0.0.1'])
+        self.assertTrue(instance.failed)
+        self.assertTrue(instance.failure_ignored)
+
+    def node(self, external_id, name, state=NodeState.RUNNING):
+        return Node(id=external_id, name=name, state=state, public_ips=[], private_ips=[], driver=None)
+
+    def test_orphan_nodes_are_reported(self):
+        # an instance whose create_libcloud_node() has created its node, but not yet recorded its external_id
+        ComputeInstance.objects.bulk_create([ComputeInstance(name='uncreated', group=self.instance.group,
+                                                             provider_configuration=self.provider_configuration,
+                                                             provider_image=self.instance.provider_image,
+                                                             provider_size=self.instance.provider_size,
+                                                             public_ips=[], private_ips=[], extra={})])
+
+        self.provider_configuration._list_nodes = lambda: [
+            self.node('i-12345678', 'group-group-0'),
+            self.node('i-orphan', 'stray'),
+            self.node('i-terminated', 'gone', state=NodeState.TERMINATED),
+            self.node('i-uncreated', 'group-uncreated'),
+        ]
+        orphan_nodes = self.provider_configuration.check_health()
+
+        self.assertEqual([node.id for node in orphan_nodes], ['i-orphan'])
+
+
+class BulkWriteTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password')
+        self.group, self.provider_configuration, provider_image, self.provider_size = \
+            create_compute_group(self.user, instance_count=2)
+        self.instances = create_instances(self.group, self.provider_configuration, provider_image, self.provider_size,
+                                          2, state=ComputeInstance.PENDING, failed_at=timezone.now())
+
+    def test_bulk_update_round_trips_values(self):
+        other_size = ProviderSize.objects.create(provider_configuration=self.provider_configuration,
+                                                 external_id='m4.xlarge', name='Extra Large', price=0.24, ram=16384,
+                                                 disk=0, cpu=13, extra={})
+        failed_at = timezone.now() - timedelta(minutes=5)
+
+        first, second = self.instances
+        first.state = ComputeInstance.RUNNING
+        first.public_ips = ['10.0.0.1']
+        first.extra = {'tags': {'name': 'first'}, 'zone': None}
+        first.provider_size_id = other_size.pk
+        first.failed_at = failed_at
+        second.state = None
+        second.failed_at = None
+
+        bulk_update(self.instances, ['state', 'public_ips', 'extra', 'provider_size', 'failed_at'])
+
+        first = ComputeInstance.objects.get(pk=first.pk)
+        self.assertEqual(first.state, ComputeInstance.RUNNING)
+        self.assertEqual(first.public_ips, ['10.0.0.1'])
+        self.assertEqual(first.extra, {'tags': {'name': 'first'}, 'zone': None})
+        self.assertEqual(first.provider_size_id, other_size.pk)
+        self.assertEqual(first.failed_at, failed_at)
+
+        second = ComputeInstance.objects.get(pk=second.pk)
+        self.assertIsNone(second.state)
+        self.assertIsNone(second.failed_at)
+        self.assertEqual(second.provider_size_id, self.provider_size.pk)
+
+    def test_bulk_create_inherited_writes_parent_and_child_rows(self):
+        events = [InstanceStateChangeEvent(user=self.user, provider_configuration=self.provider_configuration,
+                                           compute_group=self.group, compute_instance=instance,
+                                           old_state=ComputeInstance.PENDING, new_state=ComputeInstance.RUNNING)
+                  for instance in self.instances]
+        bulk_create_inherited(events)
+
+        for event, instance in zip(events, self.instances):
+            loaded = Event.objects.get(pk=event.pk)
+            self.assertIsInstance(loaded, InstanceStateChangeEvent)
+            self.assertEqual(loaded.compute_instance_id, instance.pk)
+            self.assertEqual(loaded.new_state, ComputeInstance.RUNNING)
+            self.assertIsNotNone(loaded.created_at)
+
+    def test_bulk_create_historical_records_matches_save(self):
+        instance = self.instances[0]
+        instance.state = ComputeInstance.RUNNING
+        instance.public_ips = ['10.0.0.1']
+        instance.save()
+        saved_record = instance.history.latest('history_date')
+
+        bulk_create_historical_records([instance])
+        bulk_record = instance.history.latest('history_date')
+
+        self.assertNotEqual(bulk_record.pk, saved_record.pk)
+        self.assertEqual(bulk_record.history_type, saved_record.history_type)
+        self.assertEqual(bulk_record.history_user, saved_record.history_user)
+        for field in ComputeInstance._meta.fields:
+            self.assertEqual(getattr(bulk_record, field.attname), getattr(saved_record, field.attname), field.name)
+
+
+class SyncProviderImagesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        _, self.provider_configuration, _, _ = create_compute_group(user)
+
+    def driver_images(self, *ids, **extra):
+        return [NodeImage(id=image_id, name=image_id, driver=None, extra=dict({'is_public': False}, **extra))
+                for image_id in ids]
+
+    def sync(self, driver_images, **kwargs):
+        with mock.patch('stratosphere.lib.provider_configuration_data_loader.bulk_update', wraps=bulk_update) as update:
+            self.provider_configuration._sync_provider_images(driver_images, False, 2, **kwargs)
+        return [obj.external_id for call in update.call_args_list for obj in call[0][0]]
+
+    def linked_images(self):
+        return {image.external_id: image for image in self.provider_configuration.provider_images.all()}
+
+    def test_new_images_are_created_and_linked_in_batches(self):
+        self.sync(self.driver_images('ami-1', 'ami-2', 'ami-3', 'ami-4', 'ami-5'))
+        self.assertEqual(set(self.linked_images()), {'ami-1', 'ami-2', 'ami-3', 'ami-4', 'ami-5'})
+
+    def test_only_changed_images_are_updated(self):
+        self.sync(self.driver_images('ami-1', 'ami-2', 'ami-3'))
+        images = self.linked_images()
+
+        updated_ids = self.sync(self.driver_images('ami-1', 'ami-3') + self.driver_images('ami-2', tag='changed'))
+        self.assertEqual(updated_ids, ['ami-2'])
+
+        synced_images = self.linked_images()
+        self.assertEqual(synced_images['ami-2'].extra, {'is_public': False, 'tag': 'changed'})
+        self.assertNotEqual(synced_images['ami-2'].extra_hash, images['ami-2'].extra_hash)
+        self.assertEqual(synced_images['ami-1'].extra_hash, images['ami-1'].extra_hash)
+        self.assertEqual({image.pk for image in synced_images.values()}, {image.pk for image in images.values()})
+
+    def test_images_deleted_remotely_are_removed(self):
+        self.sync(self.driver_images('ami-1', 'ami-2', 'ami-3'))
+        self.sync(self.driver_images('ami-1', 'ami-3'))
+
+        self.assertEqual(set(self.linked_images()), {'ami-1', 'ami-3'})
+        self.assertFalse(ProviderImage.objects.filter(external_id='ami-2').exists())
+
+    def test_images_are_not_removed_when_listing_is_truncated(self):
+        self.sync(self.driver_images('ami-1', 'ami-2', 'ami-3'))
+        self.sync(self.driver_images('ami-1', 'ami-2', 'ami-3'), driver_images_limit=2)
+
+        self.assertEqual(set(self.linked_images()), {'ami-1', 'ami-2', 'ami-3'})
+
+
+class LoadPublicCatalogTest(TestCase):
+    PUBLIC_IMAGE_IDS = ['ami-12345678', 'ami-public1', 'ami-public2']
+    PRIVATE_IMAGE_IDS = ['ami-private1', 'ami-private2']
+
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        _, self.provider_configuration, _, _ = create_compute_group(user)
+        self.provider = self.provider_configuration.provider
+
+    def driver_images(self, include_public):
+        image_ids_by_public = {True: self.PUBLIC_IMAGE_IDS, False: self.PRIVATE_IMAGE_IDS}
+        return [NodeImage(id=image_id, name=image_id, driver=None, extra={'is_public': is_public})
+                for is_public in ([True, False] if include_public else [False])
+                for image_id in image_ids_by_public[is_public]]
+
+    def load(self, load):
+        with mock.patch.object(AWSProviderConfiguration, '_load_available_sizes'), \
+                mock.patch.object(AWSProviderConfiguration, '_get_driver_images', side_effect=self.driver_images) \
+                as get_driver_images:
+            load()
+        return get_driver_images
+
+    def add_public_configuration(self):
+        with mock.patch('stratosphere.models.schedule_random_default_delay'):
+            credential_set = AWSProviderCredentialSet.objects.create(access_key_id='access_key_id',
+                                                                     secret_access_key='secret_access_key')
+            return AWSProviderConfiguration.objects.create(provider=self.provider, provider_name=self.provider.name,
+                                                           region='us-east-1', user=None,
+                                                           provider_credential_set=credential_set)
+
+    def public_images(self):
+        return {image.external_id: (image.pk, image.extra_hash, image.catalog_version)
+                for image in ProviderImage.objects.filter(provider=self.provider, provider_configurations=None)}
+
+    def test_fresh_catalog_is_not_reloaded(self):
+        self.load(self.add_public_configuration().load_public_catalog)
+        self.assertEqual(set(self.public_images()), set(self.PUBLIC_IMAGE_IDS))
+        catalog_version = Provider.objects.get(pk=self.provider.pk).public_catalog_version
+
+        get_driver_images = self.load(self.add_public_configuration().load_public_catalog)
+
+        self.assertFalse(get_driver_images.called)
+        self.assertEqual(Provider.objects.get(pk=self.provider.pk).public_catalog_version, catalog_version)
+
+    def test_private_load_leaves_public_catalog_alone(self):
+        self.load(self.add_public_configuration().load_public_catalog)
+        public_images = self.public_images()
+        catalog_version = Provider.objects.get(pk=self.provider.pk).public_catalog_version
+
+        get_driver_images = self.load(lambda: load_provider_data(self.provider_configuration.pk))
+
+        get_driver_images.assert_called_once_with(False)
+        self.assertEqual(set(self.provider_configuration.provider_images.values_list('external_id', flat=True)),
+                         set(self.PRIVATE_IMAGE_IDS))
+        self.assertEqual(self.public_images(), public_images)
+        self.assertEqual(Provider.objects.get(pk=self.provider.pk).public_catalog_version, catalog_version)
+
+    def test_claim_is_released_when_load_raises(self):
+        with mock.patch.object(self.provider_configuration, 'load_data', side_effect=RuntimeError('list_sizes failed')):
+            with self.assertRaises(RuntimeError):
+                self.provider_configuration.load_public_catalog()
+
+        provider = Provider.objects.get(pk=self.provider_configuration.provider_id)
+        self.assertIsNone(provider.public_catalog_loaded_at)
+
+
+class SharedCacheTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        _, self.provider_configuration, _, self.provider_size = create_compute_group(user)
+
+    def test_info_url_is_cached_until_its_configuration_changes(self):
+        self.assertIn('region=us-east-1', self.provider_size.info_url())
+
+        # an update() skips the signal, so the cached URL is still returned
+        ProviderConfiguration.objects.filter(pk=self.provider_configuration.pk).update(region='us-west-2')
+        provider_size = ProviderSize.objects.get(pk=self.provider_size.pk)
+        self.assertIn('region=us-east-1', provider_size.info_url())
+
+        # saving it bumps the cache's version for every process
+        self.provider_configuration.region = 'us-west-2'
+        self.provider_configuration.save()
+        provider_size = ProviderSize.objects.get(pk=self.provider_size.pk)
+        self.assertIn('region=us-west-2', provider_size.info_url())
+
+
+class LoadAvailableSizesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        _, self.provider_configuration, _, self.provider_size = create_compute_group(user)
+
+    def load_sizes(self, price):
+        driver = mock.Mock()
+        driver.list_sizes.return_value = [NodeSize(id='m4.large', name='Large', ram=8192, disk=0, bandwidth=None,
+                                                   price=price, driver=None, extra={})]
+
+        with mock.patch.object(AWSProviderConfiguration, 'driver', new_callable=mock.PropertyMock, return_value=driver), \
+                mock.patch('stratosphere.lib.provider_configuration_data_loader.bulk_update', wraps=bulk_update) as update:
+            self.provider_configuration._load_available_sizes()
+        return [obj.external_id for call in update.call_args_list for obj in call[0][0]]
+
+    def test_unchanged_float_price_is_not_rewritten(self):
+        self.assertEqual(self.load_sizes(0.12), [])
+
+    def test_changed_price_is_rewritten(self):
+        self.assertEqual(self.load_sizes(0.13), ['m4.large'])
+        self.assertEqual(ProviderSize.objects.get(pk=self.provider_size.pk).price, Decimal('0.13'))
+
+
+class BestProviderSizeTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        self.group, self.provider_configuration, provider_image, self.provider_size = create_compute_group(user)
+
+        disk_image = DiskImage.objects.create(name='image')
+        provider_image.disk_image = disk_image
+        provider_image.extra = {'is_public': True, 'virtualization_type': 'hvm', 'root_device_type': 'ebs'}
+        provider_image.save()
+        self.disk_image_mapping = DiskImageMapping.objects.create(provider=self.provider_configuration.provider,
+                                                                  disk_image=disk_image, compute_image=self.group.image)
+
+    def get_best_sizes(self):
+        return {provider_name: provider_size.pk for provider_name, provider_size in self.group._get_best_sizes().items()}
+
+    def test_best_size_is_indexed(self):
+        self.assertEqual(self.get_best_sizes(), {'aws_us_east_1': self.provider_size.pk})
+        self.assertEqual(BestProviderSize.objects.get().provider_size_id, self.provider_size.pk)
+
+        with mock.patch.object(ComputeGroup, '_find_best_size') as find_best_size:
+            self.assertEqual(self.get_best_sizes(), {'aws_us_east_1': self.provider_size.pk})
+        self.assertFalse(find_best_size.called)
+
+    def test_missing_size_is_indexed(self):
+        ProviderSize.objects.all().delete()
+
+        self.assertEqual(self.get_best_sizes(), {})
+        self.assertIsNone(BestProviderSize.objects.get().provider_size)
+
+    def test_mapping_changes_invalidate_index(self):
+        self.get_best_sizes()
+        self.disk_image_mapping.delete()
+        self.assertFalse(BestProviderSize.objects.exists())
+
+        self.assertEqual(self.get_best_sizes(), {})
+
+    def test_size_load_invalidates_index(self):
+        self.get_best_sizes()
+
+        driver = mock.Mock()
+        driver.list_sizes.return_value = [NodeSize(id='m4.large', name='Large', ram=8192, disk=0, bandwidth=None,
+                                                   price=0.13, driver=None, extra={})]
+        with mock.patch.object(AWSProviderConfiguration, 'driver', new_callable=mock.PropertyMock, return_value=driver):
+            self.provider_configuration._load_available_sizes()
+
+        self.assertFalse(BestProviderSize.objects.exists())
+
+
+class NeedsRebalanceTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        self.group, self.provider_configuration, self.provider_image, self.provider_size = \
+            create_compute_group(user, instance_count=1)
+        ComputeGroup.objects.update(needs_rebalance=False)
+
+    def needs_rebalance(self):
+        return ComputeGroup.objects.get(pk=self.group.pk).needs_rebalance
+
+    def check_all(self):
+        with mock.patch.object(ScheduledTask, 'enqueue') as enqueue:
+            check_instance_distribution_all()
+        return [call[0][1] for call in enqueue.call_args_list]
+
+    def test_rebalance_inputs_mark_group(self):
+        group = ComputeGroup.objects.get(pk=self.group.pk)
+        group.name = 'renamed'
+        group.save()
+        self.assertFalse(self.needs_rebalance())
+
+        group.instance_count = 2
+        group.save()
+        self.assertTrue(self.needs_rebalance())
+
+    def test_provider_changes_mark_groups(self):
+        with mock.patch.object(connections['default'], 'on_commit', lambda f: f()):
+            self.provider_configuration.mark_groups_for_rebalance()
+        self.assertTrue(self.needs_rebalance())
+
+    def test_marked_group_is_claimed_and_cleared(self):
+        self.assertEqual(self.check_all(), [])
+
+        ComputeGroup.objects.update(needs_rebalance=True)
+        self.assertEqual(self.check_all(), [self.group.pk])
+        self.assertFalse(self.needs_rebalance())
+
+        # still claimed by the run just enqueued
+        ComputeGroup.objects.update(needs_rebalance=True)
+        self.assertEqual(self.check_all(), [])
+        self.assertTrue(self.needs_rebalance())
+
+        ScheduledTask.release(check_instance_distribution.name, self.group.pk)
+        self.assertEqual(self.check_all(), [self.group.pk])
+
+    def test_sweep_skips_destroyed_groups_without_available_instances(self):
+        mark_compute_groups_for_rebalance()
+        self.assertTrue(self.needs_rebalance())
+
+        ComputeGroup.objects.update(state=ComputeGroup.DESTROYED, needs_rebalance=False)
+        instance, = create_instances(self.group, self.provider_configuration, self.provider_image, self.provider_size,
+                                     1, state=ComputeInstance.RUNNING)
+        mark_compute_groups_for_rebalance()
+        self.assertTrue(self.needs_rebalance())
+
+        ComputeGroup.objects.update(needs_rebalance=False)
+        ComputeInstance.objects.filter(pk=instance.pk).update(destroyed=True)
+        mark_compute_groups_for_rebalance()
+        self.assertFalse(self.needs_rebalance())
+
+
+class CreateComputeInstancesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password')
+
+        # nodes are created and destroyed by tasks scheduled once the transaction commits
+        self.on_commit_callbacks = []
+        on_commit_patcher = mock.patch.object(connections['default'], 'on_commit', self.on_commit_callbacks.append)
+        schedule_patcher = mock.patch('stratosphere.submodels.compute_instance.schedule_random_default_delay')
+        on_commit_patcher.start()
+        self.schedule = schedule_patcher.start()
+        self.addCleanup(on_commit_patcher.stop)
+        self.addCleanup(schedule_patcher.stop)
+
+    def add_group(self, region='us-east-1'):
+        group, provider_configuration, provider_image, provider_size = \
+            create_compute_group(self.user, provider_name='aws_%s' % region.replace('-', '_'), region=region)
+
+        disk_image = DiskImage.objects.create(name='image')
+        provider_image.disk_image = disk_image
+        provider_image.save()
+        DiskImageMapping.objects.create(provider=provider_configuration.provider, disk_image=disk_image,
+                                        compute_image=group.image)
+
+        return group, provider_configuration, provider_image, provider_size
+
+    def scale(self, group, provider_size, instance_count):
+        group.instance_count = instance_count
+        group.size_distribution = {str(provider_size.pk): instance_count}
+        group._create_compute_instances()
+
+    def commit(self):
+        for callback in self.on_commit_callbacks:
+            callback()
+        del self.on_commit_callbacks[:]
+
+    def live_instance_ids(self, group):
+        return set(group.instances.filter(~ComputeInstance.unavailable_instances_query()).values_list('pk', flat=True))
+
+    def test_scale_up_from_zero(self):
+        group, _, _, provider_size = self.add_group()
+        self.scale(group, provider_size, 25)
+
+        instances = list(group.instances.all())
+        self.assertEqual(len(instances), 25)
+        self.assertEqual(len({instance.name for instance in instances}), 25)
+        self.assertEqual(ComputeInstance.history.filter(group_id=group.pk, history_type='+').count(), 25)
+
+        # node creation waits for the instances to be committed
+        self.assertFalse(self.schedule.called)
+        self.commit()
+        self.assertEqual(sorted(call[0][1] for call in self.schedule.call_args_list),
+                         sorted(instance.pk for instance in instances))
+        self.assertTrue(all(call[0][0] is create_libcloud_node for call in self.schedule.call_args_list))
+
+    def test_scale_up_queries_do_not_grow_with_instance_count(self):
+        small_group, _, _, small_provider_size = self.add_group('us-east-1')
+        with CaptureQueriesContext(connection) as context:
+            self.scale(small_group, small_provider_size, 1)
+
+        large_group, _, _, large_provider_size = self.add_group('us-west-2')
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.scale(large_group, large_provider_size, 50)
+
+        self.assertEqual(large_group.instances.count(), 50)
+
+    def test_extra_instances_are_destroyed_once_enough_are_running(self):
+        group, provider_configuration, provider_image, provider_size = self.add_group()
+        create_instances(group, provider_configuration, provider_image, provider_size, 1, state=ComputeInstance.RUNNING)
+        create_instances(group, provider_configuration, provider_image, provider_size, 2, state=ComputeInstance.PENDING)
+
+        # one extra instance, but only one of the two wanted is running yet
+        self.scale(group, provider_size, 2)
+        self.assertEqual(len(self.live_instance_ids(group)), 3)
+
+        group.instances.update(state=ComputeInstance.RUNNING)
+        self.scale(group, provider_size, 2)
+        self.assertEqual(len(self.live_instance_ids(group)), 2)
+        self.assertEqual(ComputeInstance.objects.filter(group=group, destroyed=True).count(), 1)
+
+    def test_instances_on_removed_size_are_destroyed_once_replacements_are_running(self):
+        group, provider_configuration, provider_image, old_provider_size = self.add_group()
+        new_provider_size = ProviderSize.objects.create(provider_configuration=provider_configuration,
+                                                        external_id='m4.xlarge', name='Extra Large', price=0.24,
+                                                        ram=16384, disk=0, cpu=13, extra={})
+
+        old_instances = create_instances(group, provider_configuration, provider_image, old_provider_size, 2,
+                                         state=ComputeInstance.RUNNING)
+        create_instances(group, provider_configuration, provider_image, new_provider_size, 2,
+                         state=ComputeInstance.PENDING)
+        old_instance_ids = {instance.pk for instance in old_instances}
+
+        # the replacements are still pending, so the old instances are the only ones running
+        self.scale(group, new_provider_size, 2)
+        self.assertTrue(old_instance_ids <= self.live_instance_ids(group))
+
+        group.instances.filter(provider_size=new_provider_size).update(state=ComputeInstance.RUNNING)
+        self.scale(group, new_provider_size, 2)
+        self.assertFalse(old_instance_ids & self.live_instance_ids(group))
+        self.assertEqual(len(self.live_instance_ids(group)), 2)
+
+
+DESCRIBE_IMAGES_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<DescribeImagesResponse xmlns="http://ec2.amazonaws.com/doc/2013-10-15/">
+    <requestId>59dbff89-35bd-4eac-99ed-be587EXAMPLE</requestId>
+    <imagesSet>%s</imagesSet>
+</DescribeImagesResponse>"""
+
+DESCRIBE_IMAGES_ITEM_XML = """
+        <item>
+            <imageId>ami-%(index)08d</imageId>
+            <imageLocation>amazon/image-%(index)d</imageLocation>
+            <imageState>available</imageState>
+            <imageOwnerId>123456789012</imageOwnerId>
+            <isPublic>true</isPublic>
+            <architecture>x86_64</architecture>
+            <imageType>machine</imageType>
+            <name>image-%(index)d</name>
+            <rootDeviceType>ebs</rootDeviceType>
+            <rootDeviceName>/dev/xvda</rootDeviceName>
+            <blockDeviceMapping>
+                <item>
+                    <deviceName>/dev/xvda</deviceName>
+                    <ebs>
+                        <snapshotId>snap-%(index)08d</snapshotId>
+                        <volumeSize>8</volumeSize>
+                        <deleteOnTermination>true</deleteOnTermination>
+                        <volumeType>gp2</volumeType>
+                    </ebs>
+                </item>
+                <item>
+                    <deviceName>/dev/xvdb</deviceName>
+                    <virtualName>ephemeral0</virtualName>
+                </item>
+            </blockDeviceMapping>
+            <tagSet>
+                <item>
+                    <key>Name</key>
+                    <value>image-%(index)d</value>
+                </item>
+            </tagSet>
+            <virtualizationType>hvm</virtualizationType>
+            <hypervisor>xen</hypervisor>
+        </item>"""
+
+
+class FakeRawResponse(io.BytesIO):
+    status = 200
+
+    def __init__(self, body, headers):
+        super().__init__(body)
+        self.headers = headers
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class AWSDriverImagesTest(TestCase):
+    IMAGE_COUNT = 5
+
+    def setUp(self):
+        user = User.objects.create_user(email='test@example.com', password='password')
+        _, self.provider_configuration, _, _ = create_compute_group(user)
+        self.driver = self.provider_configuration.create_driver()
+
+        self.xml = DESCRIBE_IMAGES_XML % ''.join(DESCRIBE_IMAGES_ITEM_XML % {'index': index}
+                                                 for index in range(self.IMAGE_COUNT))
+
+    def image_fields(self, images):
+        return [(image.id, image.name, image.extra) for image in images]
+
+    def assertStreamedImagesMatch(self, body, headers):
+        def request(path, params=None, raw=False, **kwargs):
+            if raw:
+                return mock.Mock(response=FakeRawResponse(body, headers))
+            return mock.Mock(object=ElementTree.fromstring(self.xml))
+
+        parse = ElementTree.iterparse
+        images_sets = []
+        images_set_sizes = []
+
+        # remembers the imagesSet element, to check how many images it holds as each one is parsed
+        def iterparse(*args, **kwargs):
+            for event, element in parse(*args, **kwargs):
+                if event == 'start' and element.tag.endswith('imagesSet'):
+                    images_sets.append(element)
+                yield event, element
+
+        to_image = self.driver._to_image
+
+        def to_image_counting(element):
+            images_set_sizes.append(len(images_sets[0]))
+            return to_image(element)
+
+        with mock.patch.object(AWSProviderConfiguration, 'driver', new_callable=mock.PropertyMock,
+                               return_value=self.driver), \
+                mock.patch.object(self.driver.connection, 'request', side_effect=request), \
+                mock.patch.object(ElementTree, 'iterparse', iterparse), \
+                mock.patch.object(self.driver, '_to_image', side_effect=to_image_counting):
+            streamed_images = list(self.provider_configuration._get_driver_images(True))
+
+        with mock.patch.object(self.driver.connection, 'request', side_effect=request):
+            listed_images = self.driver.list_images()
+
+        self.assertEqual(self.image_fields(streamed_images), self.image_fields(listed_images))
+        self.assertEqual(len(streamed_images), self.IMAGE_COUNT)
+        self.assertEqual(len(streamed_images[0].extra['block_device_mapping']), 2)
+
+        # each image is dropped once the next one is parsed, so the set only ever holds the one being parsed
+        self.assertEqual(images_set_sizes, [1] * self.IMAGE_COUNT)
+        self.assertEqual(len(images_sets[0]), 0)
+
+    def test_streamed_images_match_list_images(self):
+        self.assertStreamedImagesMatch(self.xml.encode('utf-8'), {})
+
+    def test_gzipped_response(self):
+        self.assertStreamedImagesMatch(gzip.compress(self.xml.encode('utf-8')), {'content-encoding': 'gzip'})
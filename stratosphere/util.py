@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import json
 import logging
 import random
@@ -7,12 +8,18 @@ import time
 import traceback
 
 from celery import current_task
+from concurrent.futures import ThreadPoolExecutor
 from celery.utils.log import get_task_logger
 from django.contrib.staticfiles.storage import CachedFilesMixin
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, OperationalError, router, transaction
 from django.utils import timezone
 from functools import wraps
 from haikunator import haikunate
 from libcloud.compute.drivers.ec2 import EC2NetworkInterface
+from simple_history.models import HistoricalRecords
 from storages.backends.s3boto import S3BotoStorage
 
 
@@ -75,11 +82,10 @@ def call_with_retry(f, exception_type, tries=4, delay=0.01, backoff=4, logger=No
             ret = f(*args, **kwargs)
             succeeded = True
         except exception_type as e:
-            task_traceback = ''.join(traceback.format_list(traceback.extract_stack()))
             exception_traceback = ''.join(traceback.format_list(traceback.extract_tb(e.__traceback__)))
 
-            msg = "%s failed (%s: %s), retrying in %d seconds. Task traceback:\n%s\nException traceback:\n%s" % \
-                  (f.__name__, e.__class__.__qualname__, str(e), mdelay, task_traceback, exception_traceback)
+            msg = "%s failed (%s: %s), retrying in %d seconds. Exception traceback:\n%s" % \
+                  (f.__name__, e.__class__.__qualname__, str(e), mdelay, exception_traceback)
 
             if logger:
                 logger.warning(msg)
@@ -159,14 +165,177 @@ def schedule_random_default_delay(task, *args):
     schedule_random_delay(task, 5, 2, *args)
 
 
-def generate_name(existing_query):
-    try_count = 0
-    while True:
-        name = haikunate(tokenlength=try_count, delimiter='')
-        if not existing_query.filter(name=name).exists():
-            return name
+# number of plain adjective-noun names tried before falling back to a numeric suffix
+NAME_ATTEMPTS = 10
+
+
+def generate_names(existing_query, count):
+    """
+    Returns `count` distinct names that aren't used by any object in `existing_query`, with a single query for the
+    existing names. Each name is a random adjective-noun pair; if NAME_ATTEMPTS of those collide, the last one gets
+    the smallest numeric suffix that's free.
+    """
+    taken_names = set(existing_query.values_list('name', flat=True))
+    names = []
+
+    for i in range(count):
+        for attempt in range(NAME_ATTEMPTS):
+            name = haikunate(tokenlength=0, delimiter='')
+            if name not in taken_names:
+                break
         else:
-            try_count += 1
+            base_name = name
+            suffix = 2
+            while '%s%d' % (base_name, suffix) in taken_names:
+                suffix += 1
+            name = '%s%d' % (base_name, suffix)
+
+        taken_names.add(name)
+        names.append(name)
+
+    return names
+
+
+def grouper(n, iterable):
+    it = iter(iterable)
+    while True:
+        chunk = tuple(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_concurrently(f, items, key, max_workers, max_per_key):
+    """
+    Calls f(item) for each of `items` on a pool of up to `max_workers` threads, running at most `max_per_key` items
+    with the same key(item) at a time, and returns a list of (item, result, exception) tuples in the order of
+    `items`. Exceptions are returned rather than raised, so that one failing item doesn't hide the others' results.
+
+    Django opens a database connection per thread, so each thread closes its connections when it's done with an
+    item.
+    """
+    items = list(items)
+    semaphores = {}
+    indexes_by_key = {}
+    for index, item in enumerate(items):
+        semaphores.setdefault(key(item), threading.BoundedSemaphore(max_per_key))
+        indexes_by_key.setdefault(key(item), []).append(index)
+
+    def call(item):
+        with semaphores[key(item)]:
+            try:
+                return f(item), None
+            except Exception as e:
+                return None, e
+            finally:
+                connections.close_all()
+
+    # submit items round-robin across keys, so that pool threads don't pile up waiting on one key's semaphore
+    interleaved_indexes = [index for key_indexes in itertools.zip_longest(*indexes_by_key.values())
+                           for index in key_indexes if index is not None]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = {index: executor.submit(call, items[index]) for index in interleaved_indexes}
+        return [(item,) + futures[index].result() for index, item in enumerate(items)]
+
+
+def bulk_update(objs, field_names, batch_size=1000):
+    """
+    Writes the given fields of every object in `objs` back to the database with one UPDATE ... FROM (VALUES ...)
+    statement per batch, instead of one UPDATE per object. Skips signals, like QuerySet.update() does.
+    """
+    if len(objs) == 0:
+        return
+
+    model = objs[0].__class__
+    connection = connections[router.db_for_write(model)]
+    quote_name = connection.ops.quote_name
+
+    pk_field = model._meta.pk
+    fields = [model._meta.get_field(field_name) for field_name in field_names]
+    columns = [pk_field] + fields
+
+    # every value has to be cast, since Postgres otherwise infers VALUES columns as text
+    placeholders = '(%s)' % ', '.join(['%%s::%s' % f.db_type(connection) for f in columns])
+    set_clause = ', '.join(['%s = v.%s' % (quote_name(f.column), quote_name(f.column)) for f in fields])
+    table = quote_name(model._meta.db_table)
+
+    # An UPDATE ... FROM locks rows in whatever order its join happens to produce them, so two bulk updates of
+    # overlapping rows can deadlock. Locking the rows in primary key order first makes them queue instead.
+    objs = sorted(objs, key=lambda obj: obj.pk)
+
+    with transaction.atomic(using=connection.alias):
+        for chunk in grouper(batch_size, objs):
+            list(model._base_manager.using(connection.alias).select_for_update()
+                                    .filter(pk__in=[obj.pk for obj in chunk]).order_by('pk').values_list('pk', flat=True))
+
+        for chunk in grouper(batch_size, objs):
+            params = []
+            for obj in chunk:
+                params.extend(f.get_db_prep_save(getattr(obj, f.attname), connection=connection) for f in columns)
+
+            sql = 'UPDATE %s SET %s FROM (VALUES %s) AS v (%s) WHERE %s.%s = v.%s' % (
+                table, set_clause, ', '.join([placeholders] * len(chunk)),
+                ', '.join([quote_name(f.column) for f in columns]),
+                table, quote_name(pk_field.column), quote_name(pk_field.column))
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+
+def bulk_create_inherited(objs):
+    """
+    Like QuerySet.bulk_create(), but also works for multi-table inherited models like the Event subclasses, which
+    Django refuses to bulk create. Issues one INSERT per table in the inheritance chain, which only works because
+    our primary keys are UUIDs assigned before saving.
+    """
+    if len(objs) == 0:
+        return objs
+
+    model = objs[0].__class__
+    using = router.db_for_write(model)
+
+    for obj in objs:
+        if hasattr(obj, 'pre_save_polymorphic'):
+            obj.pre_save_polymorphic()
+
+    for table_model in list(reversed(list(model._meta.get_parent_list()))) + [model]:
+        for obj in objs:
+            for parent, parent_link in table_model._meta.parents.items():
+                setattr(obj, parent_link.attname, obj._get_pk_val(parent._meta))
+
+        table_model._base_manager._insert(objs, fields=table_model._meta.local_concrete_fields, using=using)
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = using
+
+    return objs
+
+
+def bulk_create_historical_records(objs, history_type='~'):
+    """
+    Creates the django-simple-history records that saving each object individually would have, with a single
+    INSERT. `history_type` is '+' for created objects and '~' for changed ones.
+    """
+    if len(objs) == 0:
+        return
+
+    history_model = objs[0].__class__.history.model
+    history_date = timezone.now()
+
+    # mirrors HistoricalRecords.get_history_user()
+    request = getattr(HistoricalRecords.thread, 'request', None)
+    user = getattr(request, 'user', None)
+    history_user = user if user is not None and user.is_authenticated() else None
+
+    historical_records = []
+    for obj in objs:
+        attrs = {field.attname: getattr(obj, field.attname) for field in obj._meta.fields}
+        historical_records.append(history_model(history_date=history_date, history_type=history_type,
+                                                history_user=history_user, **attrs))
+
+    history_model.objects.bulk_create(historical_records)
 
 
 # from https://dzone.com/articles/django-switching-databases
@@ -213,12 +382,123 @@ class thread_local(object):
         return inner
 
 
+@contextmanager
+def isolated_transaction(lock=None):
+    """ opens a transaction for a read-modify-write path, isolated according to settings.TRANSACTION_ISOLATION_MODE
+
+    In 'serializable' mode, the transaction runs against the serializable database, and conflicting concurrent
+    transactions abort with serialization failures. In 'row_lock' mode, it runs at READ COMMITTED, and first locks
+    the row of the model instance `lock` with SELECT ... FOR UPDATE, so that concurrent transactions on the same
+    object wait for each other instead of aborting.
+
+    Unless the transaction is nested in another isolated transaction, `lock` is reloaded once the transaction has begun
+    (and its row is locked), so that a caller that waited on the lock works from what the transaction it waited on
+    wrote, rather than from the fields it loaded before. Nested transactions assume the object was loaded, or locked,
+    by the enclosing one.
+    """
+    reload = lock is not None and not get_thread_local('ISOLATED_TRANSACTION', False)
+
+    if settings.TRANSACTION_ISOLATION_MODE == 'serializable':
+        with thread_local(DB_OVERRIDE='serializable', ISOLATED_TRANSACTION=True), transaction.atomic():
+            if reload:
+                lock.refresh_from_db()
+            yield
+    else:
+        with thread_local(ISOLATED_TRANSACTION=True), transaction.atomic():
+            if lock is not None:
+                list(lock.__class__._base_manager.select_for_update().filter(pk=lock.pk).values_list('pk', flat=True))
+                if reload:
+                    lock.refresh_from_db()
+            yield
+
+
+def isolated(lock_self=True):
+    """ a decorator that runs a method in an isolated_transaction(), locking the row of the object it's called on
+    unless lock_self is False
+
+    Calls that open the transaction are retried when it deadlocks or fails to serialize, e.g. when a rebalance and
+    a health check lock their group and provider configuration first and then wait on each other's instance rows.
+    Calls nested in another isolated transaction aren't, since the error aborts the enclosing one, which has to be
+    retried as a whole.
+    """
+    def deco(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            def run():
+                with isolated_transaction(args[0] if lock_self else None):
+                    return f(*args, **kwargs)
+
+            if get_thread_local('ISOLATED_TRANSACTION', False):
+                return run()
+            else:
+                return call_with_retry(run, OperationalError, logger=get_task_logger(f.__module__))
+
+        return inner
+
+    return deco
+
+
 def get_thread_local(attr, default=None):
     """ use this method from lower in the stack to get the value """
     stack = getattr(_stratosphere_threadlocal, attr, [])
     return stack[-1] if len(stack) > 0 else default
 
 
+def request_cached(f):
+    """ a decorator that memoizes lookups made through get_request_cached() for the duration of each call, e.g., for
+    the rows a view would otherwise fetch once per serialized object
+    """
+    @wraps(f)
+    def inner(*args, **kwargs):
+        with thread_local(REQUEST_CACHE={}):
+            return f(*args, **kwargs)
+
+    return inner
+
+
+def get_request_cached(key, load):
+    """ returns load(), memoized by key if called within a request_cached function """
+    cache = get_thread_local('REQUEST_CACHE')
+    if cache is None:
+        return load()
+
+    if key not in cache:
+        cache[key] = load()
+    return cache[key]
+
+
+# how long get_shared_cached() keeps values for, which bounds how stale they can get if a change isn't signalled
+SHARED_CACHE_TIMEOUT = 5 * 60
+
+
+def _shared_cache_version_key(namespace):
+    return 'shared_cache_version:%s' % namespace
+
+
+def get_shared_cached(namespace, key, load, timeout=SHARED_CACHE_TIMEOUT):
+    """ returns load(), memoized by key in the Django cache for `timeout` seconds or until bump_shared_cache(namespace)
+    is called, and within a request_cached function for the rest of the call. With a shared cache backend, a bump
+    reaches every process; with the default per-process one, other processes see changes once `timeout` is up.
+    """
+    def load_shared():
+        version = cache.get(_shared_cache_version_key(namespace), 0)
+        cache_key = '%s:%s:%s' % (namespace, version, ':'.join(str(part) for part in key))
+
+        value = cache.get(cache_key)
+        if value is None:
+            value = load()
+            cache.set(cache_key, value, timeout)
+        return value
+
+    return get_request_cached((namespace, key), load_shared)
+
+
+def bump_shared_cache(namespace):
+    """ makes get_shared_cached() reload everything in `namespace` """
+    # a timestamp rather than a counter, so that the version never goes back to one already used if it's evicted
+    cache.set(_shared_cache_version_key(namespace), int(time.time() * 1000000), None)
+
+
 # no-argument decorators work differently than with-argument decorators, so we
 # have to do some bridging between them
 class static_thread_local(thread_local):
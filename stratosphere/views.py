@@ -1,4 +1,4 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
@@ -7,15 +7,18 @@ from django.forms import modelform_factory
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 
 import base64
 import copy
 import json
+import math
 import re
 
 from .forms import *
 from .tasks import load_provider_data
-from .util import generate_name, schedule_random_default_delay, unix_time_millis
+from .util import generate_names, request_cached, schedule_random_default_delay, unix_time_millis
 
 
 def view_or_basicauth(view, request, *args, **kwargs):
@@ -328,9 +331,10 @@ def _compute_instance_to_json(instance):
     failed_at = instance.failed_at.timestamp() if instance.failed_at is not None else None
 
     provider_size_json = _provider_size_to_json(instance.provider_size)
+    provider_configuration = instance.provider_configuration
 
     return {'id': instance.pk, 'provider_size': provider_size_json,
-            'provider_pretty_name': instance.provider_configuration.provider.pretty_name,
+            'provider_pretty_name': provider_configuration.provider.pretty_name,
             'name': instance.name, 'created_at': instance.created_at.timestamp(),
             'external_id': instance.external_id, 'public_ips': instance.public_ips,
             'private_ips': instance.private_ips, 'destroyed_at': destroyed_at,
@@ -339,19 +343,74 @@ def _compute_instance_to_json(instance):
             'size': instance.provider_size.external_id,
             'size_price': instance.provider_size.price,
             'size_info_url': instance.provider_size.info_url(),
-            'provider_icon_url': instance.provider_configuration.provider.icon_url(),
-            'provider_admin_url': instance.provider_configuration.admin_url()}
+            'provider_icon_url': provider_configuration.provider.icon_url(),
+            'provider_admin_url': provider_configuration.admin_url()}
+
+
+# The number of queries _compute_groups_to_json() makes, regardless of how many groups and instances it serializes,
+# assuming the user has provider configurations of both types
+COMPUTE_GROUPS_JSON_QUERY_BUDGET = 8
+
+
+def _compute_groups_to_json(user, compute_groups):
+    """
+    Serializes `compute_groups` with a fixed number of queries by loading each kind of related row once for all
+    groups, and by computing instance counts in SQL.
+    """
+    compute_groups = list(compute_groups)
+    group_ids = [group.pk for group in compute_groups]
+
+    providers_by_id = {provider.pk: provider for provider in Provider.objects.all()}
+
+    provider_configurations_by_id = {}
+    for provider_configuration in user.provider_configurations.all():
+        provider_configuration.provider = providers_by_id[provider_configuration.provider_id]
+        provider_configurations_by_id[provider_configuration.pk] = provider_configuration
+
+    provider_configurations_by_name = {pc.provider_name: pc for pc in provider_configurations_by_id.values()}
+
+    provider_size_ids = set()
+    for group in compute_groups:
+        provider_size_ids.update(group.size_distribution.keys())
+    provider_sizes = {ComputeGroup._get_provider_size_key(provider_size): provider_size
+                      for provider_size in ProviderSize.objects.filter(pk__in=provider_size_ids)}
+
+    instances_by_group_id = {group_id: [] for group_id in group_ids}
+    instances = ComputeInstance.objects.filter(~Q(state=ComputeInstance.TERMINATED), group__in=group_ids) \
+                                       .select_related('provider_size')
+    for instance in instances:
+        provider_configuration = provider_configurations_by_id.get(instance.provider_configuration_id)
+        if provider_configuration is not None:
+            instance.provider_configuration = provider_configuration
+            instance.provider_size.provider_configuration = provider_configuration
+
+        instances_by_group_id[instance.group_id].append(instance)
+
+    state_counts_by_group_id = {group_id: {} for group_id in group_ids}
+    state_counts = ComputeInstance.objects.filter(group__in=group_ids).values('group', 'provider_configuration') \
+                                          .annotate(**ComputeInstance.state_count_aggregates())
+    for counts in state_counts:
+        state_counts_by_group_id[counts['group']][counts['provider_configuration']] = counts
+
+    groups_json = []
+    for group in compute_groups:
+        group_state_counts = state_counts_by_group_id[group.pk]
+        instances_json = [_compute_instance_to_json(instance) for instance in instances_by_group_id[group.pk]]
+
+        groups_json.append({
+            'id': group.pk, 'name': group.name, 'cpu': group.cpu, 'memory': group.memory,
+            'running_instance_count': sum(counts['running'] for counts in group_state_counts.values()),
+            'instance_count': group.instance_count,
+            'providers': group.provider_states(provider_configurations_by_name, group_state_counts),
+            'state': 'DESTROYED' if group.state == 'DESTROYED' else 'RUNNING',
+            'instances': instances_json, 'created_at': group.created_at.timestamp(),
+            'cost': group.estimated_cost(provider_sizes)})
+
+    return groups_json
 
 
 def _compute_group_to_json(group):
-    state = group.instances.filter(~Q(state=ComputeInstance.TERMINATED))
-    instances_json = [_compute_instance_to_json(instance) for instance in state]
-    return {'id': group.pk, 'name': group.name, 'cpu': group.cpu, 'memory': group.memory,
-            'running_instance_count': group.instances.filter(ComputeInstance.running_instances_query()).count(),
-            'instance_count': group.instance_count, 'providers': group.provider_states(),
-            'state': 'DESTROYED' if group.state == 'DESTROYED' else 'RUNNING',
-            'instances': instances_json, 'created_at': group.created_at.timestamp(),
-            'cost': group.estimated_cost()}
+    return _compute_groups_to_json(group.user, [group])[0]
 
 
 @login_required
@@ -388,10 +447,11 @@ def authentication_methods(request, method_id=None):
 
 
 @login_required
+@request_cached
 def compute(request, group_id=None):
     if request.method == 'GET':
         if group_id is None:
-            compute_groups = [_compute_group_to_json(group) for group in request.user.compute_groups.all()]
+            compute_groups = _compute_groups_to_json(request.user, request.user.compute_groups.all())
             return JsonResponse(compute_groups, safe=False)
         else:
             compute_group = _compute_group_to_json(request.user.compute_groups.filter(pk=group_id).first())
@@ -411,7 +471,7 @@ def compute(request, group_id=None):
 
         name = params.get('name')
         if name is None or len(name.strip()) == 0:
-            name = generate_name(request.user.compute_groups)
+            name = generate_names(request.user.compute_groups, 1)[0]
 
         key_authentication_method_id = params.get('key_authentication_method')
         if key_authentication_method_id != None:
@@ -492,7 +552,7 @@ def aws_provider(request):
                     provider_configuration.data_state = ProviderConfiguration.NOT_LOADED
                     provider_configuration.save()
 
-                    load_provider_data.apply_async(args=[provider_configuration.pk])
+                    ScheduledTask.schedule(load_provider_data, provider_configuration.pk)
 
         if is_setup_complete(request.user):
             return redirect('/providers/aws/')
@@ -542,7 +602,7 @@ def azure_provider(request):
                     provider_configuration.data_state = ProviderConfiguration.NOT_LOADED
                     provider_configuration.save()
 
-                    load_provider_data.apply_async(args=[provider_configuration.pk])
+                    ScheduledTask.schedule(load_provider_data, provider_configuration.pk)
 
         if is_setup_complete(request.user):
             return redirect('/providers/azure/')
@@ -595,31 +655,34 @@ def providers_refresh(request):
         provider_configuration.data_state = ProviderConfiguration.NOT_LOADED
         provider_configuration.save()
 
-        load_provider_data.apply_async(args=[provider_configuration.pk])
+        ScheduledTask.schedule(load_provider_data, provider_configuration.pk)
 
     return HttpResponse('')
 
 
 def _provider_json(provider_configuration):
+    provider = Provider.get_cached(provider_configuration.provider_id)
+
     return {'id': provider_configuration.pk,
-            'pretty_name': provider_configuration.provider.pretty_name,
+            'pretty_name': provider.pretty_name,
             'enabled': provider_configuration.enabled,
             'failure_count': provider_configuration.failure_count(timezone.now()),
             'running_count': provider_configuration.instances.filter(ComputeInstance.running_instances_query()).count(),
             'cost': provider_configuration.estimated_cost(),
             'admin_url': provider_configuration.admin_url(),
-            'icon_url': provider_configuration.provider.icon_url(),
+            'icon_url': provider.icon_url(),
             'failed': provider_configuration.failed}
 
 
 @login_required
+@request_cached
 def get_providers(request, provider_id=None):
     if provider_id is None:
         provider_configurations = request.user.provider_configurations.all()
         return JsonResponse([_provider_json(pc) for pc in provider_configurations], safe=False)
 
     else:
-        provider_configuration = ProviderConfiguration.objects.get(pk=provider_id)
+        provider_configuration = ProviderConfiguration.get_cached(provider_id)
         return JsonResponse(_provider_json(provider_configuration))
 
 
@@ -661,50 +724,57 @@ def provider_disk_images(request, provider_id):
         return JsonResponse([], safe=False)
 
 
-@login_required
-def state_history(request, group_id=None):
-    def get_history_dict(h):
-        return {'time': unix_time_millis(h[0]),
-                'running': h[1].running,
-                'pending': h[1].pending,
-                'failed': h[1].failed}
-
-    time_field = 'time' if group_id is None else 'user_snapshot__time'
+# how many buckets state_history() downsamples a chart's window into by default, and at most
+STATE_HISTORY_POINTS = 500
+MAX_STATE_HISTORY_POINTS = 5000
 
-    limit = request.GET.get('limit')
-    if limit is None or len(limit.strip()) == 0:
-        limit_datetime = None
-        limit_query = Q()
-    else:
-        limit_datetime = timezone.now() - timedelta(seconds=int(limit))
-        limit_query = Q(**{'%s__gte' % time_field: limit_datetime})
 
-    if group_id is None:
-        snapshots = request.user.instance_states_snapshots
-    else:
-        group = request.user.compute_groups.filter(pk=group_id).first()
-        snapshots = GroupInstanceStatesSnapshot.objects.filter(group=group)
+def _state_history_bucket_to_json(bucket):
+    return dict(bucket, time=unix_time_millis(bucket['time']))
 
-    snapshots = snapshots.order_by(time_field)
 
-    if group_id is None:
-        history = [(s.time, s) for s in snapshots.filter(limit_query)]
+@login_required
+def state_history(request, group_id=None):
+    """
+    Returns the user's instance state counts, or one of their group's, over the last `limit` seconds (or all time),
+    downsampled to at most `points` buckets; see instance_states_history(), which reads long windows from rollups.
+    The history starts with the counts as of the start of the window, if there were any snapshots before it.
+    """
+    try:
+        points = max(1, min(int(request.GET.get('points', STATE_HISTORY_POINTS)), MAX_STATE_HISTORY_POINTS))
+        limit = request.GET.get('limit')
+        limit_seconds = None if limit is None or len(limit.strip()) == 0 else int(limit)
+    except ValueError as e:
+        return HttpResponse('Invalid limit or points: %s' % e, status=422)
+
+    if group_id is not None:
+        if not request.user.compute_groups.filter(pk=group_id).exists():
+            return JsonResponse([], safe=False)
+
+    now = timezone.now()
+    if limit_seconds is None:
+        limit_datetime = None
+        start = instance_states_first_time(request.user.pk, group_id)
     else:
-        # TODO optimize this with a JOIN
-        history = [(s.user_snapshot.time, s) for s in snapshots.filter(limit_query)]
+        limit_datetime = now - timedelta(seconds=limit_seconds)
+        start = limit_datetime
+
+    history = []
+    if start is not None:
+        bucket_seconds = max(1, int(math.ceil((now - start).total_seconds() / points)))
+        history = instance_states_history(request.user.pk, start, bucket_seconds, group_id)
 
     if len(history) == 0:
-        last_snapshot = snapshots.last()
+        last_snapshot = instance_states_last_before(request.user.pk, None, group_id)
         if last_snapshot is not None:
-            time = last_snapshot.time if group_id is None else last_snapshot.user_snapshot.time
-            history = [(time, last_snapshot)]
+            history = [last_snapshot]
     elif limit_datetime is not None:
-        previous_snapshot = snapshots.filter(**{'%s__lt' % time_field: limit_datetime}).last()
+        previous_snapshot = instance_states_last_before(request.user.pk, limit_datetime, group_id)
 
         if previous_snapshot is not None:
-            history = [(limit_datetime, previous_snapshot)] + history
+            history = [dict(previous_snapshot, time=limit_datetime)] + history
 
-    history = [get_history_dict(h) for h in history]
+    history = [_state_history_bucket_to_json(bucket) for bucket in history]
     return JsonResponse(history, safe=False)
 
 
@@ -724,11 +794,49 @@ def _event_to_json(event):
 
     return json
 
+# how many events the events feed returns by default, and at most
+EVENTS_PAGE_SIZE = 100
+MAX_EVENTS_PAGE_SIZE = 1000
+
+# how far behind the cursor the events feed looks for events that committed after newer ones were returned
+EVENTS_CURSOR_OVERLAP = timedelta(minutes=1)
+
+_event_cursor_epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _event_cursor(event):
+    # microseconds rather than a float timestamp, so that the cursor round-trips exactly
+    return '%d_%s' % ((event.created_at - _event_cursor_epoch) // timedelta(microseconds=1), event.pk)
+
+
+def _parse_event_cursor(cursor):
+    micros, _, event_id = cursor.partition('_')
+    return _event_cursor_epoch + timedelta(microseconds=int(micros)), uuid.UUID(event_id)
+
+
 @login_required
+@request_cached
 def get_events(request):
+    """
+    Returns a page of the user's events, ordered by (created_at, id), with a cursor for the newest one. Pass the
+    cursor back as `since` to get only the events created after it; without `since`, the newest `limit` events are
+    returned. `has_more` is set if there are newer events than the page holds.
+
+    Events get their created_at when they're saved, but only become visible once their transaction commits, so an
+    event can show up after newer ones were already returned. Pages after `since` therefore also include the events
+    created within EVENTS_CURSOR_OVERLAP before it, which clients have to skip by ID if they've already seen them.
+    """
     compute_group_id = request.GET.get('computeGroupId')
+    since = request.GET.get('since')
     events = request.user.events.all()
 
+    try:
+        limit = min(int(request.GET.get('limit', EVENTS_PAGE_SIZE)), MAX_EVENTS_PAGE_SIZE)
+        if since is not None:
+            since_created_at, since_id = _parse_event_cursor(since)
+    except ValueError as e:
+        return HttpResponse('Invalid events cursor or limit: %s' % e, status=422)
+
     if compute_group_id is not None:
         try:
             uuid.UUID(compute_group_id)
@@ -736,12 +844,82 @@ def get_events(request):
             return HttpResponse('Invalid filter object ID: %s' % e, 422)
 
         compute_group = request.user.compute_groups.get(pk=compute_group_id)
-        provider_configuration_ids = [ProviderConfiguration.objects.get(provider_name=provider_name, user=compute_group.user)
-                                      for provider_name in compute_group.provider_policy.keys()]
-        events = events.filter(Q(compute_group_id=compute_group_id) | Q(provider_configuration_id__in=provider_configuration_ids))
+        provider_configuration_ids = ProviderConfiguration.objects.filter(provider_name__in=compute_group.provider_policy.keys(),
+                                                                          user=compute_group.user).values_list('pk', flat=True)
+        events = events.filter(Q(compute_group_id=compute_group_id) | Q(provider_configuration_id__in=list(provider_configuration_ids)))
+
+    if since is None:
+        new_events = list(reversed(events.order_by('-created_at', '-id')[:limit]))
+        late_events = []
+        has_more = False
+    else:
+        # fetch one extra event to tell whether there are more
+        after_since = Q(created_at__gt=since_created_at) | Q(created_at=since_created_at, id__gt=since_id)
+        new_events = list(events.filter(after_since).order_by('created_at', 'id')[:limit + 1])
+        has_more = len(new_events) > limit
+        new_events = new_events[:limit]
+
+        late_events = list(events.filter(created_at__gte=since_created_at - EVENTS_CURSOR_OVERLAP)
+                                 .exclude(after_since).order_by('created_at', 'id')[:MAX_EVENTS_PAGE_SIZE])
 
-    json = [_event_to_json(event) for event in events]
-    return JsonResponse(json, safe=False)
+    events = late_events + new_events
+    Event.prefetch_related_objects(events)
+
+    json = {'events': [_event_to_json(event) for event in events],
+            'cursor': _event_cursor(new_events[-1]) if len(new_events) > 0 else since,
+            'has_more': has_more}
+    return JsonResponse(json)
+
+
+@login_required
+@request_cached
+def changes(request):
+    """
+    Returns what changed on the user's dashboard since version `since` of their change counter (or everything, without
+    `since`): the new version, the sections that changed, and the compute groups and providers that did. Those come
+    with the ids of the ones that were removed (under 'compute_removed' and 'providers_removed') when only some of
+    them changed, and without when the whole list was sent. The events feed and state history fetch their own deltas
+    when they've changed. Responses are tagged with the version, so polls that send it back in If-None-Match get an
+    empty 304 until something changes.
+    """
+    try:
+        since = int(request.GET['since']) if 'since' in request.GET else -1
+    except ValueError as e:
+        return HttpResponse('Invalid version: %s' % e, status=422)
+
+    # read before the sections, since bumps come after the changes commit, so the sections are at least this new
+    change_counter = ChangeCounter.get_for_user(request.user)
+    version = str(change_counter.version)
+
+    if version in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponse(status=304)
+    else:
+        changed_sections = change_counter.changed_sections(since)
+        json = {'version': change_counter.version, 'changed': changed_sections}
+
+        sections_json = [
+            (ChangeCounter.COMPUTE, request.user.compute_groups.all(),
+             lambda groups: _compute_groups_to_json(request.user, groups)),
+            (ChangeCounter.PROVIDERS, request.user.provider_configurations.all(),
+             lambda provider_configurations: [_provider_json(pc) for pc in provider_configurations]),
+        ]
+        for section, objects, to_json in sections_json:
+            if section not in changed_sections:
+                continue
+
+            changed_ids = change_counter.changed_object_ids(section, since)
+            if changed_ids is None:
+                json[section] = to_json(objects)
+            else:
+                objects = list(objects.filter(pk__in=changed_ids))
+                json[section] = to_json(objects)
+                json['%s_removed' % section] = sorted(changed_ids - {obj.pk for obj in objects})
+
+        response = JsonResponse(json)
+
+    response['ETag'] = quote_etag(version)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 def letsencrypt_challenge(request):